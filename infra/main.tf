@@ -107,6 +107,12 @@ module "cloudfunctions" {
   gcf_max_instance_count = var.gcf_max_instance_count
   gcf_timeout_seconds    = var.gcf_timeout_seconds
 
+  gcf_max_instance_request_concurrency = var.gcf_max_instance_request_concurrency
+  gcf_available_cpu                    = var.gcf_available_cpu
+  gcf_available_memory_mb              = var.gcf_available_memory_mb
+
+  gcf_backfill_timeout_seconds = var.gcf_backfill_timeout_seconds
+
   input-bucket       = module.storage.gcs_input
   annotations-bucket = module.storage.gcs_annotations
 
@@ -103,14 +103,18 @@ resource "google_cloudfunctions2_function" "annotate_http" {
   }
 
   service_config {
-    max_instance_count = var.gcf_max_instance_count
-    timeout_seconds    = var.gcf_timeout_seconds
-    available_memory   = "256M"
+    max_instance_count               = var.gcf_max_instance_count
+    max_instance_request_concurrency = var.gcf_max_instance_request_concurrency
+    available_cpu                    = var.gcf_available_cpu
+    timeout_seconds                  = var.gcf_timeout_seconds
+    available_memory                 = "${var.gcf_available_memory_mb}M"
     environment_variables = {
-      INPUT_BUCKET       = var.input-bucket
-      ANNOTATIONS_BUCKET = var.annotations-bucket
-      FEATURES           = var.gcf_annotation_features
-      LOG_LEVEL          = var.gcf_log_level
+      INPUT_BUCKET         = var.input-bucket
+      ANNOTATIONS_BUCKET   = var.annotations-bucket
+      FEATURES             = var.gcf_annotation_features
+      LOG_LEVEL            = var.gcf_log_level
+      FUNCTION_TIMEOUT_SEC = var.gcf_timeout_seconds
+      MEMORY_LIMIT_MB      = var.gcf_available_memory_mb
     }
     ingress_settings               = var.gcf_http_ingress_types_list[var.gcf_http_ingress_type_index]
     all_traffic_on_latest_revision = true
@@ -131,6 +135,47 @@ resource "google_cloud_run_service_iam_binding" "annotate_http" {
   members  = var.gcr_invoker_members
 }
 
+# ------- Backfill function, annotates images already stored in the input bucket -----------
+
+
+resource "google_cloudfunctions2_function" "annotate_backfill" {
+  name        = "annotate-backfill"
+  labels      = var.labels
+  location    = var.gcf_location
+  description = "Vision API Image Annotate of the input bucket content, authenticated"
+  depends_on = [
+    google_storage_bucket_object.gcf_code,
+    time_sleep.some_time_after_gcf_sa_roles,
+  ]
+  build_config {
+    runtime     = "python311"
+    entry_point = "annotate_backfill"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.code_bucket.name
+        object = google_storage_bucket_object.gcf_code.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count = 1 # invocations share the checkpoint in the annotations bucket
+    timeout_seconds    = var.gcf_backfill_timeout_seconds
+    available_memory   = "${var.gcf_available_memory_mb}M"
+    environment_variables = {
+      INPUT_BUCKET         = var.input-bucket
+      ANNOTATIONS_BUCKET   = var.annotations-bucket
+      FEATURES             = var.gcf_annotation_features
+      LOG_LEVEL            = var.gcf_log_level
+      FUNCTION_TIMEOUT_SEC = var.gcf_backfill_timeout_seconds
+    }
+    # no IAM binding for allUsers, callers need roles/run.invoker
+    ingress_settings               = "ALLOW_ALL"
+    all_traffic_on_latest_revision = true
+    service_account_email          = google_service_account.gcf_sa.email
+  }
+}
+
 
 # ------- GCS function -----------
 
@@ -175,14 +220,18 @@ resource "google_cloudfunctions2_function" "annotate_gcs" {
   }
 
   service_config {
-    max_instance_count = var.gcf_max_instance_count
-    timeout_seconds    = var.gcf_timeout_seconds
-    available_memory   = "256M"
+    max_instance_count               = var.gcf_max_instance_count
+    max_instance_request_concurrency = var.gcf_max_instance_request_concurrency
+    available_cpu                    = var.gcf_available_cpu
+    timeout_seconds                  = var.gcf_timeout_seconds
+    available_memory                 = "${var.gcf_available_memory_mb}M"
     environment_variables = {
-      INPUT_BUCKET       = var.input-bucket
-      ANNOTATIONS_BUCKET = var.annotations-bucket
-      FEATURES           = var.gcf_annotation_features
-      LOG_LEVEL          = var.gcf_log_level
+      INPUT_BUCKET         = var.input-bucket
+      ANNOTATIONS_BUCKET   = var.annotations-bucket
+      FEATURES             = var.gcf_annotation_features
+      LOG_LEVEL            = var.gcf_log_level
+      FUNCTION_TIMEOUT_SEC = var.gcf_timeout_seconds
+      MEMORY_LIMIT_MB      = var.gcf_available_memory_mb
     }
     ingress_settings               = "ALLOW_INTERNAL_ONLY"
     all_traffic_on_latest_revision = true
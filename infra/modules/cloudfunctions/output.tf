@@ -24,6 +24,11 @@ output "function_uri" {
   ]
 }
 
+output "backfill_uri" {
+  description = "URI of the Cloud Function annotating images already stored in the input bucket."
+  value       = google_cloudfunctions2_function.annotate_backfill.service_config[0].uri
+}
+
 output "annotate_gcs_function_name" {
   description = "The name of the Cloud Function that annotates an image triggered by a GCS event."
   value       = google_cloudfunctions2_function.annotate_gcs.name
@@ -19,6 +19,11 @@ output "vision_prediction_url" {
   value       = module.cloudfunctions.function_uri
 }
 
+output "vision_backfill_url" {
+  description = "The URL for annotating images already stored in the input bucket, requires authentication."
+  value       = module.cloudfunctions.backfill_uri
+}
+
 output "vision_input_gcs" {
   description = "Input GCS bucket name."
   value       = "gs://${module.storage.gcs_input}"
@@ -53,6 +53,30 @@ variable "gcf_timeout_seconds" {
   default     = 120
 }
 
+variable "gcf_max_instance_request_concurrency" {
+  type        = number
+  description = "MAX number of concurrent requests served by one GCF instance, more than 1 requires at least 1 CPU."
+  default     = 8
+}
+
+variable "gcf_available_cpu" {
+  type        = string
+  description = "Number of CPUs of a GCF instance."
+  default     = "1"
+}
+
+variable "gcf_available_memory_mb" {
+  type        = number
+  description = "Memory of a GCF instance in MB, shared by its concurrent requests."
+  default     = 1024
+}
+
+variable "gcf_backfill_timeout_seconds" {
+  type        = number
+  description = "Backfill GCF execution timeout, at most 3600."
+  default     = 1800
+}
+
 variable "gcf_http_ingress_type_index" {
   type        = number
   description = "Ingres type index."
@@ -0,0 +1,102 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control of concurrent requests by their estimated memory use."""
+
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+
+class AdmissionRejected(Exception):
+    """The request couldn't reserve its memory before the timeout."""
+
+
+class MemoryAdmission:
+    """Thread-safe budget of memory reserved by the requests an instance serves.
+
+    A request reserves its estimated memory use before it starts and releases it
+    when it finishes. Requests which don't fit into the budget wait for others
+    to finish, in the order of arrival. A request larger than the whole budget
+    is admitted only when no other request runs.
+
+    Args:
+        budget: bytes available to the requests
+        clock: time source, for tests
+    """
+
+    def __init__(self, budget: int, clock: Callable[[], float] = time.monotonic):
+        self.budget = budget
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._reserved = 0
+        self._running = 0
+        # tickets of the waiting requests, the first one is admitted next
+        self._queue: list = []
+        self._counters = {"admitted": 0, "rejected": 0, "waited": 0, "peak": 0}
+
+    def _fits(self, size: int) -> bool:
+        return self._running == 0 or self._reserved + size <= self.budget
+
+    @contextlib.contextmanager
+    def reserve(self, size: int, timeout: Optional[float] = None) -> Iterator[None]:
+        """Runs the enclosed code with <size> bytes reserved.
+
+        Raises:
+            AdmissionRejected: the memory wasn't available within <timeout> seconds.
+        """
+        with self._condition:
+            if self._queue or not self._fits(size):
+                self._wait(size, timeout)
+            self._reserved += size
+            self._running += 1
+            self._counters["admitted"] += 1
+            self._counters["peak"] = max(self._counters["peak"], self._reserved)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= size
+                self._running -= 1
+                self._condition.notify_all()
+
+    def _wait(self, size: int, timeout: Optional[float]) -> None:
+        ticket = object()
+        self._queue.append(ticket)
+        self._counters["waited"] += 1
+        deadline = None if timeout is None else self._clock() + timeout
+        try:
+            while self._queue[0] is not ticket or not self._fits(size):
+                remaining = None if deadline is None else deadline - self._clock()
+                if remaining is not None and remaining <= 0:
+                    self._counters["rejected"] += 1
+                    raise AdmissionRejected(
+                        f"{size} bytes not available, {self._reserved} reserved"
+                    )
+                self._condition.wait(remaining)
+        finally:
+            self._queue.remove(ticket)
+            # the next request in the queue may fit now
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns admission counters, reserved bytes and number of running requests."""
+        with self._condition:
+            return dict(
+                self._counters,
+                reserved=self._reserved,
+                running=self._running,
+                budget=self.budget,
+            )
@@ -0,0 +1,106 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed cache of annotation results."""
+
+import collections
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class AnnotationCache:
+    """Thread-safe LRU cache of annotation JSON strings, with an optional backing store.
+
+    The in-memory tier evicts least recently used entries when it holds more than
+    <max_entries> entries or <max_bytes> bytes, and expires entries older than <ttl>
+    seconds. On a memory miss the backing store (any object with get(key) and
+    put(key, value) methods) is consulted and its hits are promoted into memory.
+
+    Args:
+        max_entries: max. number of entries kept in memory
+        max_bytes: max. total size of values kept in memory
+        ttl: time to live of in-memory entries in seconds, 0 means no expiration
+        store: optional persistent tier
+        clock: time source, for tests
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttl: float = 3600.0,
+        store=None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.store = store
+        self._clock = clock
+        self._entries: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            "memory_hits": 0,
+            "store_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns cached value or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if self.ttl and self._clock() - created > self.ttl:
+                    self._remove(key)
+                else:
+                    self._entries.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return value
+        value = self.store.get(key) if self.store else None
+        with self._lock:
+            self._counters["store_hits" if value else "misses"] += 1
+        if value:
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        """Stores value in memory and in the backing store."""
+        self._put_memory(key, value)
+        if self.store:
+            self.store.put(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit/miss counters and current size of the in-memory tier."""
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._size)
+
+    def _put_memory(self, key: str, value: str) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, self._clock())
+            self._size += len(value)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._counters["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self._size -= len(value)
@@ -0,0 +1,80 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares annotation throughput of /annotate per image and /annotate/batch.
+
+Vision API is replaced by a stub adding a fixed latency to every RPC, so the
+results show the effect of batching and parallelism rather than Vision speed.
+"""
+
+import argparse
+import os
+import time
+from unittest.mock import patch
+
+import flask
+
+from benchmarks.common import emit, import_main
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient
+
+
+def post(main, path: str, **kwargs) -> float:
+    app = flask.Flask(__name__)
+    with app.test_request_context(path, method="POST", **kwargs):
+        started = time.perf_counter()
+        response = main.annotate_http(flask.request)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.status_code
+    return elapsed
+
+
+def run(num_images: int, latency: float, parallelism: list) -> dict:
+    main = import_main()
+    main.reset_instance_state()
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(latency=latency)
+    names = [f"{i:06d}.jpg" for i in range(num_images)]
+    for name in names:
+        # distinct content, so that the annotation cache isn't hit
+        storage_client.put("in", name, name.encode())
+    uris = [f"gs://in/{name}" for name in names]
+    results = {"images": num_images, "latency": latency}
+    with patch("google.cloud.storage.Client", lambda: storage_client), patch(
+        "google.cloud.vision.ImageAnnotatorClient", lambda: vision_client
+    ):
+        elapsed = sum(post(main, "/annotate", data={"image_uri": uri}) for uri in uris)
+        results["single_images_per_sec"] = num_images / elapsed
+        for workers in parallelism:
+            os.environ["ANNOTATE_BATCH_PARALLELISM"] = str(workers)
+            elapsed = post(main, "/annotate/batch", json={"image_uri": uris})
+            results[f"batch_p{workers}_images_per_sec"] = num_images / elapsed
+            elapsed = post(
+                main, "/annotate/batch?format=ndjson", json={"image_uri": uris}
+            )
+            results[f"ndjson_p{workers}_images_per_sec"] = num_images / elapsed
+    results["vision_rpcs"] = dict(vision_client.counters)
+    main.reset_instance_state()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=512)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Vision RPC latency in seconds"
+    )
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+    emit("annotate_batch", run(args.images, args.latency, args.parallelism))
@@ -0,0 +1,75 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counts GCS and Vision client constructions per 1,000 requests.
+
+Clients are replaced by local stubs, so no network access is needed.
+"""
+
+import argparse
+import time
+from unittest.mock import MagicMock, patch
+
+from google.cloud import vision
+
+from benchmarks.common import emit, import_main
+
+
+class StubVisionClient:
+    """Vision client stub returning an empty annotation."""
+
+    def annotate_image(self, request, timeout=None):
+        return vision.AnnotateImageResponse()
+
+
+class CountingFactory:
+    """Client class stub, counting how many clients were built."""
+
+    def __init__(self, client_class=MagicMock):
+        self.client_class = client_class
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self.client_class()
+
+
+def run(num_requests: int) -> dict:
+    main = import_main()
+    main.reset_clients()
+    storage_factory = CountingFactory()
+    vision_factory = CountingFactory(StubVisionClient)
+    with patch("google.cloud.storage.Client", storage_factory), patch(
+        "google.cloud.vision.ImageAnnotatorClient", vision_factory
+    ):
+        started = time.perf_counter()
+        for i in range(num_requests):
+            main.annotate_image_uri(f"gs://bucket/image-{i}.jpg", [])
+            main.read_json_str("bucket", f"image-{i}.jpg.json")
+        elapsed = time.perf_counter() - started
+    main.reset_clients()
+    return {
+        "requests": num_requests,
+        "storage_clients": storage_factory.count,
+        "vision_clients": vision_factory.count,
+        "storage_clients_per_1000": storage_factory.count * 1000 / num_requests,
+        "vision_clients_per_1000": vision_factory.count * 1000 / num_requests,
+        "elapsed_sec": elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000)
+    emit("clients", run(parser.parse_args().requests))
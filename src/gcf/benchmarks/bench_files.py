@@ -0,0 +1,116 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures annotation of multi-page files by annotate_gcs: time and peak memory.
+
+Every page gets a detected text of <page-text-kb> KB, like a dense document page
+with DOCUMENT_TEXT_DETECTION. Every measurement runs in a separate process,
+peak RSS is measured on Linux by resetting the high water mark before the event.
+The fake bucket keeps the written annotations in the process, working_mb is
+the peak RSS growth without them.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+from google.cloud import vision
+
+from benchmarks.common import emit, import_main, reset_peak_rss, rss_status
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+MB = 1024 * 1024
+
+
+class DocumentVisionClient(FakeVisionClient):
+    """Fake Vision client returning <text_kb> KB of text for every page."""
+
+    def __init__(self, storage_client, latency: float, text_kb: int):
+        super().__init__(storage_client, latency)
+        self.text = " ".join(["lorem"] * (text_kb * 1024 // 6))
+
+    def _annotate_file(self, request):
+        response = super()._annotate_file(request)
+        for page_response in response.responses:
+            page_response.text_annotations.append(
+                vision.EntityAnnotation(description=self.text)
+            )
+        return response
+
+
+def measure(pages: int, parallelism: int, args) -> dict:
+    main = import_main()
+    os.environ["ANNOTATIONS_BUCKET"] = "out"
+    os.environ["FEATURES"] = "DOCUMENT_TEXT_DETECTION"
+    os.environ["FILE_PARALLELISM"] = str(parallelism)
+    os.environ["FUNCTION_TIMEOUT_SEC"] = "3600"
+    storage_client = FakeStorageClient()
+    vision_client = DocumentVisionClient(
+        storage_client, args.vision_latency, args.page_text_kb
+    )
+    storage_client.put(
+        "in",
+        "doc.pdf",
+        b"\f".join(b"page %d" % page for page in range(pages)),
+        content_type="application/pdf",
+    )
+    with patch("google.cloud.storage.Client", lambda: storage_client), patch(
+        "google.cloud.vision.ImageAnnotatorClient", lambda: vision_client
+    ):
+        main.get_storage_client()
+        main.get_vision_client()
+        rss_before = rss_status("VmRSS")
+        peak_reset = reset_peak_rss()
+        started = time.perf_counter()
+        main.annotate_gcs(finalized_event("in", "doc.pdf"))
+        elapsed = time.perf_counter() - started
+        peak = rss_status("VmHWM")
+    output_mb = sum(blob.size for blob in storage_client.bucket("out")._blobs.values())
+    return {
+        "pages": pages,
+        "parallelism": parallelism,
+        "vision_latency": args.vision_latency,
+        "vision_calls": vision_client.counters["files"],
+        "output_mb": output_mb / MB,
+        "peak_rss_delta_mb": (peak - rss_before) / MB if peak_reset else None,
+        "working_mb": (peak - rss_before - output_mb) / MB if peak_reset else None,
+        "elapsed_sec": elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 500])
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--page-text-kb", type=int, default=64)
+    parser.add_argument(
+        "--vision-latency", type=float, default=0.1, help="seconds per Vision call"
+    )
+    parser.add_argument("--child", nargs=2, type=int, metavar=("PAGES", "PARALLELISM"))
+    args = parser.parse_args()
+    if args.child:
+        emit("files", measure(args.child[0], args.child[1], args))
+    else:
+        for pages in args.pages:
+            for parallelism in args.parallelism:
+                subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_files"]
+                    + ["--child", str(pages), str(parallelism)]
+                    + ["--page-text-kb", str(args.page_text_kb)]
+                    + ["--vision-latency", str(args.vision_latency)],
+                    check=True,
+                )
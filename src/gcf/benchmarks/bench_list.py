@@ -0,0 +1,89 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures /bucket/list latency for 10k, 100k and 1M images with a fake GCS.
+
+Half of the images are annotated. Every size is measured with the annotations
+manifest (cold and warm instance cache, first and a deep cursor page) and without
+it, when annotations are found by listing the annotations bucket.
+"""
+
+import argparse
+import os
+import time
+from unittest.mock import patch
+
+import flask
+
+from benchmarks.common import emit, import_main
+from benchmarks.fakes import FakeStorageClient
+
+
+def request(main, path: str):
+    with flask.Flask(__name__).test_request_context(path):
+        started = time.perf_counter()
+        response = main.annotate_http(flask.request)
+        elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.status_code
+    return elapsed, response.headers.get("X-Next-Cursor")
+
+
+def run(num_images: int, page_size: int, latency: float) -> dict:
+    main = import_main()
+    main.reset_instance_state()
+    os.environ["INPUT_BUCKET"] = "in"
+    os.environ["ANNOTATIONS_BUCKET"] = "out"
+    storage_client = FakeStorageClient()
+    names = [f"images/{i:08d}.jpg" for i in range(num_images)]
+    storage_client.put_many("in", names, b"image")
+    storage_client.put_many("out", [n + ".json" for n in names[::2]], b"{}")
+    # sort names of the fake buckets in advance
+    storage_client.bucket("in").names()
+    storage_client.bucket("out").names()
+    results = {"images": num_images, "page_size": page_size, "latency": latency}
+    with patch("google.cloud.storage.Client", lambda: storage_client):
+        storage_client.latency = latency
+        results["listing_first_page_sec"], _ = request(
+            main, f"/bucket/list?limit={page_size}"
+        )
+        storage_client.latency = 0
+        main.get_manifest("out").write_all(((n, 0) for n in names[::2]), {})
+        main.reset_manifests()
+        storage_client.latency = latency
+        results["manifest_cold_first_page_sec"], _ = request(
+            main, f"/bucket/list?limit={page_size}"
+        )
+        results["manifest_warm_first_page_sec"], _ = request(
+            main, f"/bucket/list?limit={page_size}"
+        )
+        cursor = names[num_images // 2]
+        results["manifest_warm_deep_page_sec"], _ = request(
+            main, f"/bucket/list?limit={page_size}&cursor={cursor}"
+        )
+    main.reset_instance_state()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="GCS latency in seconds"
+    )
+    args = parser.parse_args()
+    for size in args.sizes:
+        emit("list", run(size, args.page_size, args.latency))
@@ -0,0 +1,185 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test of the HTTP and GCS-triggered functions with fake Vision and GCS backends.
+
+Every scenario sends <requests> requests from <concurrency> threads and prints
+a JSON line with latency percentiles (p50/p95/p99, seconds), throughput
+(requests per second), failed requests, Vision API calls and peak RSS growth
+of the process.
+Save the output of two runs to compare them, e.g.:
+    python -m benchmarks.bench_load --latency 0.02 > before.jsonl
+
+Scenarios:
+    annotate_gcs: finalized events of new images.
+    annotate: GET /annotate?image_uri=gs://... of stored images.
+    annotate_hot: GET /annotate?image_uri=gs://... of <hot-images> popular images,
+        concurrent requests of one image share a Vision call.
+    bucket_list: GET /bucket/list pages with embedded annotations.
+    bucket_imagedata: GET /bucket/imagedata/<name> of stored images.
+    bucket_thumbnail: GET /bucket/imagedata/<name>?size=256 of stored JPEG images,
+        thumbnails are made on the first request of an image.
+"""
+
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import flask
+from PIL import Image
+
+from benchmarks.common import emit, import_main, percentiles, reset_peak_rss, rss_status
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+MB = 1024 * 1024
+SCENARIOS = [
+    "annotate_gcs",
+    "annotate",
+    "annotate_hot",
+    "bucket_list",
+    "bucket_imagedata",
+    "bucket_thumbnail",
+]
+
+
+def photo(size_kb: int) -> bytes:
+    """Returns JPEG of about <size_kb> KB."""
+    width = int((size_kb * 1024 * 4 / 3) ** 0.5)
+    output = io.BytesIO()
+    Image.effect_noise((width, width * 3 // 4), 32).convert("RGB").save(
+        output, format="JPEG", quality=95
+    )
+    return output.getvalue()
+
+
+def http_get(main, path: str) -> bool:
+    with flask.Flask(__name__).test_request_context(path):
+        response = main.annotate_http(flask.request)
+        # streamed responses are read like the server sends them
+        for _ in response.response:
+            pass
+        return response.status_code == 200
+
+
+def scenario_call(main, scenario: str, names, args):
+    """Returns function sending i-th request of the scenario, it returns True on success."""
+    page_size = args.page_size
+    if scenario == "annotate_gcs":
+        return lambda i: main.annotate_gcs(
+            finalized_event("in", f"new/{i:08d}.jpg", event_id=str(i))
+        ) in (None, "")
+    if scenario == "annotate":
+        return lambda i: http_get(
+            main, f"/annotate?image_uri=gs://in/{names[i % len(names)]}"
+        )
+    if scenario == "annotate_hot":
+        return lambda i: http_get(
+            main, f"/annotate?image_uri=gs://in/{names[i % args.hot_images]}"
+        )
+    if scenario == "bucket_list":
+        return lambda i: http_get(
+            main,
+            f"/bucket/list?limit={page_size}&embed={page_size}"
+            f"&cursor={names[i * page_size % len(names)]}",
+        )
+    if scenario == "bucket_thumbnail":
+        return lambda i: http_get(
+            main, f"/bucket/imagedata/{names[i % len(names)]}?size=256"
+        )
+    return lambda i: http_get(main, f"/bucket/imagedata/{names[i % len(names)]}")
+
+
+def run(scenario: str, args) -> dict:
+    main = import_main()
+    main.reset_instance_state()
+    os.environ["INPUT_BUCKET"] = "in"
+    os.environ["ANNOTATIONS_BUCKET"] = "out"
+    os.environ.setdefault("FEATURES", "LABEL_DETECTION")
+    # identical test images would be annotated once with the cache
+    os.environ.setdefault("ANNOTATION_CACHE", "none")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    names = [f"{i:08d}.jpg" for i in range(args.images)]
+    if scenario == "bucket_thumbnail":
+        storage_client.put_many("in", names, photo(args.image_kb))
+    else:
+        storage_client.put_many("in", names, os.urandom(args.image_kb * 1024))
+    storage_client.put_many("out", [n + ".json" for n in names[::2]], b'{"a": 1}')
+    if scenario == "annotate_gcs":
+        storage_client.put_many(
+            "in",
+            [f"new/{i:08d}.jpg" for i in range(args.requests)],
+            os.urandom(args.image_kb * 1024),
+        )
+    storage_client.latency = args.latency
+    vision_client.latency = args.vision_latency
+    call = scenario_call(main, scenario, names, args)
+    latencies = []
+
+    def timed(i: int) -> bool:
+        started = time.perf_counter()
+        try:
+            return call(i)
+        except Exception:
+            return False
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    with patch("google.cloud.storage.Client", lambda: storage_client), patch(
+        "google.cloud.vision.ImageAnnotatorClient", lambda: vision_client
+    ):
+        rss_before = rss_status("VmRSS")
+        peak_reset = reset_peak_rss()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            succeeded = sum(executor.map(timed, range(args.requests)))
+        elapsed = time.perf_counter() - started
+        peak = rss_status("VmHWM")
+    main.reset_instance_state()
+    return {
+        "scenario": scenario,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "latency": args.latency,
+        "vision_latency": args.vision_latency,
+        **percentiles(latencies),
+        "throughput_rps": args.requests / elapsed,
+        "failed": args.requests - succeeded,
+        "vision_calls": vision_client.counters["annotate"]
+        + vision_client.counters["batch"],
+        "peak_rss_delta_mb": (peak - rss_before) / MB if peak_reset else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--images", type=int, default=2000)
+    parser.add_argument("--image-kb", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--hot-images", type=int, default=4)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="GCS latency in seconds"
+    )
+    parser.add_argument(
+        "--vision-latency", type=float, default=0.0, help="Vision latency in seconds"
+    )
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        emit("load", run(scenario, args))
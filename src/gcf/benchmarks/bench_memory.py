@@ -0,0 +1,85 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures peak memory of a single annotate_gcs request for 1, 10 and 40 MB images.
+
+Every measurement runs in a separate process. Peak RSS is measured on Linux by
+resetting the high water mark (/proc/self/clear_refs) before the request.
+
+Modes:
+    gcs_uri: annotate_gcs event, Vision reads the image from GCS.
+    gcs_download: image is downloaded by read_vision_image_from_gcs and sent as bytes.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+from benchmarks.common import emit, import_main, reset_peak_rss, rss_status
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+MB = 1024 * 1024
+MODES = ["gcs_uri", "gcs_download"]
+
+
+def measure(size: int, mode: str) -> dict:
+    main = import_main()
+    os.environ["ANNOTATIONS_BUCKET"] = "out"
+    os.environ["ANNOTATION_CACHE"] = "none"
+    os.environ["MAX_IMAGE_SIZE"] = str(64 * MB)
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    storage_client.put("in", "image.jpg", os.urandom(size))
+    event = finalized_event("in", "image.jpg", size=str(size))
+    with patch("google.cloud.storage.Client", lambda: storage_client), patch(
+        "google.cloud.vision.ImageAnnotatorClient", lambda: vision_client
+    ):
+        main.get_storage_client()
+        main.get_vision_client()
+        rss_before = rss_status("VmRSS")
+        peak_reset = reset_peak_rss()
+        started = time.perf_counter()
+        if mode == "gcs_uri":
+            main.annotate_gcs(event)
+        else:
+            vision_image = main.read_vision_image_from_gcs("in", "image.jpg")
+            main.annotate_image(vision_image, [])
+        elapsed = time.perf_counter() - started
+        peak = rss_status("VmHWM")
+    return {
+        "mode": mode,
+        "image_mb": size / MB,
+        "peak_rss_delta_mb": (peak - rss_before) / MB if peak_reset else None,
+        "elapsed_sec": elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 40])
+    parser.add_argument("--child", nargs=2, metavar=("SIZE_MB", "MODE"))
+    args = parser.parse_args()
+    if args.child:
+        emit("memory", measure(int(args.child[0]) * MB, args.child[1]))
+    else:
+        for size_mb in args.sizes:
+            for mode in MODES:
+                subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_memory"]
+                    + ["--child", str(size_mb), mode],
+                    check=True,
+                )
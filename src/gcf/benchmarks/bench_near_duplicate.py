@@ -0,0 +1,123 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures hit rate and latency of the near-duplicate lookup.
+
+Resized and re-encoded copies of synthetic pictures are looked up among the
+hashes of the originals and of <hashes> random hashes, with the multi-index
+hash table and with a linear scan. Different pictures found as duplicates count as false hits.
+"""
+
+import argparse
+import io
+import random
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from benchmarks.common import emit, percentiles
+from near_duplicates import MultiIndexHash, hamming_distance, perceptual_hash
+
+
+def picture(rng: random.Random, size=(1600, 1200)) -> Image.Image:
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse(
+            [x, y, x + rng.randrange(100, 800), y + rng.randrange(100, 600)],
+            fill=tuple(rng.randrange(256) for _ in range(3)),
+        )
+    return image.filter(ImageFilter.GaussianBlur(rng.randrange(2, 40)))
+
+
+def encode(image: Image.Image, scale: float, quality: int) -> bytes:
+    if scale != 1:
+        image = image.resize((int(image.width * scale), int(image.height * scale)))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def run(num_pictures: int, num_hashes: int, max_distance: int) -> dict:
+    rng = random.Random(0)
+    index = MultiIndexHash(max_distance)
+    hashes = {}
+    for position in range(num_hashes):
+        value = rng.getrandbits(64)
+        index.add(value, f"random-{position}")
+        hashes[f"random-{position}"] = value
+    hash_times = []
+    copies = []
+    for position in range(num_pictures):
+        image = picture(rng)
+        content = encode(image, 1, 90)
+        started = time.perf_counter()
+        image_hash = perceptual_hash(content)
+        hash_times.append(time.perf_counter() - started)
+        index.add(image_hash.value, f"picture-{position}")
+        hashes[f"picture-{position}"] = image_hash.value
+        copy = encode(image, rng.choice((0.25, 0.5, 0.75)), rng.randrange(30, 95))
+        copies.append((f"picture-{position}", perceptual_hash(copy).value))
+    # pictures not in the index must not be found
+    strangers = [
+        perceptual_hash(encode(picture(rng), 0.5, 80)).value
+        for _ in range(num_pictures)
+    ]
+    index_times, scan_times = [], []
+    hits = false_hits = 0
+    for expected, value in copies + [(None, value) for value in strangers]:
+        started = time.perf_counter()
+        found = [
+            (distance, name)
+            for distance, _, names in index.search(value)
+            for name in names
+        ]
+        index_times.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        scanned = [
+            name
+            for name, other in hashes.items()
+            if hamming_distance(value, other) <= max_distance
+        ]
+        scan_times.append(time.perf_counter() - started)
+        assert len(scanned) == len(found)
+        closest = min(found)[1] if found else None
+        if expected and closest == expected:
+            hits += 1
+        elif closest:
+            false_hits += 1
+    return {
+        "pictures": num_pictures,
+        "hashes": len(hashes),
+        "max_distance": max_distance,
+        "hit_rate": hits / num_pictures,
+        "false_hit_rate": false_hits / (2 * num_pictures),
+        "hash_sec": percentiles(hash_times),
+        "index_lookup_sec": percentiles(index_times),
+        "linear_lookup_sec": percentiles(scan_times),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pictures", type=int, default=100)
+    parser.add_argument(
+        "--hashes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--max-distance", type=int, nargs="+", default=[4, 6, 8])
+    args = parser.parse_args()
+    for num_hashes in args.hashes:
+        for max_distance in args.max_distance:
+            emit("near_duplicates", run(args.pictures, num_hashes, max_distance))
@@ -0,0 +1,80 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures per-request setup overhead: configuration and feature parsing.
+
+The previous setup, which read the environment and scanned vision.Feature.Type
+for every feature name of every request, is reproduced here for comparison
+with the parsed-once configuration and memoized feature overrides.
+"""
+
+import argparse
+import os
+import timeit
+
+from google.cloud import vision
+
+from benchmarks.common import emit, import_main
+
+FEATURES = "LABEL_DETECTION,TEXT_DETECTION,OBJECT_LOCALIZATION,LANDMARK_DETECTION"
+OVERRIDE = "FACE_DETECTION,SAFE_SEARCH_DETECTION"
+
+
+def previous_setup(features_http=None):
+    def build(feature_names):
+        features_list = []
+        for name in feature_names.split(","):
+            name = name.upper().strip('"').strip()
+            for feature in vision.Feature.Type:
+                if feature.name == name:
+                    features_list.append({"type_": feature})
+                    break
+        return features_list
+
+    features_list = build(os.environ.get("FEATURES", ""))
+    if features_http:
+        features_list = build(features_http)
+    return features_list, os.environ.get("ANNOTATIONS_BUCKET")
+
+
+def current_setup(main, features_http=None):
+    features_list = list(main.request_features(features_http).features)
+    return features_list, main.get_config().annotations_bucket
+
+
+def run(number: int) -> dict:
+    main = import_main()
+    main.reset_instance_state()
+    os.environ["FEATURES"] = FEATURES
+    os.environ["ANNOTATIONS_BUCKET"] = "out"
+    assert previous_setup() == current_setup(main)
+    assert previous_setup(OVERRIDE) == current_setup(main, OVERRIDE)
+    cases = {
+        "previous_env_us": lambda: previous_setup(),
+        "previous_override_us": lambda: previous_setup(OVERRIDE),
+        "current_env_us": lambda: current_setup(main),
+        "current_override_us": lambda: current_setup(main, OVERRIDE),
+    }
+    results = {"calls": number}
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=number, repeat=5))
+        results[name] = seconds / number * 1e6
+    main.reset_instance_state()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=10_000)
+    emit("request_setup", run(parser.parse_args().calls))
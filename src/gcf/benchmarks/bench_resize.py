@@ -0,0 +1,98 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures downscaling of camera-sized images before they are sent to Vision.
+
+For every image size (in megapixels, a noisy JPEG like a high ISO photo) and max.
+dimension it reports bytes sent to Vision, time of annotate_image_content with
+a fake Vision client and peak RSS growth. Every measurement runs in a separate
+process. Max. dimension 0 sends the original image.
+"""
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+from PIL import Image
+
+from benchmarks.common import emit, import_main, reset_peak_rss, rss_status
+from benchmarks.fakes import FakeVisionClient
+
+MB = 1024 * 1024
+
+
+def camera_image(megapixels: float) -> bytes:
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    output = io.BytesIO()
+    Image.effect_noise((width, height), 32).convert("RGB").save(
+        output, format="JPEG", quality=95
+    )
+    return output.getvalue()
+
+
+def measure(megapixels: float, max_dimension: int) -> dict:
+    main = import_main()
+    os.environ["ANNOTATION_CACHE"] = "none"
+    image_bin = camera_image(megapixels)
+    vision_client = FakeVisionClient()
+    sent = []
+    annotate = vision_client.annotate_image
+
+    def annotate_image(request, **kwargs):
+        sent.append(len(request.image.content))
+        return annotate(request, **kwargs)
+
+    vision_client.annotate_image = annotate_image
+    features_list = main.build_features_list("LABEL_DETECTION")
+    with patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client):
+        main.get_vision_client()
+        rss_before = rss_status("VmRSS")
+        peak_reset = reset_peak_rss()
+        started = time.perf_counter()
+        main.annotate_image_content(
+            image_bin, features_list, max_dimension=max_dimension or None
+        )
+        elapsed = time.perf_counter() - started
+        peak = rss_status("VmHWM")
+    return {
+        "megapixels": megapixels,
+        "max_dimension": max_dimension,
+        "image_mb": len(image_bin) / MB,
+        "sent_mb": sent[0] / MB,
+        "elapsed_sec": elapsed,
+        "peak_rss_delta_mb": (peak - rss_before) / MB if peak_reset else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[12, 24, 48])
+    parser.add_argument("--max-dimensions", type=int, nargs="+", default=[0, 640, 2048])
+    parser.add_argument("--child", nargs=2, metavar=("MEGAPIXELS", "MAX_DIMENSION"))
+    args = parser.parse_args()
+    if args.child:
+        emit("resize", measure(float(args.child[0]), int(args.child[1])))
+    else:
+        for megapixels in args.megapixels:
+            for max_dimension in args.max_dimensions:
+                subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_resize"]
+                    + ["--child", str(megapixels), str(max_dimension)],
+                    check=True,
+                )
@@ -0,0 +1,122 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures /bucket/search latency over 1M indexed images with a fake GCS.
+
+Every image gets labels, an object and words of detected text drawn from
+Zipf-like vocabularies, so some terms match a large part of the images and
+others only a few. The index is built directly by SearchIndex.rebuild().
+Queries are measured on a cold instance (shards read from GCS) and a warm one,
+incremental updates as annotate_gcs makes them.
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from unittest.mock import patch
+
+import flask
+
+from benchmarks.common import emit, import_main, percentiles
+from benchmarks.fakes import FakeStorageClient
+
+QUERIES = {
+    "common_label": "label:label0",
+    "rare_label": "label:label900",
+    "any_namespace": "word3",
+    "two_words": "label0 word1",
+}
+
+
+def zipf_choice(rng: random.Random, prefix: str, size: int) -> str:
+    return f"{prefix}{min(size - 1, int(rng.paretovariate(1.0)) - 1)}"
+
+
+def image_terms(rng: random.Random) -> dict:
+    terms = {}
+    for _ in range(3):
+        terms["label:" + zipf_choice(rng, "label", 1000)] = rng.randint(5, 10)
+    terms["object:" + zipf_choice(rng, "object", 100)] = rng.randint(5, 10)
+    for _ in range(4):
+        terms["text:" + zipf_choice(rng, "word", 10000)] = 10
+    return terms
+
+
+def request(main, query: str) -> float:
+    with flask.Flask(__name__).test_request_context(
+        "/bucket/search", query_string={"q": query, "limit": "50"}
+    ):
+        started = time.perf_counter()
+        response = main.annotate_http(flask.request)
+        elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.status_code
+    json.loads(response.get_data())
+    return elapsed
+
+
+def run(num_images: int, shards: int, latency: float, repeat: int) -> dict:
+    main = import_main()
+    main.reset_instance_state()
+    os.environ["INPUT_BUCKET"] = "in"
+    os.environ["ANNOTATIONS_BUCKET"] = "out"
+    os.environ["SEARCH_INDEX_SHARDS"] = str(shards)
+    os.environ.setdefault("ANNOTATION_CACHE", "none")
+    storage_client = FakeStorageClient()
+    rng = random.Random(0)
+    results = {"images": num_images, "shards": shards, "latency": latency}
+    with patch("google.cloud.storage.Client", lambda: storage_client):
+        index = main.get_search_index("out")
+        started = time.perf_counter()
+        index.rebuild(
+            ((f"images/{i:08d}.jpg", image_terms(rng)) for i in range(num_images)),
+            {},
+        )
+        results["rebuild_sec"] = time.perf_counter() - started
+        results["index_mb"] = (
+            sum(
+                len(blob._data)
+                for name, blob in storage_client.bucket("out")._blobs.items()
+                if name.startswith(main.SEARCH_TERMS_PREFIX)
+            )
+            / 1e6
+        )
+        storage_client.latency = latency
+        for name, query in QUERIES.items():
+            main.reset_search_indexes()
+            results[f"{name}_cold_sec"] = request(main, query)
+            results[f"{name}_warm"] = percentiles(
+                [request(main, query) for _ in range(repeat)]
+            )
+        updates = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            index.update(f"images/{i:08d}.jpg", image_terms(rng))
+            updates.append(time.perf_counter() - started)
+        results["update"] = percentiles(updates)
+    main.reset_instance_state()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=1_000_000)
+    parser.add_argument("--shards", type=int, default=256)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="GCS latency in seconds"
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    emit("search", run(args.images, args.shards, args.latency, args.repeat))
@@ -0,0 +1,128 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures cold start: import time of main and time to the first response.
+
+Every measurement runs in a fresh interpreter. functions_framework is imported
+before the clock starts, as the Functions runtime loads it before the function
+code. GCS and Vision are fakes, which need google.cloud.vision and storage
+themselves, so the modules main would import lazily are imported and timed
+explicitly before the fakes are built.
+
+The "eager_imports_ms" result is the import time of the modules main used to
+load at import (Cloud Logging, Vision, Storage), without creating a logging client.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.common import emit
+
+CHILD = r"""
+import importlib, json, os, sys, time
+from unittest.mock import patch
+import functions_framework
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+lazy_started = time.perf_counter()
+for name in sys.argv[2:]:
+    importlib.import_module(name)
+lazy_ms = (time.perf_counter() - lazy_started) * 1000
+
+import flask
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+storage_client = FakeStorageClient()
+storage_client.put("in", "image.jpg", b"image")
+vision_client = FakeVisionClient()
+os.environ.update(INPUT_BUCKET="in", ANNOTATIONS_BUCKET="out")
+with patch("google.cloud.storage.Client", lambda: storage_client), patch(
+    "google.cloud.vision.ImageAnnotatorClient", lambda: vision_client
+):
+    timings = []
+    for _ in range(2):
+        call_started = time.perf_counter()
+        if sys.argv[1] == "http":
+            with flask.Flask("bench").test_request_context("/bucket/list"):
+                assert main.annotate_http(flask.request).status_code == 200
+        else:
+            main.annotate_gcs(finalized_event("in", "image.jpg"))
+        timings.append((time.perf_counter() - call_started) * 1000)
+import_ms = (imported - started) * 1000
+print(json.dumps({
+    "import_ms": import_ms,
+    "lazy_imports_ms": lazy_ms,
+    "first_call_ms": timings[0],
+    "warm_call_ms": timings[1],
+    "time_to_first_response_ms": import_ms + lazy_ms + timings[0],
+}))
+"""
+
+EAGER = r"""
+import time
+import functions_framework
+started = time.perf_counter()
+from google.cloud import logging, storage, vision
+print((time.perf_counter() - started) * 1000)
+"""
+
+# modules loaded on first use by each entry point
+LAZY_MODULES = {
+    "http": ["google.api_core.exceptions", "google.cloud.storage"],
+    "gcs": [
+        "google.api_core.exceptions",
+        "google.cloud.storage",
+        "google.cloud.vision",
+    ],
+}
+
+
+def child(args: list) -> str:
+    env = {k: v for k, v in os.environ.items() if k != "LOG_LEVEL"}
+    return subprocess.run(
+        [sys.executable, "-c", *args],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+
+
+def run(entry_point: str, repeat: int) -> dict:
+    samples = [
+        json.loads(child([CHILD, entry_point, *LAZY_MODULES[entry_point]]))
+        for _ in range(repeat)
+    ]
+    results = {"entry_point": entry_point, "repeat": repeat}
+    for key in samples[0]:
+        results[key] = statistics.median(sample[key] for sample in samples)
+    results["eager_imports_ms"] = statistics.median(
+        float(child([EAGER])) for _ in range(repeat)
+    )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for entry_point in ("http", "gcs"):
+        emit("startup", run(entry_point, args.repeat))
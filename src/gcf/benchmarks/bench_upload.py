@@ -0,0 +1,102 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures latency and peak memory of image uploads to /annotate.
+
+Vision API is stubbed out, the benchmark covers reading and decoding of
+the request only. The image is sent base64 encoded in a form and in JSON,
+as a multipart file and as a raw request body.
+"""
+
+import argparse
+import base64
+import io
+import os
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import flask
+
+from benchmarks.common import emit, import_main
+
+
+def payloads(image: bytes) -> dict:
+    image_b64 = base64.b64encode(image).decode()
+    return {
+        "form_b64": lambda: {"data": {"image": image_b64}},
+        "json_b64": lambda: {"json": {"image": image_b64}},
+        "multipart": lambda: {"data": {"image": (io.BytesIO(image), "image.jpg")}},
+        "raw": lambda: {
+            "data": image,
+            "headers": {"Content-Type": "application/octet-stream"},
+        },
+    }
+
+
+def post(main, app, kwargs: dict) -> tuple:
+    with app.test_request_context("/annotate", method="POST", **kwargs):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        response = main.annotate_http(flask.request)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    assert response.status_code == 200, response.status_code
+    return elapsed, peak - before
+
+
+def run(size: int, repeat: int) -> dict:
+    main = import_main()
+    main.reset_instance_state()
+    os.environ["MAX_IMAGE_SIZE"] = str(max(size, main.VISION_IMAGE_SIZE_MAX))
+    os.environ["ANNOTATION_CACHE"] = "none"
+    app = flask.Flask(__name__)
+    image = os.urandom(size)
+    received = []
+
+    def annotate(vision_image, features, image_context=None):
+        received.append(len(vision_image.content))
+        return "{}"
+
+    results = {"image_bytes": size}
+    with patch.object(main, "annotate_image", annotate):
+        tracemalloc.start()
+        for mode, build in payloads(image).items():
+            timings, peaks = [], []
+            for _ in range(repeat):
+                kwargs = build()
+                elapsed, peak = post(main, app, kwargs)
+                timings.append(elapsed)
+                peaks.append(peak)
+            results[f"{mode}_ms"] = min(timings) * 1000
+            results[f"{mode}_peak_bytes"] = max(peaks)
+        tracemalloc.stop()
+    assert set(received) == {size}, received
+    results["vision_content_bytes"] = size
+    # the image was previously passed to Vision as base64 text
+    results["previous_vision_content_bytes"] = len(base64.b64encode(image))
+    main.reset_instance_state()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[256 * 1024, 1024 * 1024, 4 << 20]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for size in args.sizes:
+        emit("upload", run(size, args.repeat))
@@ -0,0 +1,62 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+import sys
+from typing import Dict, List
+from unittest.mock import patch
+
+
+def import_main():
+    """Imports main module without connecting to Cloud Logging."""
+    with patch("google.cloud.logging.Client"):
+        import main
+    return main
+
+
+def emit(name: str, results: dict) -> None:
+    """Prints benchmark results as a single JSON line."""
+    json.dump({"benchmark": name, **results}, sys.stdout)
+    sys.stdout.write("\n")
+
+
+def percentiles(values: List[float], points=(50, 95, 99)) -> Dict[str, float]:
+    """Returns nearest-rank percentiles of the values, e.g. {"p50": ...}."""
+    ordered = sorted(values)
+    if not ordered:
+        return {f"p{point}": None for point in points}
+    return {
+        f"p{point}": ordered[max(0, math.ceil(len(ordered) * point / 100) - 1)]
+        for point in points
+    }
+
+
+def rss_status(field: str) -> int:
+    """Returns memory field from /proc/self/status in bytes."""
+    with open("/proc/self/status") as fp:
+        for line in fp:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak RSS (VmHWM) of the process, returns False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
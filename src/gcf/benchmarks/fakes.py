@@ -0,0 +1,566 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process fakes of the GCS and Vision clients used by main.py.
+
+Used by benchmarks and tests, e.g.:
+    with patch("google.cloud.storage.Client", lambda: storage_client): ...
+"""
+
+import base64
+import bisect
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+import types
+from typing import Dict, Iterable, List, Optional
+
+from cloudevents.http import CloudEvent
+from google.api_core import exceptions
+from google.cloud import vision
+from google.longrunning import operations_pb2
+
+# max. number of pages of a file in a BatchAnnotateFiles request, as in Vision API
+FILE_PAGES_MAX = 5
+
+
+def finalized_event(
+    bucket: str, name: str, event_id: str = "1", **object_metadata
+) -> CloudEvent:
+    """Returns google.cloud.storage.object.v1.finalized CloudEvent for the object."""
+    attributes = {
+        "id": event_id,
+        "type": "google.cloud.storage.object.v1.finalized",
+        "source": f"//storage.googleapis.com/projects/_/buckets/{bucket}",
+    }
+    return CloudEvent(attributes, {"bucket": bucket, "name": name, **object_metadata})
+
+
+class FakeBlob:
+    """Subset of google.cloud.storage.Blob."""
+
+    __slots__ = (
+        "bucket",
+        "name",
+        "_data",
+        "generation",
+        "metageneration",
+        "content_type",
+        "content_encoding",
+        "cache_control",
+        "metadata",
+        "updated",
+        "md5_hash",
+    )
+
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self._data: Optional[bytes] = None
+        self.generation: Optional[int] = None
+        self.metageneration: Optional[int] = None
+        self.content_type: Optional[str] = None
+        self.content_encoding: Optional[str] = None
+        self.cache_control: Optional[str] = None
+        self.metadata: Optional[Dict[str, str]] = None
+        self.updated: Optional[datetime.datetime] = None
+        self.md5_hash: Optional[str] = None
+
+    @property
+    def client(self) -> "FakeStorageClient":
+        return self.bucket.client
+
+    @property
+    def size(self) -> Optional[int]:
+        return None if self._data is None else len(self._data)
+
+    @property
+    def etag(self) -> Optional[str]:
+        return None if self.generation is None else str(self.generation)
+
+    def _stored(self) -> "FakeBlob":
+        self.client._wait()
+        stored = self.bucket._blobs.get(self.name)
+        if stored is None:
+            raise exceptions.NotFound(f"{self.bucket.name}/{self.name}")
+        return stored
+
+    def _copy_from(self, stored: "FakeBlob") -> None:
+        for field in (
+            "_data",
+            "generation",
+            "metageneration",
+            "content_type",
+            "content_encoding",
+            "cache_control",
+            "metadata",
+            "updated",
+            "md5_hash",
+        ):
+            setattr(self, field, getattr(stored, field))
+
+    def exists(self, *args, **kwargs) -> bool:
+        self.client._wait()
+        return self.name in self.bucket._blobs
+
+    def reload(self, *args, **kwargs) -> None:
+        self._copy_from(self._stored())
+
+    def download_as_bytes(self, start=None, end=None, raw_download=False, **kwargs):
+        stored = self._stored()
+        self.client.counters["downloads"] += 1
+        # like the real client, the download sets generation and other properties
+        self._copy_from(stored)
+        # a new buffer, like data received from the network
+        data = bytes(memoryview(stored._data))
+        # like GCS decompressive transcoding of gzip encoded objects
+        if self.content_encoding == "gzip" and not raw_download:
+            data = gzip.decompress(data)
+        if start is not None or end is not None:
+            data = data[start or 0 : None if end is None else end + 1]  # noqa: E203
+        return data
+
+    download_as_string = download_as_bytes
+
+    def download_as_text(self, **kwargs) -> str:
+        return self.download_as_bytes(**kwargs).decode("utf-8")
+
+    def upload_from_string(
+        self,
+        data,
+        content_type: Optional[str] = None,
+        if_generation_match: Optional[int] = None,
+        **kwargs,
+    ) -> None:
+        self.client._wait()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.bucket._lock:
+            current = self.bucket._blobs.get(self.name)
+            if if_generation_match is not None:
+                current_generation = current.generation if current else 0
+                if current_generation != if_generation_match:
+                    raise exceptions.PreconditionFailed(
+                        f"{self.bucket.name}/{self.name}"
+                    )
+            self.client.counters["uploads"] += 1
+            self._data = bytes(data)
+            self.generation = self.client._next_generation()
+            self.metageneration = 1
+            if content_type:
+                self.content_type = content_type
+            self.updated = datetime.datetime.now(datetime.timezone.utc)
+            self.md5_hash = base64.b64encode(hashlib.md5(self._data).digest()).decode()
+            stored = FakeBlob(self.bucket, self.name)
+            stored._copy_from(self)
+            if current is None:
+                self.bucket._sorted_names = None
+            self.bucket._blobs[self.name] = stored
+
+    def delete(self, *args, **kwargs) -> None:
+        self._stored()
+        with self.bucket._lock:
+            self.bucket._blobs.pop(self.name, None)
+            self.bucket._sorted_names = None
+
+    def patch(self, *args, **kwargs) -> None:
+        stored = self._stored()
+        for field in ("content_type", "content_encoding", "cache_control", "metadata"):
+            setattr(stored, field, getattr(self, field))
+        stored.metageneration += 1
+
+    def open(self, mode: str = "r", **kwargs):
+        if "r" in mode:
+            data = self.download_as_bytes()
+            return io.BytesIO(data) if "b" in mode else io.StringIO(data.decode())
+        return _FakeWriter(self, binary="b" in mode)
+
+
+class _FakeWriter:
+    """File-like writer which uploads its content on close."""
+
+    def __init__(self, blob: FakeBlob, binary: bool):
+        self._blob = blob
+        self._buffer = io.BytesIO() if binary else io.StringIO()
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def close(self):
+        self._blob.upload_from_string(self._buffer.getvalue())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeBlobIterator:
+    """Iterator over listed blobs with GCS-like page tokens."""
+
+    def __init__(self, blobs: Iterable[FakeBlob], next_page_token: Optional[str]):
+        self._blobs = blobs
+        self.next_page_token = next_page_token
+
+    def __iter__(self):
+        return iter(self._blobs)
+
+
+class FakeBucket:
+    """Subset of google.cloud.storage.Bucket."""
+
+    def __init__(self, client: "FakeStorageClient", name: str):
+        self.client = client
+        self.name = name
+        self._blobs: Dict[str, FakeBlob] = {}
+        self._sorted_names: Optional[List[str]] = None
+        self._lock = threading.RLock()
+
+    def names(self) -> List[str]:
+        with self._lock:
+            if self._sorted_names is None:
+                self._sorted_names = sorted(self._blobs)
+            return self._sorted_names
+
+    def blob(self, name: str, *args, **kwargs) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, *args, **kwargs) -> Optional[FakeBlob]:
+        blob = FakeBlob(self, name)
+        try:
+            blob.reload()
+        except exceptions.NotFound:
+            return None
+        return blob
+
+    def list_blobs(self, **kwargs) -> FakeBlobIterator:
+        return self.client.list_blobs(self, **kwargs)
+
+
+class FakeStorageClient:
+    """In-memory replacement of google.cloud.storage.Client.
+
+    Args:
+        latency: seconds added to every storage operation.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.counters = {"downloads": 0, "uploads": 0, "lists": 0}
+        self._buckets: Dict[str, FakeBucket] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _wait(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _next_generation(self) -> int:
+        with self._lock:
+            self._generation += 1
+            return self._generation
+
+    def bucket(self, name: str) -> FakeBucket:
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(self, name)
+            return self._buckets[name]
+
+    def put(
+        self, bucket_name: str, name: str, data, content_type: Optional[str] = None
+    ) -> FakeBlob:
+        """Stores an object, a helper for setting up the test data."""
+        blob = self.bucket(bucket_name).blob(name)
+        latency, self.latency = self.latency, 0.0
+        try:
+            blob.upload_from_string(data, content_type=content_type)
+        finally:
+            self.latency = latency
+        self.counters["uploads"] -= 1
+        return blob
+
+    def names(self, bucket_name: str) -> List[str]:
+        """Returns sorted names of all objects in the bucket."""
+        return list(self.bucket(bucket_name).names())
+
+    def put_many(self, bucket_name: str, names: List[str], data) -> None:
+        """Stores many objects with the same content, a helper for large test data."""
+        bucket = self.bucket(bucket_name)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with bucket._lock:
+            for name in names:
+                blob = FakeBlob(bucket, name)
+                blob._data = data
+                blob.generation = self._next_generation()
+                blob.metageneration = 1
+                blob.updated = now
+                blob.md5_hash = md5_hash
+                bucket._blobs[name] = blob
+            bucket._sorted_names = None
+
+    def list_blobs(
+        self,
+        bucket_or_name,
+        max_results: Optional[int] = None,
+        page_token: Optional[str] = None,
+        prefix: Optional[str] = None,
+        start_offset: Optional[str] = None,
+        end_offset: Optional[str] = None,
+        **kwargs,
+    ) -> FakeBlobIterator:
+        self._wait()
+        self.counters["lists"] += 1
+        bucket = (
+            bucket_or_name
+            if isinstance(bucket_or_name, FakeBucket)
+            else self.bucket(bucket_or_name)
+        )
+        names = bucket.names()
+        start = max(page_token or "", start_offset or "", prefix or "")
+
+        def matching_blobs():
+            # blobs are created lazily, like pages fetched by the real iterator
+            for index in range(bisect.bisect_left(names, start), len(names)):
+                name = names[index]
+                if prefix and not name.startswith(prefix):
+                    break
+                if end_offset and name >= end_offset:
+                    break
+                stored = bucket._blobs.get(name)
+                if stored:
+                    blob = FakeBlob(bucket, name)
+                    blob._copy_from(stored)
+                    yield blob
+
+        if max_results is None:
+            return FakeBlobIterator(matching_blobs(), None)
+        blobs = []
+        next_page_token = None
+        for blob in matching_blobs():
+            if len(blobs) == max_results:
+                next_page_token = blob.name
+                break
+            blobs.append(blob)
+        return FakeBlobIterator(blobs, next_page_token)
+
+
+class FakeOperation:
+    """Long running operation returned by async_batch_annotate_images.
+
+    The operation runs when its result is requested, unless the Vision client
+    is set not to finish operations.
+    """
+
+    def __init__(self, name: str, run, vision_client: "FakeVisionClient"):
+        self.operation = operations_pb2.Operation(name=name)
+        self._run = run
+        self._vision_client = vision_client
+        self._result = None
+        self._done = False
+
+    def done(self) -> bool:
+        return self._done
+
+    def result(self, timeout: Optional[float] = None):
+        if not self._done:
+            if not self._vision_client.finish_operations:
+                raise concurrent.futures.TimeoutError()
+            self._result = self._run()
+            self._done = True
+            self.operation.done = True
+            self.operation.response.Pack(type(self._result).pb(self._result))
+        return self._result
+
+
+class FakeOperationsClient:
+    """Subset of google.api_core.operations_v1.OperationsClient."""
+
+    def __init__(self, vision_client: "FakeVisionClient"):
+        self._vision_client = vision_client
+
+    def get_operation(self, name: str, **kwargs) -> operations_pb2.Operation:
+        operation = self._vision_client.operations[name]
+        try:
+            operation.result()
+        except concurrent.futures.TimeoutError:
+            pass
+        return operation.operation
+
+    def cancel_operation(self, name: str, **kwargs) -> None:
+        pass
+
+
+class FakeVisionClient:
+    """In-memory replacement of vision.ImageAnnotatorClient.
+
+    Every image gets a label annotation named after its URI or content size.
+    Images with "error" in their URI get an error response.
+
+    Args:
+        storage_client: fake storage receiving outputs of async batch requests.
+        latency: seconds added to every Vision RPC.
+        quota: max. images per second, RPCs over the quota fail with ResourceExhausted
+            like the real API returns HTTP 429.
+        clock: time source of the quota, for tests
+
+    Attributes:
+        finish_operations: when False, async batch operations never finish.
+        operations: async batch operations by name.
+    """
+
+    def __init__(
+        self,
+        storage_client: Optional[FakeStorageClient] = None,
+        latency: float = 0.0,
+        quota: Optional[float] = None,
+        clock=time.monotonic,
+    ):
+        self.storage_client = storage_client
+        self.latency = latency
+        self.quota = quota
+        self.clock = clock
+        self.counters = {
+            "images": 0,
+            "annotate": 0,
+            "batch": 0,
+            "async_batch": 0,
+            "files": 0,
+            "throttled": 0,
+        }
+        self.finish_operations = True
+        self.operations: Dict[str, FakeOperation] = {}
+        self.transport = types.SimpleNamespace(
+            operations_client=FakeOperationsClient(self)
+        )
+        self._lock = threading.Lock()
+        # start times of the RPCs in the last second and their numbers of images
+        self._window: List[tuple] = []
+
+    def _count(self, counter: str, images: int) -> None:
+        with self._lock:
+            if self.quota is not None:
+                now = self.clock()
+                self._window = [(t, n) for t, n in self._window if now - t < 1.0]
+                if sum(n for _, n in self._window) + images > self.quota:
+                    self.counters["throttled"] += 1
+                    raise exceptions.ResourceExhausted("Quota exceeded")
+                self._window.append((now, images))
+            self.counters[counter] += 1
+            self.counters["images"] += images
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _annotate(request: vision.AnnotateImageRequest) -> vision.AnnotateImageResponse:
+        uri = request.image.source.image_uri
+        response = vision.AnnotateImageResponse()
+        response.context.uri = uri
+        if "error" in uri:
+            response.error.code = 3
+            response.error.message = f"Bad image {uri}"
+            return response
+        description = uri or "uploaded image"
+        response.label_annotations.append(
+            vision.EntityAnnotation(description=description, score=0.9)
+        )
+        return response
+
+    def annotate_image(self, request, timeout=None, **kwargs):
+        self._count("annotate", 1)
+        return self._annotate(request)
+
+    def batch_annotate_images(self, requests=None, timeout=None, **kwargs):
+        self._count("batch", len(requests))
+        return vision.BatchAnnotateImagesResponse(
+            responses=[self._annotate(request) for request in requests]
+        )
+
+    def _annotate_file(
+        self, request: vision.AnnotateFileRequest
+    ) -> vision.AnnotateFileResponse:
+        uri = request.input_config.gcs_source.uri
+        response = vision.AnnotateFileResponse(input_config=request.input_config)
+        bucket_name, name = uri[len("gs://") :].split("/", 1)  # noqa: E203
+        blob = self.storage_client.bucket(bucket_name).get_blob(name)
+        content = blob.download_as_bytes() if blob else b""
+        total_pages = content.count(b"\f") + 1
+        pages = list(request.pages) or list(
+            range(1, min(total_pages, FILE_PAGES_MAX) + 1)
+        )
+        if not content or b"error" in content:
+            response.error.code = 3
+            response.error.message = f"Bad file {uri}"
+            return response
+        if len(pages) > FILE_PAGES_MAX or not all(
+            1 <= page <= total_pages for page in pages
+        ):
+            response.error.code = 3
+            response.error.message = f"Invalid pages {pages} of {uri}"
+            return response
+        response.total_pages = total_pages
+        for page in pages:
+            page_response = vision.AnnotateImageResponse()
+            page_response.context.uri = uri
+            page_response.context.page_number = page
+            page_response.label_annotations.append(
+                vision.EntityAnnotation(description=uri, score=0.9)
+            )
+            page_response.label_annotations.append(
+                vision.EntityAnnotation(description=f"page {page}", score=0.5)
+            )
+            response.responses.append(page_response)
+        return response
+
+    def batch_annotate_files(self, requests=None, timeout=None, **kwargs):
+        """Annotates files of the fake storage, their pages are separated by form feeds.
+
+        Files with "error" in their content get an error response.
+        """
+        self._count("files", sum(len(r.pages) or FILE_PAGES_MAX for r in requests))
+        return vision.BatchAnnotateFilesResponse(
+            responses=[self._annotate_file(request) for request in requests]
+        )
+
+    def async_batch_annotate_images(self, requests=None, output_config=None, **kwargs):
+        self._count("async_batch", len(requests))
+
+        def run():
+            uri = output_config.gcs_destination.uri
+            bucket_name, prefix = uri[len("gs://") :].split("/", 1)  # noqa: E203
+            batch_size = output_config.batch_size or 20
+            for start in range(0, len(requests), batch_size):
+                chunk = requests[start : start + batch_size]  # noqa: E203
+                responses = [
+                    json.loads(vision.AnnotateImageResponse.to_json(self._annotate(r)))
+                    for r in chunk
+                ]
+                name = f"{prefix}output-{start + 1}-to-{start + len(chunk)}.json"
+                self.storage_client.put(
+                    bucket_name, name, json.dumps({"responses": responses})
+                )
+            return vision.AsyncBatchAnnotateImagesResponse(output_config=output_config)
+
+        with self._lock:
+            name = f"operations/{len(self.operations) + 1}"
+            self.operations[name] = FakeOperation(name, run, self)
+        return self.operations[name]
@@ -0,0 +1,191 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multi-page files (PDF, TIFF, GIF) annotated page by page.
+
+TIFF and GIF images have pages only when they have several frames, single-frame
+ones are annotated as other images. Pillow is imported on first use, like in
+image_resize.
+"""
+
+import io
+import logging
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from search_index import SCORED_ANNOTATIONS
+
+# content types of files annotated page by page, by the file extension
+FILE_MIMETYPES = {
+    ".pdf": "application/pdf",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+    ".gif": "image/gif",
+}
+# content types of files which are annotated page by page only with several frames
+FRAME_MIMETYPES = {"image/tiff", "image/gif"}
+# objects uploaded without a content type get this one
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+
+def file_mimetype(file_name: str, content_type: Optional[str]) -> Optional[str]:
+    """Returns content type of a multi-page file, None for other images.
+
+    Objects without a specific content type are recognized by their extension.
+    """
+    if content_type:
+        content_type = content_type.partition(";")[0].strip().lower()
+    if content_type in FILE_MIMETYPES.values():
+        return content_type
+    if content_type and content_type != DEFAULT_CONTENT_TYPE:
+        return None
+    return FILE_MIMETYPES.get(os.path.splitext(file_name)[1].lower())
+
+
+def frame_count(content: bytes) -> Optional[int]:
+    """Returns number of frames of the encoded image, None if it can't be decoded.
+
+    Args:
+        content: encoded image
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning("Pillow is not installed, frames are not counted.")
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            return getattr(image, "n_frames", 1)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning("Frames not counted: %s", e)
+        return None
+
+
+def page_chunks(pages: Iterable[int], size: int) -> Iterator[List[int]]:
+    """Splits page numbers into lists of at most <size> pages."""
+    chunk: List[int] = []
+    for page in pages:
+        chunk.append(page)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def page_digest(annotation: dict) -> dict:
+    """Returns the part of a page annotation kept in the summary of its file.
+
+    That's the error of the page and its labels, objects, landmarks and logos
+    without their positions.
+    """
+    digest = {}
+    if "error" in annotation:
+        digest["error"] = annotation["error"]
+    for field, (_, description_field) in SCORED_ANNOTATIONS.items():
+        items = [
+            {
+                name: item[name]
+                for name in ("mid", description_field, "score")
+                if name in item
+            }
+            for item in annotation.get(field, [])
+        ]
+        if items:
+            digest[field] = items
+    return digest
+
+
+class FileSummary:
+    """Annotation of a multi-page file, built from digests of its pages.
+
+    Labels, objects, landmarks and logos found on any page are merged by their
+    description, each with the best score and the pages where it was found.
+    The summary is stored as the annotation of the file, so the demo UI,
+    the annotation list and the search index use it like an image annotation.
+
+    Args:
+        mime_type: content type of the file
+    """
+
+    def __init__(self, mime_type: str):
+        self.mime_type = mime_type
+        self.total_pages = 0
+        self.pages: Set[int] = set()
+        self.error: Optional[dict] = None
+        self._failed: Dict[int, dict] = {}
+        # field -> description -> merged item
+        self._merged: Dict[str, Dict[str, dict]] = {}
+
+    def add(self, page: int, digest: dict) -> None:
+        """Merges the digest of the page, see page_digest()."""
+        self.pages.add(page)
+        if "error" in digest:
+            self._failed[page] = digest["error"]
+        for field, (_, description_field) in SCORED_ANNOTATIONS.items():
+            merged = self._merged.setdefault(field, {})
+            for item in digest.get(field, []):
+                key = item.get(description_field, "")
+                current = merged.get(key)
+                if current is None:
+                    current = merged[key] = dict(item, pages=[])
+                elif item.get("score", 0.0) > current.get("score", 0.0):
+                    current.update(item)
+                else:
+                    current.update(
+                        (name, value)
+                        for name, value in item.items()
+                        if name not in current
+                    )
+                current["pages"].append(page)
+
+    def missing_pages(self) -> List[int]:
+        """Returns numbers of pages without a digest."""
+        return [
+            page for page in range(1, self.total_pages + 1) if page not in self.pages
+        ]
+
+    def to_dict(self) -> dict:
+        """Returns the summary as annotation JSON of the file.
+
+        Merged items are ordered by their best score, the pages where they
+        were found by the page number.
+        """
+        summary: dict = {"mimeType": self.mime_type, "totalPages": self.total_pages}
+        if self.error:
+            summary["error"] = self.error
+        if self._failed:
+            summary["failedPages"] = [
+                {"page": page, "error": error}
+                for page, error in sorted(self._failed.items())
+            ]
+        for field, merged in self._merged.items():
+            if merged:
+                summary[field] = sorted(
+                    (
+                        dict(item, pages=sorted(item["pages"]))
+                        for item in merged.values()
+                    ),
+                    key=lambda item: -item.get("score", 0.0),
+                )
+        return summary
+
+
+def parse_page_name(name: str) -> Optional[Tuple[str, int]]:
+    """Returns file name and page number of a page annotation name "<file>/<page>.json"."""
+    file_name, _, page_name = name.rpartition("/")
+    page, _, extension = page_name.partition(".")
+    if not file_name or extension != "json" or not page.isdigit():
+        return None
+    return file_name, int(page)
@@ -0,0 +1,122 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Downscaling of images before annotation and rescaling of annotation coordinates.
+
+Pillow is imported on first use, it isn't needed when images are sent as they are.
+"""
+
+import io
+import logging
+from typing import Optional, Tuple
+
+# JSON fields of AnnotateImageResponse with vertices in pixels of the image,
+# normalizedVertices are independent of the image size
+BOUNDING_POLY_FIELDS = ("boundingPoly", "fdBoundingPoly", "boundingBox")
+# re-encoded images keep their format if Vision accepts it, others become PNG or JPEG
+KEPT_FORMATS = ("JPEG", "PNG", "WEBP")
+
+
+def downscale(
+    content: bytes, max_dimension: int, quality: int = 90
+) -> Optional[Tuple[bytes, float, float]]:
+    """Re-encodes the image so that no side is longer than <max_dimension> pixels.
+
+    Metadata (EXIF, ICC profile) isn't copied, the pixel grid isn't rotated, so
+    annotations map back to the original by scaling only.
+
+    Args:
+        content: encoded image
+        max_dimension: max. width and height of the result
+        quality: JPEG and WEBP quality of the result
+
+    Returns:
+        tuple: the re-encoded image and x, y scale factors from it to the original,
+            None if the image is small enough, can't be decoded or Pillow isn't installed.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning("Pillow is not installed, images are not downscaled.")
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            width, height = image.size
+            if max(width, height) <= max_dimension:
+                return None
+            image_format = image.format
+            # JPEG is decoded in the smallest scale (1/2, 1/4, 1/8) still
+            # larger than the result, not in the full size
+            image.draft(None, (max_dimension, max_dimension))
+            image.thumbnail((max_dimension, max_dimension), reducing_gap=None)
+            if image_format not in KEPT_FORMATS:
+                image_format = "JPEG" if image.mode in ("RGB", "L") else "PNG"
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, format=image_format, quality=quality)
+            new_width, new_height = image.size
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning("Image not downscaled: %s", e)
+        return None
+    downscaled = output.getvalue()
+    if len(downscaled) >= len(content):
+        return None
+    return downscaled, width / new_width, height / new_height
+
+
+def rescale_annotation(annotation, scale_x: float, scale_y: float) -> None:
+    """Scales pixel coordinates in AnnotateImageResponse JSON in place.
+
+    Args:
+        annotation: parsed JSON of AnnotateImageResponse or of any of its fields
+        scale_x: factor of x coordinates and widths
+        scale_y: factor of y coordinates and heights
+    """
+    if isinstance(annotation, list):
+        for item in annotation:
+            rescale_annotation(item, scale_x, scale_y)
+        return
+    if not isinstance(annotation, dict):
+        return
+    for key, value in annotation.items():
+        if key in BOUNDING_POLY_FIELDS:
+            for vertex in value.get("vertices", []):
+                # fields equal to 0 are omitted from the JSON
+                vertex["x"] = round(vertex.get("x", 0) * scale_x)
+                vertex["y"] = round(vertex.get("y", 0) * scale_y)
+        elif key == "position":
+            # face landmarks
+            value["x"] = value.get("x", 0.0) * scale_x
+            value["y"] = value.get("y", 0.0) * scale_y
+        elif key == "pages":
+            for page in value:
+                if "width" in page:
+                    page["width"] = round(page["width"] * scale_x)
+                if "height" in page:
+                    page["height"] = round(page["height"] * scale_y)
+                rescale_annotation(page, scale_x, scale_y)
+        else:
+            rescale_annotation(value, scale_x, scale_y)
+
+
+def image_mimetype(content: bytes) -> str:
+    """Returns MIME type of an image produced by downscale()."""
+    if content.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if content.startswith(b"\x89PNG"):
+        return "image/png"
+    if content[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
@@ -12,54 +12,855 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import annotations
+
+import base64
+import binascii
 import collections
-import io
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import gzip
+import hashlib
+import itertools
 import json
+import math
 import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+)
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait
+from dataclasses import dataclass
 
 # Imports Python standard library logging
 # Logs show fine in the Cloud Logs explorer, but in GCF LOGS, they show HTTP logging request.
 import logging
-from typing import Dict, List, Optional, OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    OrderedDict,
+    Set,
+    Tuple,
+    TypeVar,
+)
 from urllib import parse
 
 import functions_framework
-from flask import Request, Response, make_response, send_file
-from google.cloud import logging as cloud_logging
-from google.cloud import storage, vision
+from flask import Request, Response, make_response
+from werkzeug.datastructures import ContentRange
+
+from admission import AdmissionRejected, MemoryAdmission
+from annotation_cache import AnnotationCache
+from file_pages import (
+    FRAME_MIMETYPES,
+    FileSummary,
+    file_mimetype,
+    frame_count,
+    page_chunks,
+    page_digest,
+    parse_page_name,
+)
+from image_resize import downscale, image_mimetype, rescale_annotation
+from lazy_module import lazy_import
+from near_duplicates import ImageHash, NearDuplicateIndex, perceptual_hash
+from ratelimit import AdaptiveRateLimiter, RateLimitTimeout, call_with_retry
+from search_index import SearchIndex, annotation_terms
+from sharded_store import ShardedJsonStore
+from single_flight import SingleFlight, SingleFlightTimeout
+from telemetry import (
+    TimedIterable,
+    observe,
+    reset_telemetry,
+    set_attributes,
+    stage,
+    traced,
+)
 
 FEATURES_ENV = "FEATURES"
+IMAGE_CONTEXT_ENV = "IMAGE_CONTEXT"
+IMAGE_MAX_DIMENSION_ENV = "IMAGE_MAX_DIMENSION"
+THUMBNAIL_SIZES_ENV = "THUMBNAIL_SIZES"
+OUTPUT_EXCLUDE_FIELDS_ENV = "OUTPUT_EXCLUDE_FIELDS"
+OUTPUT_COMPACT_ENV = "OUTPUT_COMPACT"
+OUTPUT_GZIP_ENV = "OUTPUT_GZIP"
+OUTPUT_NDJSON_ENV = "OUTPUT_NDJSON"
 INPUT_BUCKET_ENV = "INPUT_BUCKET"
 ANNOTATIONS_BUCKET_ENV = "ANNOTATIONS_BUCKET"
+VISION_CLIENT_POOL_SIZE_ENV = "VISION_CLIENT_POOL_SIZE"
+BATCH_WINDOW_MS_ENV = "BATCH_WINDOW_MS"
+BATCH_SIZE_ENV = "BATCH_SIZE"
+BACKFILL_BATCH_SIZE_ENV = "BACKFILL_BATCH_SIZE"
+BACKFILL_CONCURRENCY_ENV = "BACKFILL_CONCURRENCY"
+ANNOTATION_CACHE_ENV = "ANNOTATION_CACHE"
+ANNOTATION_CACHE_MAX_ENTRIES_ENV = "ANNOTATION_CACHE_MAX_ENTRIES"
+ANNOTATION_CACHE_MAX_BYTES_ENV = "ANNOTATION_CACHE_MAX_BYTES"
+ANNOTATION_CACHE_TTL_ENV = "ANNOTATION_CACHE_TTL"
+MAX_IMAGE_SIZE_ENV = "MAX_IMAGE_SIZE"
+MANIFEST_SHARDS_ENV = "MANIFEST_SHARDS"
+MANIFEST_TTL_ENV = "MANIFEST_TTL"
+SEARCH_INDEX_SHARDS_ENV = "SEARCH_INDEX_SHARDS"
+NEAR_DUPLICATE_DISTANCE_ENV = "NEAR_DUPLICATE_DISTANCE"
+EMBED_MAX_ENV = "EMBED_MAX"
+EMBED_FETCH_TIMEOUT_ENV = "EMBED_FETCH_TIMEOUT"
+IO_WORKERS_ENV = "IO_WORKERS"
+MEMORY_LIMIT_MB_ENV = "MEMORY_LIMIT_MB"
+ADMISSION_MEMORY_MB_ENV = "ADMISSION_MEMORY_MB"
+ADMISSION_TIMEOUT_ENV = "ADMISSION_TIMEOUT"
+VISION_RATE_ENV = "VISION_RATE"
+VISION_RATE_MAX_ENV = "VISION_RATE_MAX"
+VISION_MAX_RETRIES_ENV = "VISION_MAX_RETRIES"
+FUNCTION_TIMEOUT_SEC_ENV = "FUNCTION_TIMEOUT_SEC"
+ANNOTATE_BATCH_PARALLELISM_ENV = "ANNOTATE_BATCH_PARALLELISM"
+ANNOTATE_BATCH_ITEMS_MAX_ENV = "ANNOTATE_BATCH_ITEMS_MAX"
+ANNOTATE_BATCH_BYTES_MAX_ENV = "ANNOTATE_BATCH_BYTES_MAX"
+FILE_PARALLELISM_ENV = "FILE_PARALLELISM"
 
 FILE_LIST_SIZE_MAX = 8196
-NUM_EMBEDDED_ANNOTATIONS_MAX = 10
+NUM_EMBEDDED_ANNOTATIONS_MAX = 100
+EMBED_FETCH_TIMEOUT = 10.0
+IO_WORKERS_DEFAULT = 16
+# share of the instance memory reserved by concurrent requests, the rest is taken
+# by the interpreter, clients, caches and indexes
+ADMISSION_MEMORY_SHARE = 0.5
+# how long a request waits for memory released by other requests
+ADMISSION_TIMEOUT_DEFAULT = 10.0
+# memory of a request without images, and of an image per byte of its size:
+# the request body, the decoded image and the Vision request
+REQUEST_MEMORY_BASE = 1024 * 1024
+IMAGE_MEMORY_FACTOR = 3
+# memory of decoding an image into a thumbnail
+THUMBNAIL_MEMORY = 32 * 1024 * 1024
+# concurrent BatchAnnotateImages calls and max. images of one /annotate/batch request
+ANNOTATE_BATCH_PARALLELISM_DEFAULT = 4
+ANNOTATE_BATCH_ITEMS_MAX_DEFAULT = 1024
+# max. size of all images uploaded with one /annotate/batch request
+ANNOTATE_BATCH_BYTES_MAX_DEFAULT = 32 * 1024 * 1024
+NDJSON_MIMETYPE = "application/x-ndjson"
+# number of distinct <features> and <image_context> values of HTTP requests kept parsed
+FEATURE_OVERRIDES_CACHE_SIZE = 256
+# model part of a feature spec NAME[:MAX_RESULTS][@MODEL], e.g. "builtin/latest"
+FEATURE_MODEL_RE = re.compile(r"^[\w./-]+$")
+# base64 alphabet with optional padding, MIME encoders may add line breaks
+BASE64_RE = re.compile(r"[A-Za-z0-9+/\s]*(=\s*){0,2}")
+# sizes of thumbnails served by /bucket/imagedata/<image>?size=<pixels>
+THUMBNAIL_SIZES_DEFAULT = "128,256,512"
+THUMBNAIL_QUALITY = 80
+# thumbnail URLs carry the image generation, their responses never change
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+# Size of chunks in which images are streamed from GCS to the HTTP response.
+IMAGE_CHUNK_SIZE = 1024 * 1024
+# allowance for form fields and multipart boundaries of an image upload
+UPLOAD_OVERHEAD_MAX = 64 * 1024
+# smaller GCS images are read by Vision directly, downscaling them saves little
+DOWNSCALE_MIN_SIZE = 1024 * 1024
+# Vision API doesn't accept images larger than 20MB.
+VISION_IMAGE_SIZE_MAX = 20 * 1024 * 1024
+# timeout of a single Vision API call
+VISION_TIMEOUT = 120.0
+VISION_MAX_RETRIES_DEFAULT = 5
+# Cloud Functions default timeout, and time reserved to store results after Vision calls
+FUNCTION_TIMEOUT_DEFAULT = 60.0
+FUNCTION_TIMEOUT_MARGIN = 5.0
+# Max. number of images in a single BatchAnnotateImages request.
+VISION_BATCH_SIZE_MAX = 16
+# Max. number of pages of a file in a single BatchAnnotateFiles request.
+VISION_FILE_PAGES_MAX = 5
+# concurrent BatchAnnotateFiles calls of one multi-page file
+FILE_PARALLELISM_DEFAULT = 4
+# Max. number of images in a single AsyncBatchAnnotateImages request.
+VISION_ASYNC_BATCH_SIZE_MAX = 2000
+# Max. number of responses per output file of AsyncBatchAnnotateImages.
+VISION_ASYNC_OUTPUT_BATCH_SIZE = 100
+BACKFILL_BATCH_SIZE_DEFAULT = 500
+BACKFILL_CONCURRENCY_DEFAULT = 2
+BACKFILL_OPERATION_TIMEOUT = 3600.0
+
+# Objects maintained by the functions are kept under this prefix in the annotations bucket.
+INTERNAL_PREFIX = "_vision/"
+BACKFILL_PREFIX = INTERNAL_PREFIX + "backfill/"
+BACKFILL_CHECKPOINT = BACKFILL_PREFIX + "checkpoint.json"
+CACHE_PREFIX = INTERNAL_PREFIX + "cache/"
+MANIFEST_PREFIX = INTERNAL_PREFIX + "manifest/"
+# inverted index of annotation terms and the indexed terms of every image
+SEARCH_TERMS_PREFIX = INTERNAL_PREFIX + "search/terms/"
+SEARCH_DOCS_PREFIX = INTERNAL_PREFIX + "search/docs/"
+# perceptual hashes of annotated images, <config fingerprint>/NNNN.json
+NEAR_DUPLICATE_PREFIX = INTERNAL_PREFIX + "phash/"
+# annotations of pages of multi-page files, <file>/<page>.json
+PAGES_PREFIX = INTERNAL_PREFIX + "pages/"
+# thumbnails of images, <size>/<image>
+THUMBNAIL_PREFIX = INTERNAL_PREFIX + "thumbnails/"
+# one <image>.ndjson file of flat annotation rows per image, for analytics
+NDJSON_PREFIX = INTERNAL_PREFIX + "ndjson/"
+GZIP_MAGIC = b"\x1f\x8b"
+# metadata of annotation objects identifying the annotated image version
+SOURCE_GENERATION_METADATA = "source-generation"
+SOURCE_MD5_METADATA = "source-md5"
+# fingerprint of the features, image context and output options of the annotation
+ANNOTATION_CONFIG_METADATA = "annotation-config"
+# metadata of page annotations with the number of pages of the file
+TOTAL_PAGES_METADATA = "total-pages"
+# number of processed (event id, generation) pairs remembered by an instance
+PROCESSED_EVENTS_MAX = 4096
+# annotation lists exported to NDJSON rows, with the row type
+NDJSON_ANNOTATION_TYPES = {
+    "labelAnnotations": "label",
+    "landmarkAnnotations": "landmark",
+    "logoAnnotations": "logo",
+    "localizedObjectAnnotations": "object",
+    "faceAnnotations": "face",
+    "textAnnotations": "text",
+}
+MANIFEST_SHARDS_DEFAULT = 256
+MANIFEST_TTL_DEFAULT = 30.0
+SEARCH_INDEX_SHARDS_DEFAULT = 256
+# default and max. number of results of one /bucket/search page
+SEARCH_PAGE_SIZE_DEFAULT = 50
+SEARCH_PAGE_SIZE_MAX = 1000
+# annotations read concurrently while the search index is rebuilt
+SEARCH_REBUILD_CHUNK = 256
+SEARCH_REBUILD_READ_TIMEOUT = 30.0
+NEAR_DUPLICATE_SHARDS = 64
+
+# Values of ANNOTATION_CACHE: no caching, in-memory only, in-memory and GCS
+ANNOTATION_CACHE_NONE = "none"
+ANNOTATION_CACHE_MEMORY = "memory"
+ANNOTATION_CACHE_GCS = "gcs"
 
 TEST_IMAGE = "gs://cloud-samples-data/vision/eiffel_tower.jpg"
 
-# Instantiates a client
-logging_client = cloud_logging.Client()
-# Retrieves a Cloud Logging handler based on the environment
-# you're running in and integrates the handler with the
-# Python logging module. By default this captures all logs
-# at INFO level and higher
-logging_client.setup_logging()
+T = TypeVar("T")
+
+# Heavy Google Cloud modules are imported on their first use, not on cold start.
+api_operation = lazy_import("google.api_core.operation")
+exceptions = lazy_import("google.api_core.exceptions")
+storage = lazy_import("google.cloud.storage")
+vision = lazy_import("google.cloud.vision")
 
 # The name of the log to write to
 LOG_NAME = "vision-api"
-# Selects the log to write to
-logger = logging_client.logger(LOG_NAME)
+logger = None
 
 # By default, disable logging for production:
 logging.disable(sys.maxsize)
 log_level = os.environ.get("LOG_LEVEL", None)
 # if user set log level, enable logging and set the level
 if log_level:
+    # Cloud Logging is set up only when logging is enabled,
+    # creating the client costs an import and a network round trip.
+    from google.cloud import logging as cloud_logging
+
+    # Instantiates a client
+    logging_client = cloud_logging.Client()
+    # Retrieves a Cloud Logging handler based on the environment
+    # you're running in and integrates the handler with the
+    # Python logging module. By default this captures all logs
+    # at INFO level and higher
+    logging_client.setup_logging()
+    # Selects the log to write to
+    logger = logging_client.logger(LOG_NAME)
     logging.disable(logging.NOTSET)
     logging.getLogger().setLevel(log_level)
 
 
+# ------- Config ------
+
+
+@dataclass(frozen=True)
+class FeatureSelection:
+    """Vision features parsed from a comma-delimited list of names.
+
+    The feature dicts are shared by all requests using the same list, don't modify them.
+    """
+
+    features: Tuple[Dict[str, Any], ...]
+    unknown: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class OutputOptions:
+    """How annotation JSON files are written to the annotations bucket.
+
+    Attributes:
+        exclude: JSON paths of fields to drop, e.g. ("fullTextAnnotation", "pages").
+            Lists on the path are traversed, the field is dropped from every item.
+        compact: JSON without indentation and spaces.
+        gzip: objects are stored gzip compressed, with Content-Encoding: gzip.
+        ndjson: flat annotation rows are also written to NDJSON_PREFIX<image>.ndjson.
+    """
+
+    exclude: Tuple[Tuple[str, ...], ...] = ()
+    compact: bool = False
+    gzip: bool = False
+    ndjson: bool = False
+
+
+@dataclass(frozen=True)
+class Config:
+    """Instance configuration, parsed once from the environment variables.
+
+    Features and image context are parsed on first use, they need the Vision
+    client library, which routes that don't annotate images never import.
+    """
+
+    features_env: Optional[str]
+    input_bucket: Optional[str]
+    annotations_bucket: Optional[str]
+    image_context_env: Optional[str] = None
+    output: OutputOptions = OutputOptions()
+    image_max_dimension_env: Optional[str] = None
+
+    @functools.cached_property
+    def features(self) -> FeatureSelection:
+        features = parse_features(self.features_env or "")
+        if features.unknown:
+            logging.error("Unknown features in %s: %s", FEATURES_ENV, features.unknown)
+        return features
+
+    @functools.cached_property
+    def image_context(self) -> Optional[vision.ImageContext]:
+        if not self.image_context_env:
+            return None
+        try:
+            return parse_image_context(self.image_context_env)
+        except ValueError as e:
+            logging.error("%s ignored: %s", IMAGE_CONTEXT_ENV, e)
+            return None
+
+    @functools.cached_property
+    def max_dimensions(self) -> Dict[str, int]:
+        try:
+            return parse_max_dimensions(self.image_max_dimension_env or "")
+        except ValueError as e:
+            logging.error("%s ignored: %s", IMAGE_MAX_DIMENSION_ENV, e)
+            return {}
+
+    def max_dimension(self, features_list: list) -> Optional[int]:
+        """Returns size to which images are downscaled for the features, None to keep them.
+
+        Images are downscaled only if every feature has a limit, to the largest one.
+        """
+        limits = [
+            self.max_dimensions.get(
+                vision.Feature.Type(feature["type_"]).name,
+                self.max_dimensions.get("*"),
+            )
+            for feature in features_list
+        ] or [self.max_dimensions.get("*")]
+        if None in limits:
+            return None
+        return max(limits)
+
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        """Short hash of the settings which determine content of annotation files."""
+        key = f"{normalize_features(list(self.features.features))}|{self.output}"
+        if self.image_context:
+            key += "|" + vision.ImageContext.to_json(
+                self.image_context, indent=None, sort_keys=True
+            )
+        if self.max_dimensions:
+            key += f"|{sorted(self.max_dimensions.items())}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+_config_lock = threading.Lock()
+_config: Optional[Config] = None
+
+
+def parse_feature_spec(feature_spec: str) -> Optional[Dict[str, Any]]:
+    """Parses a feature spec NAME[:MAX_RESULTS][@MODEL] into vision.Feature fields.
+
+    Returns:
+        dict: vision.Feature fields, None if the spec isn't valid.
+    """
+    name, has_model, model = feature_spec.partition("@")
+    name, has_max_results, max_results = name.partition(":")
+    feature_type = get_feature_by_name(name.strip().upper())
+    if feature_type is None:
+        return None
+    feature = {"type_": feature_type}
+    if has_max_results:
+        if not max_results.isdigit():
+            return None
+        feature["max_results"] = int(max_results)
+    if has_model:
+        if not FEATURE_MODEL_RE.match(model):
+            return None
+        feature["model"] = model
+    return feature
+
+
+@functools.lru_cache(maxsize=FEATURE_OVERRIDES_CACHE_SIZE)
+def parse_features(feature_names: str) -> FeatureSelection:
+    """Parses a comma-delimited list of feature specs, memoized per instance.
+
+    A spec is a feature name, optionally followed by the max. number of results
+    and the model, e.g. LABEL_DETECTION:5 or TEXT_DETECTION@builtin/latest.
+    Specs which aren't valid or name unknown features are returned in <unknown>.
+    """
+    features = []
+    unknown = []
+    for feature_spec in feature_names.split(","):
+        feature_spec = feature_spec.strip().strip('"').strip()
+        if not feature_spec:
+            continue
+        feature = parse_feature_spec(feature_spec)
+        if feature:
+            features.append(feature)
+        else:
+            unknown.append(feature_spec)
+    return FeatureSelection(tuple(features), tuple(unknown))
+
+
+@functools.lru_cache(maxsize=FEATURE_OVERRIDES_CACHE_SIZE)
+def parse_image_context(image_context: str) -> vision.ImageContext:
+    """Parses JSON of vision.ImageContext, memoized per instance.
+
+    Field names can be in camelCase or snake_case, e.g.
+    {"languageHints": ["en"], "cropHintsParams": {"aspectRatios": [1.77]}}.
+    The returned object is shared, don't modify it.
+
+    Raises:
+        ValueError: the JSON isn't a valid ImageContext.
+    """
+    try:
+        return vision.ImageContext.from_json(image_context)
+    except Exception as e:
+        raise ValueError(f"Invalid image context: {e}") from e
+
+
+def parse_max_dimensions(spec: str) -> Dict[str, int]:
+    """Parses max. image dimensions per feature, e.g. "640,TEXT_DETECTION=2048".
+
+    A number without a feature name applies to all other features, under the key "*".
+
+    Raises:
+        ValueError: the spec isn't valid.
+    """
+    dimensions = {}
+    for item in spec.split(","):
+        name, has_name, value = item.strip().rpartition("=")
+        if not value:
+            continue
+        name = name.strip().upper() if has_name else "*"
+        if name != "*" and get_feature_by_name(name) is None:
+            raise ValueError(f"Unknown feature {name}")
+        if not value.strip().isdigit() or int(value) <= 0:
+            raise ValueError(f"Invalid dimension {value}")
+        dimensions[name] = int(value)
+    return dimensions
+
+
+def env_flag(name: str) -> bool:
+    """Returns True if the environment variable is set to 1, true or yes."""
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes")
+
+
+def output_options_from_env() -> OutputOptions:
+    """Parses OUTPUT_* environment variables."""
+    exclude = tuple(
+        tuple(path.strip().split("."))
+        for path in os.environ.get(OUTPUT_EXCLUDE_FIELDS_ENV, "").split(",")
+        if path.strip()
+    )
+    return OutputOptions(
+        exclude=exclude,
+        compact=env_flag(OUTPUT_COMPACT_ENV),
+        gzip=env_flag(OUTPUT_GZIP_ENV),
+        ndjson=env_flag(OUTPUT_NDJSON_ENV),
+    )
+
+
+def get_config() -> Config:
+    """Returns the instance configuration, parsing environment variables on first use."""
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = Config(
+                features_env=os.environ.get(FEATURES_ENV, None),
+                input_bucket=os.environ.get(INPUT_BUCKET_ENV),
+                annotations_bucket=os.environ.get(ANNOTATIONS_BUCKET_ENV),
+                image_context_env=os.environ.get(IMAGE_CONTEXT_ENV),
+                output=output_options_from_env(),
+                image_max_dimension_env=os.environ.get(IMAGE_MAX_DIMENSION_ENV),
+            )
+        return _config
+
+
+def reset_config() -> None:
+    """Drops parsed configuration, environment variables are read again on next use."""
+    global _config
+    with _config_lock:
+        _config = None
+
+
+# ------- Clients ------
+
+# Clients are created lazily and reused by all invocations served by this instance,
+# so credentials lookup, gRPC channel setup and TLS handshakes happen only once.
+_clients_lock = threading.Lock()
+_storage_client: Optional[storage.Client] = None
+_vision_clients: List[vision.ImageAnnotatorClient] = []
+_vision_client_next = 0
+_vision_rate_limiter: Optional[AdaptiveRateLimiter] = None
+# time.monotonic() deadline of the invocation handled by the current thread
+_invocation_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "invocation_deadline", default=None
+)
+
+
+def client_recreate_errors() -> tuple:
+    """Errors after which a client (and its channel) is dropped and rebuilt on next use."""
+    return (exceptions.ServiceUnavailable, exceptions.Unauthenticated)
+
+
+def retryable_vision_errors() -> tuple:
+    """Errors after which a Vision call is retried with backoff."""
+    return (
+        exceptions.TooManyRequests,
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+        exceptions.InternalServerError,
+    )
+
+
+def vision_client_pool_size() -> int:
+    """Returns number of Vision clients (gRPC channels) kept in the pool."""
+    try:
+        return max(1, int(os.environ.get(VISION_CLIENT_POOL_SIZE_ENV, 1)))
+    except ValueError:
+        return 1
+
+
+def get_storage_client() -> storage.Client:
+    """Returns the shared GCS client, creating it on first use."""
+    global _storage_client
+    client = _storage_client
+    if client is None:
+        with _clients_lock:
+            if _storage_client is None:
+                logging.info("Creating storage client.")
+                _storage_client = storage.Client()
+            client = _storage_client
+    return client
+
+
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    """Returns a Vision client from the pool, creating it on first use.
+
+    Clients are handed out round-robin, each one owns its own gRPC channel.
+    The pool size is read from the VISION_CLIENT_POOL_SIZE environment variable.
+    """
+    global _vision_client_next
+    with _clients_lock:
+        pool_size = vision_client_pool_size()
+        index = _vision_client_next % pool_size
+        _vision_client_next = index + 1
+        if index >= len(_vision_clients):
+            logging.info("Creating Vision client %s of %s.", index + 1, pool_size)
+            _vision_clients.append(vision.ImageAnnotatorClient())
+            index = len(_vision_clients) - 1
+        return _vision_clients[index]
+
+
+def invalidate_client(client) -> None:
+    """Drops a failed client from the registry, so it is recreated on next use."""
+    global _storage_client
+    with _clients_lock:
+        if client is _storage_client:
+            _storage_client = None
+        elif client in _vision_clients:
+            _vision_clients.remove(client)
+    logging.warning("Dropped client %s, it will be recreated.", type(client).__name__)
+
+
+def reset_clients() -> None:
+    """Drops all cached clients."""
+    global _storage_client, _vision_client_next
+    with _clients_lock:
+        _storage_client = None
+        _vision_clients.clear()
+        _vision_client_next = 0
+
+
+_io_executor_lock = threading.Lock()
+_io_executor: Optional[ThreadPoolExecutor] = None
+
+
+def optional_float(value: Optional[str]) -> Optional[float]:
+    """Parses an optional number from an environment variable, None if it's not set."""
+    return float(value) if value else None
+
+
+def get_vision_rate_limiter() -> AdaptiveRateLimiter:
+    """Returns the instance rate limiter shared by all Vision API calls.
+
+    Calls aren't limited until Vision API rejects one for the quota, unless
+    the optional VISION_RATE sets the initial rate in images per second.
+    The rate grows with successfully annotated images up to the optional
+    VISION_RATE_MAX and halves with every call rejected by the quota.
+    """
+    global _vision_rate_limiter
+    with _clients_lock:
+        if _vision_rate_limiter is None:
+            try:
+                rate = optional_float(os.environ.get(VISION_RATE_ENV))
+                max_rate = optional_float(os.environ.get(VISION_RATE_MAX_ENV))
+            except ValueError:
+                logging.error("Invalid %s or %s.", VISION_RATE_ENV, VISION_RATE_MAX_ENV)
+                rate, max_rate = None, None
+            _vision_rate_limiter = AdaptiveRateLimiter(
+                rate=rate, burst=VISION_BATCH_SIZE_MAX, max_rate=max_rate
+            )
+            observe(
+                "gcf.vision.rate_limiter",
+                _vision_rate_limiter.stats,
+                "Rate and throttling counters of Vision API calls.",
+            )
+        return _vision_rate_limiter
+
+
+def reset_vision_rate_limiter() -> None:
+    global _vision_rate_limiter
+    with _clients_lock:
+        _vision_rate_limiter = None
+
+
+def start_invocation() -> None:
+    """Sets the deadline of the current invocation from the function timeout.
+
+    FUNCTION_TIMEOUT_SEC is set by Terraform to the timeout of the function.
+    """
+    try:
+        timeout = float(
+            os.environ.get(FUNCTION_TIMEOUT_SEC_ENV, FUNCTION_TIMEOUT_DEFAULT)
+        )
+    except ValueError:
+        timeout = FUNCTION_TIMEOUT_DEFAULT
+    _invocation_deadline.set(time.monotonic() + timeout - FUNCTION_TIMEOUT_MARGIN)
+
+
+def invocation_deadline() -> float:
+    """Returns time.monotonic() time by which Vision calls of this invocation must end.
+
+    Outside of an invocation (e.g. in tests and benchmarks) it's VISION_TIMEOUT from now.
+    """
+    deadline = _invocation_deadline.get()
+    if deadline is None:
+        return time.monotonic() + VISION_TIMEOUT
+    return deadline
+
+
+def call_vision(call, tokens: int = 1):
+    """Calls Vision API through the instance rate limiter, with retries and backoff.
+
+    Args:
+        call: function of a Vision client and timeout making the API call.
+        tokens: number of images in the call.
+
+    Returns:
+        the result of the call.
+    """
+    try:
+        max_retries = int(
+            os.environ.get(VISION_MAX_RETRIES_ENV, VISION_MAX_RETRIES_DEFAULT)
+        )
+    except ValueError:
+        max_retries = VISION_MAX_RETRIES_DEFAULT
+    limiter = get_vision_rate_limiter()
+    clients = []
+
+    def attempt(timeout: float):
+        clients.append(get_vision_client())
+        return call(clients[-1], timeout)
+
+    def on_error(error: BaseException) -> None:
+        if isinstance(error, client_recreate_errors()):
+            invalidate_client(clients[-1])
+        if isinstance(error, exceptions.TooManyRequests):
+            logging.warning("Vision API throttled: %s", limiter.stats())
+
+    return call_with_retry(
+        attempt,
+        limiter,
+        retryable=retryable_vision_errors(),
+        throttling=(exceptions.TooManyRequests,),
+        deadline=invocation_deadline(),
+        timeout=VISION_TIMEOUT,
+        tokens=tokens,
+        max_retries=max_retries,
+        on_error=on_error,
+    )
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    """Returns the instance thread pool for blocking GCS and Vision calls.
+
+    The number of threads is set by the IO_WORKERS environment variable.
+    """
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            try:
+                workers = int(os.environ.get(IO_WORKERS_ENV, IO_WORKERS_DEFAULT))
+            except ValueError:
+                workers = IO_WORKERS_DEFAULT
+            _io_executor = ThreadPoolExecutor(
+                max_workers=max(1, workers), thread_name_prefix="io"
+            )
+        return _io_executor
+
+
+# ------- Admission control ------
+
+_admission_lock = threading.Lock()
+_admission: Optional[MemoryAdmission] = None
+_admission_configured = False
+
+
+def get_memory_admission() -> Optional[MemoryAdmission]:
+    """Returns the memory budget of concurrent requests, None if it isn't limited.
+
+    ADMISSION_MEMORY_MB sets the budget, by default it's a share of MEMORY_LIMIT_MB,
+    the memory of the instance set by Terraform.
+    """
+    global _admission, _admission_configured
+    with _admission_lock:
+        if not _admission_configured:
+            _admission_configured = True
+            try:
+                budget_mb = optional_float(os.environ.get(ADMISSION_MEMORY_MB_ENV))
+                limit_mb = optional_float(os.environ.get(MEMORY_LIMIT_MB_ENV))
+            except ValueError:
+                logging.error(
+                    "Invalid %s or %s.", ADMISSION_MEMORY_MB_ENV, MEMORY_LIMIT_MB_ENV
+                )
+                budget_mb = limit_mb = None
+            if budget_mb is None and limit_mb is not None:
+                budget_mb = limit_mb * ADMISSION_MEMORY_SHARE
+            if budget_mb:
+                _admission = MemoryAdmission(int(budget_mb * 1024 * 1024))
+                observe(
+                    "gcf.admission",
+                    _admission.stats,
+                    "Admitted and rejected requests and their reserved memory.",
+                )
+        return _admission
+
+
+def reset_memory_admission() -> None:
+    global _admission, _admission_configured
+    with _admission_lock:
+        _admission = None
+        _admission_configured = False
+
+
+@contextlib.contextmanager
+def admitted(size: int) -> Iterator[None]:
+    """Runs the enclosed request with <size> bytes of the instance memory reserved.
+
+    The request waits for the memory at most ADMISSION_TIMEOUT seconds and not
+    beyond the invocation deadline.
+
+    Raises:
+        AdmissionRejected: the memory wasn't released by other requests in time.
+    """
+    admission = get_memory_admission()
+    if admission is None:
+        yield
+        return
+    try:
+        timeout = float(
+            os.environ.get(ADMISSION_TIMEOUT_ENV, ADMISSION_TIMEOUT_DEFAULT)
+        )
+    except ValueError:
+        timeout = ADMISSION_TIMEOUT_DEFAULT
+    timeout = max(0.0, min(timeout, invocation_deadline() - time.monotonic()))
+    with contextlib.ExitStack() as reservation:
+        with stage("admission", memory_reserved=size):
+            reservation.enter_context(admission.reserve(size, timeout))
+        yield
+
+
+def request_memory(request: Request) -> int:
+    """Returns memory the HTTP request is expected to use, for admission control."""
+    if request.method == "POST":
+        # bodies without Content-Length are read up to the largest accepted image
+        body_size = request.content_length or upload_size_max()
+        return REQUEST_MEMORY_BASE + body_size * IMAGE_MEMORY_FACTOR
+    if request.args.get("size"):
+        return REQUEST_MEMORY_BASE + THUMBNAIL_MEMORY
+    return REQUEST_MEMORY_BASE
+
+
+def overloaded_response() -> Response:
+    """Response asking the client to retry when the instance is out of memory."""
+    response = make_response("Too many concurrent requests, retry later.", 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+def reset_instance_state() -> None:
+    """Drops configuration, clients, caches and indexes kept by this instance."""
+    reset_config()
+    reset_clients()
+    reset_memory_admission()
+    reset_processed_events()
+    reset_vision_rate_limiter()
+    reset_annotation_caches()
+    reset_single_flight()
+    reset_near_duplicate_indexes()
+    reset_manifests()
+    reset_search_indexes()
+    reset_telemetry()
+
+
+def gcs_blob(bucket_name: str, file_name: str) -> storage.Blob:
+    """Returns blob reference using the shared GCS client."""
+    return get_storage_client().bucket(bucket_name).blob(file_name)
+
+
+def gcs_blob_metadata(bucket_name: str, file_name: str) -> Optional[storage.Blob]:
+    """Returns blob with loaded metadata (size, MD5, ...), None if it doesn't exist."""
+    try:
+        return get_storage_client().bucket(bucket_name).get_blob(file_name)
+    except exceptions.GoogleAPICallError:
+        return None
+
+
+def execute_annotate_request(request: vision.AnnotateImageRequest) -> str:
+    """Executes annotation request using a pooled Vision client.
+
+    Args:
+        request: Vision annotation request.
+
+    Returns:
+        string: JSON with annotations built from vision.AnnotateImageResponse
+    """
+    response = call_vision(
+        lambda vision_client, timeout: vision_client.annotate_image(
+            request, timeout=timeout
+        )
+    )
+    json_string = type(response).to_json(response)
+    return json_string
+
+
+@traced("read_vision_image_from_gcs")
 def read_vision_image_from_gcs(
     bucket_name: str, file_name: str
 ) -> Optional[vision.Image]:
@@ -74,17 +875,41 @@ def read_vision_image_from_gcs(
     """
 
     logging.info(f"Reading image {bucket_name}/{file_name}")
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
-    with blob.open("rb") as fp:
-        content = fp.read()
+    blob = gcs_blob_metadata(bucket_name, file_name)
+    if blob is None:
+        return None
+    set_attributes(image_size=blob.size)
+    if not image_size_allowed(blob.size):
+        logging.error(f"Image {bucket_name}/{file_name} is too large: {blob.size}")
+        return None
+    # single download buffer, size is checked from the metadata before downloading
+    content = blob.download_as_bytes()
     if content:
         image = vision.Image(content=content)
         return image
     return None
 
 
+def vision_image_for_gcs(bucket_name: str, file_name: str) -> vision.Image:
+    """Returns Vision image referencing GCS object, Vision API reads it directly."""
+    vision_image = vision.Image()
+    vision_image.source.image_uri = gcs_uri(bucket_name, file_name)
+    return vision_image
+
+
+def max_image_size() -> int:
+    """Returns max. size of image which is accepted for annotation."""
+    try:
+        return int(os.environ.get(MAX_IMAGE_SIZE_ENV, VISION_IMAGE_SIZE_MAX))
+    except ValueError:
+        return VISION_IMAGE_SIZE_MAX
+
+
+def image_size_allowed(size) -> bool:
+    """Checks image size (an int or a string, as in event data) against the limit."""
+    return size is None or int(size) <= max_image_size()
+
+
 def get_all_vision_features() -> List[Dict[str, vision.Feature.Type]]:
     """Gets a list of all Vision features.
 
@@ -94,6 +919,12 @@ def get_all_vision_features() -> List[Dict[str, vision.Feature.Type]]:
     return [{"type_": feature} for feature in vision.Feature.Type if feature != 0]
 
 
+@functools.lru_cache(maxsize=1)
+def vision_features_by_name() -> Dict[str, vision.Feature.Type]:
+    """Returns all Vision features by name, built once per instance."""
+    return {feature.name: feature for feature in vision.Feature.Type}
+
+
 def get_feature_by_name(feature_name: str) -> Optional[vision.Feature.Type]:
     """Gets a vision feature if it exists.
 
@@ -104,10 +935,7 @@ def get_feature_by_name(feature_name: str) -> Optional[vision.Feature.Type]:
         feature: a vision.Feature.Type matching name.
     """
 
-    for feature in vision.Feature.Type:
-        if feature.name == feature_name:
-            return feature
-    return None
+    return vision_features_by_name().get(feature_name)
 
 
 def build_features_list(feature_names: str) -> Optional[list]:
@@ -120,169 +948,2004 @@ def build_features_list(feature_names: str) -> Optional[list]:
         list: a list of vision.Feature.Type matching names in the input.
     """
 
-    features_list = []
-    features_items = feature_names.split(",")
-    for feature_name in features_items:
-        feature = get_feature_by_name(feature_name.upper().strip('"').strip())
-        if feature:
-            features_list.append({"type_": feature})
-    return features_list
+    return list(parse_features(feature_names).features)
 
 
-def annotate_image_uri(image_uri: str, detect_features: Optional[list] = None) -> str:
+def annotate_image_uri(
+    image_uri: str,
+    detect_features: Optional[list] = None,
+    image_context: Optional[vision.ImageContext] = None,
+) -> str:
     """Calculate annotations for the image referenced by the URI.
 
     Args:
         image_uri: URI pointing to the image
         detect_features: a list of Vision Feature Types
+        image_context: optional Vision ImageContext (language hints etc.)
+
+    Returns:
+        string: JSON with annotations built from vision.AnnotateImageResponse
+    """
+
+    logging.info("Annotate image: %s", image_uri)
+    logging.info("Building Vision Image object.")
+    vision_image = vision.Image()
+    vision_image.source.image_uri = image_uri
+    logging.info("Building Request")
+    request = vision.AnnotateImageRequest(
+        image=vision_image, features=detect_features, image_context=image_context
+    )
+    logging.info("Annotating image.")
+    with stage("annotate_image", feature_count=len(detect_features or [])):
+        return execute_annotate_request(request)
+
+
+def annotate_image(
+    vision_image: vision.Image,
+    detect_features: Optional[list] = None,
+    image_context: Optional[vision.ImageContext] = None,
+) -> str:
+    """Calculate annotations for the image referenced by URI.
+
+    Args:
+        image: a Vision Image object containing image data.
+        detect_features: a list of Vision Feature Types
+        image_context: optional Vision ImageContext (language hints etc.)
+
+    Returns:
+        string: JSON with annotations built from vision.AnnotateImageResponse
+    """
+    logging.info("annotate_image()")
+    logging.info("Building Request")
+    request = vision.AnnotateImageRequest(
+        image=vision_image, features=detect_features, image_context=image_context
+    )
+    logging.info("Annotating image.")
+    with stage(
+        "annotate_image",
+        feature_count=len(detect_features or []),
+        image_size=len(vision_image.content) or None,
+    ):
+        return execute_annotate_request(request)
+
+
+def annotate_image_content(
+    content: bytes,
+    detect_features: Optional[list] = None,
+    image_context: Optional[vision.ImageContext] = None,
+    max_dimension: Optional[int] = None,
+) -> str:
+    """Annotates the image, downscaled first if it's larger than <max_dimension> pixels.
+
+    Coordinates in annotations of a downscaled image are scaled back to the original.
+
+    Returns:
+        string: JSON with annotations built from vision.AnnotateImageResponse
+    """
+    downscaled = None
+    if max_dimension:
+        with stage("downscale_image", image_size=len(content)) as downscale_stage:
+            downscaled = downscale(content, max_dimension)
+            if downscaled:
+                downscale_stage.set(downscaled_size=len(downscaled[0]))
+    if downscaled is None:
+        return annotate_image(
+            vision.Image(content=content), detect_features, image_context
+        )
+    image_bin, scale_x, scale_y = downscaled
+    json_result = annotate_image(
+        vision.Image(content=image_bin), detect_features, image_context
+    )
+    annotation = json.loads(json_result)
+    if "error" in annotation:
+        return json_result
+    rescale_annotation(annotation, scale_x, scale_y)
+    return json.dumps(annotation, indent=2)
+
+
+@traced("batch_annotate_images")
+def batch_annotate_images(
+    requests: List[vision.AnnotateImageRequest],
+) -> List[vision.AnnotateImageResponse]:
+    """Annotates images with BatchAnnotateImages requests.
+
+    Requests are split into chunks of VISION_BATCH_SIZE_MAX images.
+    Failure of an individual image is reported in the error field of its response.
+
+    Args:
+        requests: a list of Vision annotation requests.
+
+    Returns:
+        list: responses, in the same order as requests.
+    """
+    set_attributes(image_count=len(requests))
+    responses = []
+    for start in range(0, len(requests), VISION_BATCH_SIZE_MAX):
+        end = start + VISION_BATCH_SIZE_MAX
+        chunk = requests[start:end]
+        logging.info("Annotating batch of %s images.", len(chunk))
+        # retries are done by call_vision, not by the client
+        batch_response = call_vision(
+            lambda vision_client, timeout: vision_client.batch_annotate_images(
+                requests=chunk, timeout=timeout, retry=None
+            ),
+            tokens=len(chunk),
+        )
+        responses.extend(batch_response.responses)
+    return responses
+
+
+def rpc_status_code(error: Exception) -> int:
+    """Returns google.rpc.Code of an API call error, UNKNOWN for other errors."""
+    status_code = getattr(error, "grpc_status_code", None)
+    return status_code.value[0] if status_code else 2
+
+
+def error_response(code: int, message: str) -> vision.AnnotateImageResponse:
+    """Builds an annotation response reporting an error for a single image."""
+    return vision.AnnotateImageResponse(error={"code": code, "message": message})
+
+
+def annotate_batch_group(requests: List[vision.AnnotateImageRequest]) -> List[str]:
+    """Annotates a group of images with one BatchAnnotateImages call.
+
+    A failed call is reported in the error field of every image in the group.
+
+    Returns:
+        list: compact JSON of AnnotateImageResponse for each request, in order.
+    """
+    try:
+        responses = batch_annotate_images(requests)
+    except exceptions.GoogleAPICallError as e:
+        logging.error("Batch annotation of %s images failed: %s", len(requests), e)
+        responses = [error_response(rpc_status_code(e), str(e))] * len(requests)
+    except RateLimitTimeout as e:
+        logging.error("Batch annotation of %s images timed out: %s", len(requests), e)
+        # google.rpc.Code DEADLINE_EXCEEDED
+        responses = [error_response(4, str(e))] * len(requests)
+    return [
+        vision.AnnotateImageResponse.to_json(response, indent=None)
+        for response in responses
+    ]
+
+
+def annotate_images_concurrently(
+    requests: List[Optional[Any]],
+    parallelism: int,
+    rejected: Optional[Dict[int, str]] = None,
+) -> Iterator[Tuple[int, str]]:
+    """Annotates images in groups of VISION_BATCH_SIZE_MAX, <parallelism> groups at a time.
+
+    Args:
+        requests: Vision requests, or functions returning them, None for items
+            which were rejected. Functions are called when the group of their item
+            is submitted, so that only images of the running groups are in memory.
+        parallelism: max. number of concurrent BatchAnnotateImages calls.
+        rejected: item index -> JSON of the error response of a rejected item.
+
+    Yields:
+        tuple: index of the request and JSON of its response, as groups complete.
+    """
+    rejected = rejected or {}
+    for index in sorted(rejected):
+        yield index, rejected[index]
+    indexes = [i for i, request in enumerate(requests) if request is not None]
+    groups = []
+    for start in range(0, len(indexes), VISION_BATCH_SIZE_MAX):
+        end = start + VISION_BATCH_SIZE_MAX
+        groups.append(indexes[start:end])
+    if not groups:
+        return
+    workers = max(1, min(parallelism, len(groups)))
+    next_groups = iter(groups)
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="batch"
+    ) as executor:
+
+        def submit(group: List[int]) -> Future:
+            group_requests = [
+                request() if callable(request) else request
+                for request in (requests[i] for i in group)
+            ]
+            return executor.submit(
+                contextvars.copy_context().run, annotate_batch_group, group_requests
+            )
+
+        # a new group is submitted when one completes, not all of them upfront
+        futures = {
+            submit(group): group for group in itertools.islice(next_groups, workers)
+        }
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = futures.pop(future)
+                for next_group in itertools.islice(next_groups, 1):
+                    futures[submit(next_group)] = next_group
+                yield from zip(group, future.result())
+
+
+class AnnotationBatcher:
+    """Collects concurrent annotation requests into BatchAnnotateImages calls.
+
+    The first request of a batch waits up to <window> seconds for other requests,
+    the batch is sent earlier when it reaches <max_size> images.
+    Every caller receives only the response for its own image.
+    """
+
+    class _Batch:
+        def __init__(self):
+            self.requests: List[vision.AnnotateImageRequest] = []
+            self.full = threading.Event()
+            self.result: Future = Future()
+
+    def __init__(self, window: float, max_size: int = VISION_BATCH_SIZE_MAX):
+        self.window = window
+        self.max_size = max(1, min(max_size, VISION_BATCH_SIZE_MAX))
+        self._lock = threading.Lock()
+        self._current: Optional[AnnotationBatcher._Batch] = None
+
+    def annotate(
+        self, request: vision.AnnotateImageRequest
+    ) -> vision.AnnotateImageResponse:
+        """Adds request to the current batch and waits for its response."""
+        with self._lock:
+            leader = self._current is None
+            if leader:
+                self._current = AnnotationBatcher._Batch()
+            batch = self._current
+            index = len(batch.requests)
+            batch.requests.append(request)
+            if len(batch.requests) >= self.max_size:
+                self._current = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._current is batch:
+                    self._current = None
+            try:
+                batch.result.set_result(batch_annotate_images(batch.requests))
+            except Exception as e:
+                batch.result.set_exception(e)
+        return batch.result.result()[index]
+
+
+_batcher_lock = threading.Lock()
+_batcher: Optional[AnnotationBatcher] = None
+
+
+def get_annotation_batcher() -> Optional[AnnotationBatcher]:
+    """Returns the instance batcher, None when batching is disabled.
+
+    Batching is enabled by setting BATCH_WINDOW_MS to a positive number of milliseconds.
+    It only pays off when the function instance handles concurrent events.
+    """
+    global _batcher
+    try:
+        window_ms = int(os.environ.get(BATCH_WINDOW_MS_ENV, 0))
+        max_size = int(os.environ.get(BATCH_SIZE_ENV, VISION_BATCH_SIZE_MAX))
+    except ValueError:
+        logging.error("Invalid %s or %s.", BATCH_WINDOW_MS_ENV, BATCH_SIZE_ENV)
+        return None
+    if window_ms <= 0:
+        return None
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = AnnotationBatcher(window_ms / 1000.0, max_size)
+        return _batcher
+
+
+# ------- Single-flight ------
+
+_single_flight_lock = threading.Lock()
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """Returns the instance group of annotations in flight."""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+            observe(
+                "gcf.single_flight",
+                _single_flight.stats,
+                "Annotations executed and shared by concurrent identical requests.",
+            )
+        return _single_flight
+
+
+def reset_single_flight() -> None:
+    global _single_flight
+    with _single_flight_lock:
+        _single_flight = None
+
+
+def coalesced(key: Optional[Hashable], annotate: Callable[[], T]) -> Tuple[T, bool]:
+    """Runs annotate(), or shares the result of a concurrent call with the same key.
+
+    A request waiting for the call of another request gives up at its
+    invocation deadline. Errors of the call are raised in all requests sharing it.
+
+    Args:
+        key: identifies the image and the annotation options, None to not share the call
+        annotate: function annotating the image
+
+    Returns:
+        tuple: the result and True if this request ran annotate().
+
+    Raises:
+        SingleFlightTimeout: the shared call didn't finish before the deadline.
+    """
+    if key is None:
+        return annotate(), True
+    timeout = max(0.0, invocation_deadline() - time.monotonic())
+    result, leader = get_single_flight().do(key, annotate, timeout)
+    set_attributes(coalesced=not leader)
+    return result, leader
+
+
+# ------- Annotation cache ------
+
+
+class GcsCacheStore:
+    """Persistent tier of the annotation cache, objects in the annotations bucket."""
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+
+    def get(self, key: str) -> Optional[str]:
+        blob = gcs_blob(self.bucket_name, CACHE_PREFIX + key + ".json")
+        try:
+            return blob.download_as_bytes().decode("utf-8")
+        except exceptions.NotFound:
+            return None
+        except exceptions.GoogleAPICallError as e:
+            # the image is annotated as if it wasn't cached
+            logging.warning(f"Cached annotation {key} could not be read: {e}")
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        try:
+            gcs_write(self.bucket_name, CACHE_PREFIX + key + ".json", value)
+        except exceptions.GoogleAPICallError as e:
+            logging.warning(f"Annotation {key} could not be cached: {e}")
+
+
+_annotation_caches_lock = threading.Lock()
+_annotation_caches: Dict[Optional[str], AnnotationCache] = {}
+
+
+def get_annotation_cache(
+    annotations_bucket: Optional[str],
+) -> Optional[AnnotationCache]:
+    """Returns the instance annotation cache, None when caching is disabled.
+
+    ANNOTATION_CACHE selects the cache tiers: "none", "memory" (default) or "gcs".
+    The GCS tier keeps the results under _vision/cache/ in the annotations bucket,
+    so they are shared by all instances.
+    """
+    mode = os.environ.get(ANNOTATION_CACHE_ENV, ANNOTATION_CACHE_MEMORY).lower()
+    if mode not in (ANNOTATION_CACHE_MEMORY, ANNOTATION_CACHE_GCS):
+        return None
+    store_bucket = annotations_bucket if mode == ANNOTATION_CACHE_GCS else None
+    with _annotation_caches_lock:
+        cache = _annotation_caches.get(store_bucket)
+        if cache is None:
+            try:
+                cache = AnnotationCache(
+                    max_entries=int(
+                        os.environ.get(ANNOTATION_CACHE_MAX_ENTRIES_ENV, 256)
+                    ),
+                    max_bytes=int(
+                        os.environ.get(ANNOTATION_CACHE_MAX_BYTES_ENV, 32 * 1024 * 1024)
+                    ),
+                    ttl=float(os.environ.get(ANNOTATION_CACHE_TTL_ENV, 3600)),
+                    store=GcsCacheStore(store_bucket) if store_bucket else None,
+                )
+            except ValueError:
+                logging.error("Invalid annotation cache configuration.")
+                return None
+            _annotation_caches[store_bucket] = cache
+        return cache
+
+
+def reset_annotation_caches() -> None:
+    """Drops all cached annotations."""
+    with _annotation_caches_lock:
+        _annotation_caches.clear()
+
+
+def content_md5(content: bytes) -> str:
+    """Returns base64 encoded MD5 of the content, the format GCS uses for md5_hash."""
+    return base64.b64encode(hashlib.md5(content).digest()).decode("ascii")
+
+
+def gcs_object_md5(bucket_name: str, file_name: str) -> Optional[str]:
+    """Returns MD5 of GCS object from its metadata, without downloading it."""
+    blob = gcs_blob_metadata(bucket_name, file_name)
+    if blob is None or not isinstance(blob.md5_hash, str):
+        # composite objects don't have MD5
+        return None
+    return blob.md5_hash
+
+
+def normalize_features(features_list: Optional[list]) -> str:
+    """Returns canonical string of the feature list, independent of the order."""
+    items = set()
+    for feature in features_list or []:
+        fields = dict(feature)
+        item = vision.Feature.Type(fields.pop("type_")).name
+        for name in sorted(fields):
+            item += f";{name}={fields[name]}"
+        items.add(item)
+    return ",".join(sorted(items))
+
+
+def annotation_cache_key(
+    digest: Optional[str],
+    features_list: Optional[list],
+    image_context: Optional[vision.ImageContext] = None,
+    max_dimension: Optional[int] = None,
+) -> Optional[str]:
+    """Returns cache key for image content digest, requested features and context.
+
+    Annotations of images downscaled to <max_dimension> are cached separately.
+    """
+    if not digest:
+        return None
+    key = f"{digest}|{normalize_features(features_list)}"
+    if image_context:
+        key += "|" + vision.ImageContext.to_json(
+            image_context, indent=None, sort_keys=True
+        )
+    if max_dimension:
+        key += f"|{max_dimension}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def annotation_has_error(json_result: str) -> bool:
+    """Checks if annotation JSON contains an error returned by Vision API."""
+    return json_result.find('"error"') > 0 and json_result.find('"code":') > 0
+
+
+def lookup_cached_annotation(
+    cache_key: Optional[str], annotations_bucket: Optional[str]
+) -> Optional[str]:
+    """Returns cached annotation JSON or None."""
+    cache = get_annotation_cache(annotations_bucket)
+    if cache is None or cache_key is None:
+        return None
+    with stage("lookup_cached_annotation") as lookup:
+        json_result = cache.get(cache_key)
+        lookup.set(cache_hit=json_result is not None)
+    logging.info(
+        "Annotation cache %s: %s", "hit" if json_result else "miss", cache.stats()
+    )
+    return json_result
+
+
+def store_cached_annotation(
+    cache_key: Optional[str],
+    json_result: Optional[str],
+    annotations_bucket: Optional[str],
+) -> None:
+    """Stores successful annotation result in the cache."""
+    cache = get_annotation_cache(annotations_bucket)
+    if cache is None or cache_key is None or not json_result:
+        return
+    if annotation_has_error(json_result):
+        return
+    cache.put(cache_key, json_result)
+
+
+# ------- Near-duplicate images ------
+
+_near_duplicates_lock = threading.Lock()
+_near_duplicates: Dict[Tuple[str, str], NearDuplicateIndex] = {}
+
+
+def get_near_duplicate_index(annotations_bucket: str) -> Optional[NearDuplicateIndex]:
+    """Returns perceptual hashes of annotated images, None when reuse is disabled.
+
+    NEAR_DUPLICATE_DISTANCE sets the max. Hamming distance of 64-bit hashes of
+    images sharing annotations, e.g. 4. Hashes are kept under _vision/phash/
+    in the annotations bucket, separately for every annotation configuration.
+    """
+    distance = os.environ.get(NEAR_DUPLICATE_DISTANCE_ENV)
+    if not distance:
+        return None
+    try:
+        max_distance = int(distance)
+        ttl = float(os.environ.get(MANIFEST_TTL_ENV, MANIFEST_TTL_DEFAULT))
+    except ValueError:
+        logging.error(
+            "Invalid %s or %s.", NEAR_DUPLICATE_DISTANCE_ENV, MANIFEST_TTL_ENV
+        )
+        return None
+    if max_distance < 0:
+        return None
+    fingerprint = get_config().fingerprint
+    with _near_duplicates_lock:
+        index = _near_duplicates.get((annotations_bucket, fingerprint))
+        if index is None:
+            index = NearDuplicateIndex(
+                ShardedJsonStore(
+                    lambda: get_storage_client().bucket(annotations_bucket),
+                    f"{NEAR_DUPLICATE_PREFIX}{fingerprint}/",
+                    num_shards=NEAR_DUPLICATE_SHARDS,
+                    ttl=ttl,
+                ),
+                max_distance,
+            )
+            observe(
+                "gcf.near_duplicates",
+                index.stats,
+                "Lookups and hits of near-duplicate images.",
+            )
+            _near_duplicates[(annotations_bucket, fingerprint)] = index
+        return index
+
+
+def reset_near_duplicate_indexes() -> None:
+    with _near_duplicates_lock:
+        _near_duplicates.clear()
+
+
+@traced("find_near_duplicate")
+def find_near_duplicate(
+    index: NearDuplicateIndex,
+    annotations_bucket: str,
+    content: bytes,
+) -> Tuple[Optional[ImageHash], Optional[str]]:
+    """Finds annotation of a resized or re-encoded copy of the image.
+
+    The annotation is reused only if it was made for the hashed version of the
+    copy with the current configuration, its coordinates are scaled to the image.
+
+    Returns:
+        tuple: hash of the image (None if it can't be decoded) and the annotation
+            JSON (None if there is no near-duplicate).
+    """
+    with stage("perceptual_hash", image_size=len(content)):
+        image_hash = perceptual_hash(content)
+    if image_hash is None:
+        return None, None
+    with stage("near_duplicate_lookup") as lookup:
+        found = index.lookup(image_hash)
+        lookup.set(cache_hit=found is not None)
+    if found is None:
+        return image_hash, None
+    image_name, entry, distance = found
+    set_attributes(near_duplicate_distance=distance)
+    annotation_blob = gcs_blob_metadata(
+        annotations_bucket, json_filename_for_image(image_name)
+    )
+    metadata = (annotation_blob.metadata if annotation_blob else None) or {}
+    if metadata.get(ANNOTATION_CONFIG_METADATA) != get_config().fingerprint or str(
+        metadata.get(SOURCE_GENERATION_METADATA)
+    ) != str(entry[3]):
+        logging.info(f"Annotation of near-duplicate {image_name} is not current.")
+        return image_hash, None
+    try:
+        annotation = json.loads(
+            decode_stored_json(
+                annotation_blob.download_as_bytes(
+                    if_generation_match=annotation_blob.generation
+                )
+            )
+        )
+    except (exceptions.GoogleAPICallError, ValueError) as e:
+        logging.warning(f"Annotation of near-duplicate {image_name} not read: {e}")
+        return image_hash, None
+    rescale_annotation(
+        annotation, image_hash.width / entry[1], image_hash.height / entry[2]
+    )
+    logging.info(
+        f"Reusing annotation of {image_name}, hash distance {distance}: {index.stats()}"
+    )
+    return image_hash, json.dumps(annotation, indent=2)
+
+
+def record_near_duplicate(
+    index: NearDuplicateIndex, image_file_name: str, image_hash: ImageHash, generation
+) -> None:
+    """Adds hash of an image annotated by Vision API to the index."""
+    try:
+        index.add(image_file_name, image_hash, generation)
+    except (exceptions.GoogleAPICallError, RuntimeError) as e:
+        # the image is only not found as a near-duplicate of its copies
+        logging.error(f"Perceptual hash of {image_file_name} not stored: {e}")
+
+
+# ------- Annotations manifest ------
+
+_manifests_lock = threading.Lock()
+_manifests: Dict[str, ShardedJsonStore] = {}
+
+
+def get_manifest(annotations_bucket: str) -> ShardedJsonStore:
+    """Returns manifest of annotated images: image name -> generation of the image.
+
+    The manifest is kept in MANIFEST_SHARDS objects under _vision/manifest/ in the
+    annotations bucket, annotate_gcs adds images to it incrementally.
+    The number of shards must not change after the manifest was built.
+    """
+    with _manifests_lock:
+        manifest = _manifests.get(annotations_bucket)
+        if manifest is None:
+            try:
+                num_shards = int(
+                    os.environ.get(MANIFEST_SHARDS_ENV, MANIFEST_SHARDS_DEFAULT)
+                )
+                ttl = float(os.environ.get(MANIFEST_TTL_ENV, MANIFEST_TTL_DEFAULT))
+            except ValueError:
+                logging.error(
+                    "Invalid %s or %s.", MANIFEST_SHARDS_ENV, MANIFEST_TTL_ENV
+                )
+                num_shards, ttl = MANIFEST_SHARDS_DEFAULT, MANIFEST_TTL_DEFAULT
+            manifest = ShardedJsonStore(
+                lambda: get_storage_client().bucket(annotations_bucket),
+                MANIFEST_PREFIX,
+                num_shards=num_shards,
+                ttl=ttl,
+            )
+            _manifests[annotations_bucket] = manifest
+        return manifest
+
+
+def reset_manifests() -> None:
+    with _manifests_lock:
+        _manifests.clear()
+
+
+def record_annotation(
+    annotations_bucket: str, image_file_name: str, generation=None
+) -> None:
+    """Adds annotated image to the manifest.
+
+    Nothing is recorded until the manifest was built by rebuild_manifest(),
+    the image is found by the listing of annotations until then.
+    """
+    try:
+        manifest = get_manifest(annotations_bucket)
+        if manifest.ready():
+            manifest.put(image_file_name, int(generation or 0))
+    except (exceptions.GoogleAPICallError, RuntimeError) as e:
+        # the annotation is stored, rebuild_manifest() fixes the manifest later
+        logging.error(f"Manifest update for {image_file_name} failed: {e}")
+
+
+def rebuild_manifest(annotations_bucket: str) -> int:
+    """Builds the manifest from the content of the annotations bucket.
+
+    Called at the end of a backfill or by annotate_backfill with manifest_only=true.
+    Images annotated while the bucket is listed are kept in the manifest.
+
+    Returns:
+        int: number of annotated images.
+    """
+    annotation_blobs = list_bucket(annotations_bucket, None)
+
+    def annotated_images():
+        for annotation_blob in annotation_blobs or []:
+            name = annotation_blob.name
+            if name.startswith(INTERNAL_PREFIX) or not name.endswith(".json"):
+                continue
+            yield image_filename_for_json(name), 0
+
+    count = get_manifest(annotations_bucket).write_all(
+        annotated_images(), {"updated": time.time()}
+    )
+    logging.info(f"Manifest of {annotations_bucket} rebuilt, {count} images.")
+    return count
+
+
+def annotated_images(
+    annotations_bucket: str, image_names: List[str]
+) -> Optional[Set[str]]:
+    """Returns names of images from the list which have annotations.
+
+    Uses the manifest when it was built, otherwise lists annotations
+    in the range of the image names, without the internal objects under _vision/.
+    """
+    manifest = get_manifest(annotations_bucket)
+    if manifest.ready():
+        manifest.prefetch(image_names)
+        return set(name for name in image_names if manifest.contains(name))
+    if not image_names:
+        return set()
+    first_json = json_filename_for_image(min(image_names))
+    last_json = json_filename_for_image(max(image_names))
+    # the first name after all names starting with INTERNAL_PREFIX
+    internal_end = INTERNAL_PREFIX[:-1] + chr(ord(INTERNAL_PREFIX[-1]) + 1)
+    ranges: List[Tuple[str, Optional[str]]] = [(first_json, None)]
+    if first_json < internal_end and INTERNAL_PREFIX <= last_json:
+        ranges = [(first_json, INTERNAL_PREFIX), (internal_end, None)]
+    annotation_names = set()
+    for start_offset, end_offset in ranges:
+        annotation_blobs = list_bucket(
+            annotations_bucket, None, start_offset=start_offset, end_offset=end_offset
+        )
+        if annotation_blobs is None:
+            return None
+        try:
+            for annotation_blob in annotation_blobs:
+                if annotation_blob.name > last_json:
+                    break
+                annotation_names.add(annotation_blob.name)
+        except exceptions.GoogleAPICallError:
+            return None
+    return set(
+        name
+        for name in image_names
+        if json_filename_for_image(name) in annotation_names
+    )
+
+
+# ------- Search index ------
+
+_search_indexes_lock = threading.Lock()
+_search_indexes: Dict[str, SearchIndex] = {}
+
+
+def get_search_index(annotations_bucket: str) -> SearchIndex:
+    """Returns inverted index of annotation terms (labels, objects, text, ...).
+
+    The index is kept in SEARCH_INDEX_SHARDS objects under _vision/search/ in the
+    annotations bucket, annotate_gcs updates it incrementally once it was built.
+    The number of shards must not change after the index was built.
+    """
+    with _search_indexes_lock:
+        index = _search_indexes.get(annotations_bucket)
+        if index is None:
+            try:
+                num_shards = int(
+                    os.environ.get(SEARCH_INDEX_SHARDS_ENV, SEARCH_INDEX_SHARDS_DEFAULT)
+                )
+                ttl = float(os.environ.get(MANIFEST_TTL_ENV, MANIFEST_TTL_DEFAULT))
+            except ValueError:
+                logging.error(
+                    "Invalid %s or %s.", SEARCH_INDEX_SHARDS_ENV, MANIFEST_TTL_ENV
+                )
+                num_shards, ttl = SEARCH_INDEX_SHARDS_DEFAULT, MANIFEST_TTL_DEFAULT
+
+            def get_bucket():
+                return get_storage_client().bucket(annotations_bucket)
+
+            index = SearchIndex(
+                ShardedJsonStore(
+                    get_bucket, SEARCH_TERMS_PREFIX, num_shards=num_shards, ttl=ttl
+                ),
+                ShardedJsonStore(
+                    get_bucket, SEARCH_DOCS_PREFIX, num_shards=num_shards, ttl=ttl
+                ),
+                executor=get_io_executor(),
+            )
+            _search_indexes[annotations_bucket] = index
+        return index
+
+
+def reset_search_indexes() -> None:
+    with _search_indexes_lock:
+        _search_indexes.clear()
+
+
+@traced("index_annotation")
+def index_annotation(
+    annotations_bucket: str, image_file_name: str, json_result: str
+) -> None:
+    """Replaces terms of the image in the search index.
+
+    Nothing is indexed until the index was built by rebuild_search_index().
+    """
+    try:
+        index = get_search_index(annotations_bucket)
+        if index.ready():
+            terms = annotation_terms(json.loads(json_result))
+            set_attributes(term_count=len(terms))
+            index.update(image_file_name, terms)
+    except (exceptions.GoogleAPICallError, RuntimeError, ValueError) as e:
+        # the annotation is stored, rebuild_search_index() fixes the index later
+        logging.error(f"Search index update for {image_file_name} failed: {e}")
+
+
+def rebuild_search_index(annotations_bucket: str) -> Dict[str, int]:
+    """Builds the search index from the annotations stored in the bucket.
+
+    Called at the end of a backfill of an indexed bucket, or by annotate_backfill
+    with search_index=true. Annotations are read SEARCH_REBUILD_CHUNK at a time.
+
+    Returns:
+        dict: numbers of indexed images and of annotations which couldn't be read.
+    """
+    annotation_blobs = list_bucket(annotations_bucket, None)
+    failed = 0
+
+    def indexed_images():
+        nonlocal failed
+        annotation_names = (
+            annotation_blob.name
+            for annotation_blob in annotation_blobs or []
+            if not annotation_blob.name.startswith(INTERNAL_PREFIX)
+            and annotation_blob.name.endswith(".json")
+        )
+        while chunk := list(itertools.islice(annotation_names, SEARCH_REBUILD_CHUNK)):
+            contents, chunk_failed = read_json_files(
+                annotations_bucket, chunk, SEARCH_REBUILD_READ_TIMEOUT
+            )
+            failed += chunk_failed
+            for annotation_name, annotation in contents.items():
+                if isinstance(annotation, dict):
+                    yield image_filename_for_json(annotation_name), annotation_terms(
+                        annotation
+                    )
+
+    count = get_search_index(annotations_bucket).rebuild(
+        indexed_images(), {"updated": time.time()}
+    )
+    logging.info(
+        f"Search index of {annotations_bucket} rebuilt, {count} images, {failed} failed."
+    )
+    return {"indexed": count, "failed": failed}
+
+
+def search_images(annotations_bucket: str, request: Request) -> Response:
+    """Finds annotated images matching the <q> query, best matches first.
+
+    Query words match labels, objects, landmarks, logos and detected text,
+    a word can be limited to one of them, e.g. "label:dog text:menu".
+    Every word must match. <min_score> drops terms of lower confidence.
+    Returns <limit> results from the <cursor>, the cursor of the next page
+    is returned in the X-Next-Cursor header.
+    """
+    query = request.args.get("q", "")
+    try:
+        offset = int(request.args.get("cursor") or 0)
+        page_size = int(request.args.get("limit") or SEARCH_PAGE_SIZE_DEFAULT)
+        min_score = float(request.args.get("min_score") or 0.0)
+    except ValueError:
+        return make_response("Invalid cursor, limit or min_score", 400)
+    if offset < 0 or not query.strip():
+        return make_response("Invalid query or cursor", 400)
+    page_size = max(1, min(page_size, SEARCH_PAGE_SIZE_MAX))
+    index = get_search_index(annotations_bucket)
+    try:
+        if not index.ready():
+            return make_response("Search index is not built.", 404)
+        with stage("search", page_size=page_size) as span:
+            results, total = index.search(query, min_score, offset, page_size)
+            span.set(result_count=len(results), total=total)
+    except exceptions.GoogleAPICallError as e:
+        logging.error(f"Search failed: {e}")
+        return make_response("Search index could not be read.", 503)
+    body = {
+        "total": total,
+        "results": [
+            {
+                "image": image_name,
+                "annotation": json_filename_for_image(image_name),
+                "score": score,
+            }
+            for image_name, score in results
+        ],
+    }
+    response = make_response(json.dumps(body, indent=2), 200)
+    response.mimetype = "application/json"
+    if offset + len(results) < total:
+        response.headers["X-Next-Cursor"] = str(offset + len(results))
+    response.headers["Access-Control-Expose-Headers"] = "X-Next-Cursor"
+    return response
+
+
+# ------- GCS ------
+
+
+@traced("gcs_write")
+def gcs_write(bucket_name, file_name, content):
+    """Write and read a blob from GCS using file-like IO.
+
+    Args:
+        bucket_name: name of the GCS bucket where content will be stored
+        file_name: name of the file
+        content: content to be stored into the file
+    """
+
+    set_attributes(object_size=len(content))
+    blob = gcs_blob(bucket_name, file_name)
+    # write the <content> into the file/blob
+    with blob.open("w") as fp:
+        fp.write(content)
+
+
+def drop_field(value, path: Tuple[str, ...]) -> None:
+    """Removes the field at JSON <path> from the value, in every item of lists on the way."""
+    if isinstance(value, list):
+        for item in value:
+            drop_field(item, path)
+    elif isinstance(value, dict) and path:
+        if len(path) == 1:
+            value.pop(path[0], None)
+        elif path[0] in value:
+            drop_field(value[path[0]], path[1:])
+
+
+def annotation_rows(image_file_name: str, annotation: dict) -> Iterator[dict]:
+    """Flattens an annotation into rows with the same columns, for analytics.
+
+    Every label, landmark, logo, object and face is a row, text is a single row
+    with the full detected text.
+    """
+    for field, row_type in NDJSON_ANNOTATION_TYPES.items():
+        items = annotation.get(field) or []
+        if field == "textAnnotations":
+            items = items[:1]
+        for item in items:
+            yield {
+                "image": image_file_name,
+                "type": row_type,
+                "description": item.get("description") or item.get("name"),
+                "mid": item.get("mid"),
+                "score": item.get("score", item.get("detectionConfidence")),
+            }
+
+
+@traced("write_annotation")
+def write_annotation(
+    annotations_bucket: str,
+    image_file_name: str,
+    json_result: str,
+    options: Optional[OutputOptions] = None,
+    source_metadata: Optional[Dict[str, str]] = None,
+    if_generation_match: Optional[int] = None,
+    annotations_file_name: Optional[str] = None,
+) -> None:
+    """Writes annotation JSON of the image, projected and encoded by the output options.
+
+    With the default options the JSON is written as returned by Vision API.
+
+    Args:
+        source_metadata: object metadata identifying the annotated image version.
+        if_generation_match: write only if the annotation object has this generation,
+            0 if it must not exist.
+        annotations_file_name: name of the annotation object, the JSON file name
+            of the image by default.
+
+    Raises:
+        google.api_core.exceptions.PreconditionFailed: the annotation object changed.
+    """
+    options = options or get_config().output
+    annotations_file_name = annotations_file_name or json_filename_for_image(
+        image_file_name
+    )
+    annotation = None
+    if options == OutputOptions():
+        data = json_result.encode("utf-8")
+    else:
+        annotation = json.loads(json_result)
+        for path in options.exclude:
+            drop_field(annotation, path)
+        if options.compact:
+            data = json.dumps(annotation, separators=(",", ":")).encode("utf-8")
+        else:
+            data = json.dumps(annotation, indent=2).encode("utf-8")
+    blob = gcs_blob(annotations_bucket, annotations_file_name)
+    if source_metadata:
+        blob.metadata = source_metadata
+    if options.gzip:
+        blob.content_encoding = "gzip"
+        data = gzip.compress(data)
+    set_attributes(object_size=len(data))
+    blob.upload_from_string(
+        data, content_type="application/json", if_generation_match=if_generation_match
+    )
+    if annotation is not None and options.ndjson:
+        rows = "".join(
+            json.dumps(row, separators=(",", ":")) + "\n"
+            for row in annotation_rows(image_file_name, annotation)
+        )
+        gcs_blob(
+            annotations_bucket, ndjson_filename_for_image(image_file_name)
+        ).upload_from_string(rows, content_type="application/x-ndjson")
+
+
+def decode_stored_json(data: bytes) -> bytes:
+    """Returns JSON bytes of an annotation object, decompressing gzip if needed.
+
+    GCS decompresses objects stored with Content-Encoding: gzip on download,
+    objects compressed without the metadata are detected by the gzip magic bytes.
+    """
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    return data
+
+
+def gcs_uri(bucket_name: str, file_name: str) -> str:
+    """Returns gs:// URI of the object."""
+    return f"gs://{bucket_name}/{file_name}"
+
+
+def json_filename_for_image(file_name: str) -> str:
+    """Returns name of the JSON file for source image file name."""
+    return file_name + ".json"
+
+
+def ndjson_filename_for_image(file_name: str) -> str:
+    """Returns name of the NDJSON sidecar file for source image file name."""
+    return NDJSON_PREFIX + file_name + ".ndjson"
+
+
+def image_filename_for_json(file_name: str) -> str:
+    """Returns name of the image file name for annotation JSON file name."""
+    path_items = os.path.splitext(file_name)
+    return path_items[0]
+
+
+# ------- Event idempotency ------
+
+_processed_events_lock = threading.Lock()
+_processed_events: OrderedDict[Tuple[str, str, Optional[str]], bool] = (
+    collections.OrderedDict()
+)
+
+
+def event_processed(event_id: str, name: str, generation: Optional[str]) -> bool:
+    """Checks if this instance already processed the event for the object generation."""
+    with _processed_events_lock:
+        return (event_id, name, generation) in _processed_events
+
+
+def mark_event_processed(event_id: str, name: str, generation: Optional[str]) -> None:
+    """Remembers a successfully processed event, the oldest ones are forgotten."""
+    key = (event_id, name, generation)
+    with _processed_events_lock:
+        _processed_events[key] = True
+        _processed_events.move_to_end(key)
+        while len(_processed_events) > PROCESSED_EVENTS_MAX:
+            _processed_events.popitem(last=False)
+
+
+def reset_processed_events() -> None:
+    with _processed_events_lock:
+        _processed_events.clear()
+
+
+def source_metadata(
+    generation, md5_hash: Optional[str], fingerprint: Optional[str] = None
+) -> Dict[str, str]:
+    """Returns annotation object metadata identifying the image version.
+
+    <fingerprint> identifies the configuration the annotation was made with,
+    see Config.fingerprint.
+    """
+    metadata = {}
+    if fingerprint:
+        metadata[ANNOTATION_CONFIG_METADATA] = fingerprint
+    if generation:
+        metadata[SOURCE_GENERATION_METADATA] = str(generation)
+    if md5_hash:
+        metadata[SOURCE_MD5_METADATA] = md5_hash
+    return metadata
+
+
+def annotation_is_current(
+    annotation_blob: Optional[storage.Blob],
+    generation,
+    md5_hash: Optional[str],
+    fingerprint: Optional[str] = None,
+) -> bool:
+    """Checks if the annotation object was made for this or a newer image version.
+
+    A newer image generation means this event arrived out of order. The same
+    generation or the same content MD5 (the image was rewritten without changes)
+    count only if the annotation was made with the same configuration <fingerprint>.
+    """
+    if annotation_blob is None:
+        return False
+    metadata = annotation_blob.metadata or {}
+    annotated_generation = metadata.get(SOURCE_GENERATION_METADATA)
+    if annotated_generation and generation:
+        if int(annotated_generation) > int(generation):
+            return True
+    if metadata.get(ANNOTATION_CONFIG_METADATA) != fingerprint:
+        return False
+    if annotated_generation and generation:
+        if int(annotated_generation) == int(generation):
+            return True
+    return bool(md5_hash) and metadata.get(SOURCE_MD5_METADATA) == md5_hash
+
+
+# Triggered when a new object is created in the GCS bucket.
+@functions_framework.cloud_event
+@traced("annotate_gcs")
+def annotate_gcs(cloud_event):
+    """Annotate image dropped into GCS bucket.
+
+    Terraform configuration subscribes this function for the events generated by GCS bucket.
+    event_trigger {
+        trigger_region = var.gcf_location # The trigger must be in the same location as the bucket
+        event_type = "google.cloud.storage.object.v1.finalized"
+        retry_policy = "RETRY_POLICY_RETRY"
+        service_account_email = google_service_account.gcf-sa.email
+        event_filters {
+        attribute = "bucket"
+        value = var.input-bucket
+        }
+    }
+
+    Processing is idempotent: a redelivered event, an event for an older version
+    of the image or for an unchanged content is skipped without calling Vision API.
+    The annotation is written only if it wasn't changed by another invocation
+    meanwhile, otherwise the function fails and the event is retried.
+
+    Args:
+        cloud_event: is event generated by GCS bucket when new object is created
+    """
+
+    start_invocation()
+    # read notification event data, showing also variables which are not used in this code
+    data = cloud_event.data
+    event_id = cloud_event["id"]
+    event_type = cloud_event["type"]
+    src_bucket = data["bucket"]
+    image_file_name = data["name"]
+    logging.info(
+        f"Received event {event_type} id={event_id} from {src_bucket} for file {image_file_name}"
+    )
+    set_attributes(event_id=event_id, image_size=data.get("size"))
+    image_generation = data.get("generation")
+    if event_processed(event_id, image_file_name, image_generation):
+        logging.info(f"{event_id}: Duplicate event for {image_file_name} skipped.")
+        return
+    # list of requested annotation features is parsed from environment variable once
+    config = get_config()
+    if config.features_env is None:
+        logging.warning(
+            "Annotation features aren't defined in the environment variable %s",
+            FEATURES_ENV,
+        )
+    features_list = list(config.features.features)
+    logging.info(f"{event_id}: Annotating for features: {features_list}")
+    # form environment variable retreive bucket name for results
+    annotations_bucket = config.annotations_bucket
+    if annotations_bucket is None:
+        logging.error("%s is not defined.", ANNOTATIONS_BUCKET_ENV)
+        return
+    # create result file name:
+    annotations_file_name = json_filename_for_image(image_file_name)
+    # object size and MD5 come with the event, otherwise read them from metadata
+    image_size = data.get("size")
+    image_md5 = data.get("md5Hash")
+    content_type = data.get("contentType")
+    if image_size is None:
+        image_blob = gcs_blob_metadata(src_bucket, image_file_name)
+        if image_blob is None:
+            logging.error(f"{event_id}: Image {image_file_name} could not be read.")
+            return
+        image_size, image_md5 = image_blob.size, image_blob.md5_hash
+        content_type = image_blob.content_type
+        image_generation = image_generation or image_blob.generation
+    # PDF, TIFF and GIF files are read by Vision page by page, MAX_IMAGE_SIZE doesn't apply
+    mime_type = file_mimetype(image_file_name, content_type)
+    if not int(image_size or 0) or not (mime_type or image_size_allowed(image_size)):
+        logging.error(f"{event_id}: Image {image_file_name} size is {image_size}.")
+        return
+    annotation_blob = gcs_blob_metadata(annotations_bucket, annotations_file_name)
+    if annotation_is_current(
+        annotation_blob, image_generation, image_md5, config.fingerprint
+    ):
+        logging.info(f"{event_id}: Annotation of {image_file_name} is up to date.")
+        mark_event_processed(event_id, image_file_name, data.get("generation"))
+        return
+    annotation_generation = annotation_blob.generation if annotation_blob else 0
+    if mime_type in FRAME_MIMETYPES and image_size_allowed(image_size):
+        # single-frame TIFF and GIF images get all features of the image path
+        mime_type = multipage_mimetype(
+            src_bucket, image_file_name, int(image_size), mime_type
+        )
+    max_dimension = None
+    if int(image_size) >= DOWNSCALE_MIN_SIZE and not mime_type:
+        max_dimension = config.max_dimension(features_list)
+    # byte-identical images stored under different names share annotations,
+    # annotations of multi-page files refer to the pages stored for the file name
+    digest = None if mime_type else image_md5
+    cache_key = annotation_cache_key(
+        digest, features_list, config.image_context, max_dimension
+    )
+    json_result = lookup_cached_annotation(cache_key, annotations_bucket)
+    set_attributes(cache_hit=bool(json_result), feature_count=len(features_list))
+    # hash of the image annotated by Vision API, recorded for its near-duplicates
+    annotated_hash = None
+    if json_result:
+        logging.info(f"{event_id}: Reusing cached annotation for {image_file_name}")
+    else:
+        # several events for one object, or for copies of an image, share one annotation
+        flight_key = annotation_cache_key(
+            digest or f"{gcs_uri(src_bucket, image_file_name)}#{image_generation}",
+            features_list,
+            config.image_context,
+            max_dimension,
+        )
+        (json_result, annotated_hash), leader = coalesced(
+            ("event", flight_key),
+            lambda: annotate_gcs_image(
+                event_id,
+                src_bucket,
+                image_file_name,
+                int(image_size),
+                annotations_bucket,
+                features_list,
+                config.image_context,
+                max_dimension,
+                mime_type,
+                image_generation,
+                image_md5,
+            ),
+        )
+        if json_result is None:
+            return
+        if leader:
+            store_cached_annotation(cache_key, json_result, annotations_bucket)
+    if json_result:
+        logging.info(
+            f"{event_id}: Saving JSON: {annotations_bucket}/{annotations_file_name}"
+        )
+        try:
+            write_annotation(
+                annotations_bucket,
+                image_file_name,
+                json_result,
+                config.output,
+                source_metadata(image_generation, image_md5, config.fingerprint),
+                if_generation_match=annotation_generation,
+            )
+        except exceptions.PreconditionFailed:
+            # another invocation wrote the annotation, fine if it's for this version
+            annotation_blob = gcs_blob_metadata(
+                annotations_bucket, annotations_file_name
+            )
+            if not annotation_is_current(
+                annotation_blob, image_generation, image_md5, config.fingerprint
+            ):
+                raise
+            logging.info(f"{event_id}: Annotation was written concurrently.")
+        record_annotation(annotations_bucket, image_file_name, image_generation)
+        index_annotation(annotations_bucket, image_file_name, json_result)
+        if annotated_hash and not annotation_has_error(json_result):
+            record_near_duplicate(
+                get_near_duplicate_index(annotations_bucket),
+                image_file_name,
+                annotated_hash,
+                image_generation,
+            )
+    mark_event_processed(event_id, image_file_name, data.get("generation"))
+    logging.info(f"Event {event_id} is processed")
+
+
+def annotate_gcs_image(
+    event_id: str,
+    src_bucket: str,
+    image_file_name: str,
+    image_size: int,
+    annotations_bucket: str,
+    features_list: list,
+    image_context: Optional[vision.ImageContext] = None,
+    max_dimension: Optional[int] = None,
+    mime_type: Optional[str] = None,
+    generation=None,
+    md5_hash: Optional[str] = None,
+) -> Tuple[Optional[str], Optional[ImageHash]]:
+    """Annotates GCS image by Vision API, or reuses annotation of its near-duplicate.
+
+    Multi-page files of <mime_type> are annotated by annotate_gcs_file().
+
+    Returns:
+        tuple: JSON with annotations, None if the image can't be read, and
+            the perceptual hash of the image if it was annotated by Vision API.
+    """
+    if mime_type:
+        json_result = annotate_gcs_file(
+            src_bucket,
+            image_file_name,
+            mime_type,
+            annotations_bucket,
+            features_list,
+            image_context,
+            generation,
+            md5_hash,
+        )
+        return json_result, None
+    batcher = get_annotation_batcher()
+    near_duplicates = get_near_duplicate_index(annotations_bucket)
+    image_hash = annotated_hash = json_result = None
+    if max_dimension or near_duplicates:
+        # the image is downloaded, hashed to find an annotated copy,
+        # downscaled and sent to Vision in the request; AdmissionRejected
+        # fails the invocation and the event is retried later
+        with admitted(REQUEST_MEMORY_BASE + image_size * IMAGE_MEMORY_FACTOR):
+            vision_image = read_vision_image_from_gcs(src_bucket, image_file_name)
+            if vision_image is None:
+                logging.error(f"{event_id}: Image {image_file_name} could not be read.")
+                return None, None
+            if near_duplicates:
+                image_hash, json_result = find_near_duplicate(
+                    near_duplicates, annotations_bucket, vision_image.content
+                )
+            if not json_result:
+                json_result = annotate_image_content(
+                    vision_image.content,
+                    features_list,
+                    image_context,
+                    max_dimension,
+                )
+                annotated_hash = image_hash
+            del vision_image
+    elif batcher:
+        json_result = annotate_gcs_batched(
+            batcher,
+            event_id,
+            src_bucket,
+            image_file_name,
+            features_list,
+            image_context,
+        )
+    else:
+        # Vision API reads the image from GCS, its content isn't buffered here
+        vision_image = vision_image_for_gcs(src_bucket, image_file_name)
+        logging.info(f"{event_id}: Executing annotations of {image_file_name}.")
+        json_result = annotate_image(vision_image, features_list, image_context)
+        logging.info(f"{event_id}: Annotated image {image_file_name}")
+    return json_result, annotated_hash
+
+
+def annotate_gcs_batched(
+    batcher: AnnotationBatcher,
+    event_id: str,
+    src_bucket: str,
+    image_file_name: str,
+    features_list: list,
+    image_context: Optional[vision.ImageContext] = None,
+) -> str:
+    """Annotates GCS image as a part of a batch.
+
+    Vision reads the image directly from GCS. When annotation of this image fails,
+    the exception makes the event to be retried, other images in the batch are not affected.
+
+    Returns:
+        string: JSON with annotations built from vision.AnnotateImageResponse
+    """
+    vision_image = vision_image_for_gcs(src_bucket, image_file_name)
+    request = vision.AnnotateImageRequest(
+        image=vision_image, features=features_list, image_context=image_context
+    )
+    response = batcher.annotate(request)
+    if response.error.code:
+        raise RuntimeError(
+            f"{event_id}: Annotation of {image_file_name} failed: {response.error.message}"
+        )
+    return vision.AnnotateImageResponse.to_json(response)
+
+
+# ------- Multi-page files ------
+
+
+def page_filename(file_name: str, page: int) -> str:
+    """Returns name of the annotation of a page of a multi-page file."""
+    return f"{PAGES_PREFIX}{file_name}/{page:05d}.json"
+
+
+def multipage_mimetype(
+    bucket_name: str, file_name: str, size: int, mime_type: str
+) -> Optional[str]:
+    """Returns <mime_type> of a TIFF or GIF image with several frames, None otherwise.
+
+    The image is downloaded to count its frames, images which can't be decoded
+    are left to Vision as files.
+    """
+    with admitted(REQUEST_MEMORY_BASE + size * IMAGE_MEMORY_FACTOR):
+        vision_image = read_vision_image_from_gcs(bucket_name, file_name)
+        frames = frame_count(vision_image.content) if vision_image else None
+    return None if frames == 1 else mime_type
+
+
+def file_parallelism() -> int:
+    """Returns max. number of concurrent BatchAnnotateFiles calls of one file."""
+    try:
+        return max(
+            1, int(os.environ.get(FILE_PARALLELISM_ENV, FILE_PARALLELISM_DEFAULT))
+        )
+    except ValueError:
+        return FILE_PARALLELISM_DEFAULT
+
+
+@traced("batch_annotate_files")
+def batch_annotate_file(
+    uri: str,
+    mime_type: str,
+    pages: List[int],
+    features_list: list,
+    image_context: Optional[vision.ImageContext] = None,
+) -> vision.AnnotateFileResponse:
+    """Annotates pages of a PDF, TIFF or GIF file, Vision API reads it from GCS.
+
+    Args:
+        pages: numbers of at most VISION_FILE_PAGES_MAX pages, starting from 1,
+            an empty list for the first VISION_FILE_PAGES_MAX pages.
+    """
+    request = vision.AnnotateFileRequest(
+        input_config=vision.InputConfig(
+            gcs_source=vision.GcsSource(uri=uri), mime_type=mime_type
+        ),
+        features=features_list,
+        image_context=image_context,
+        pages=pages,
+    )
+    page_count = len(pages) or VISION_FILE_PAGES_MAX
+    set_attributes(page_count=page_count)
+    # retries are done by call_vision, not by the client
+    response = call_vision(
+        lambda vision_client, timeout: vision_client.batch_annotate_files(
+            requests=[request], timeout=timeout, retry=None
+        ),
+        tokens=page_count,
+    )
+    return response.responses[0]
+
+
+def annotate_file_chunk(
+    uri: str,
+    mime_type: str,
+    pages: List[int],
+    annotations_bucket: str,
+    file_name: str,
+    features_list: list,
+    image_context: Optional[vision.ImageContext],
+    metadata: Dict[str, str],
+) -> Tuple[int, List[Tuple[int, dict]], Optional[dict]]:
+    """Annotates the pages of the file and writes their annotations.
+
+    Only digests of the pages (see page_digest()) are returned, so the memory
+    of a file is bounded by its chunks in flight, not by its number of pages.
+
+    Returns:
+        tuple: number of pages of the file, page numbers with their digests,
+            and the error of the whole file (e.g. it isn't a valid PDF).
+    """
+    response = batch_annotate_file(uri, mime_type, pages, features_list, image_context)
+    if response.error.code:
+        return 0, [], {"code": response.error.code, "message": response.error.message}
+    options = dataclasses.replace(get_config().output, ndjson=False)
+    page_metadata = dict(metadata, **{TOTAL_PAGES_METADATA: str(response.total_pages)})
+    digests = []
+    for position, page_response in enumerate(response.responses):
+        page = page_response.context.page_number or (
+            pages[position] if pages else position + 1
+        )
+        json_result = vision.AnnotateImageResponse.to_json(page_response)
+        write_annotation(
+            annotations_bucket,
+            file_name,
+            json_result,
+            options,
+            page_metadata,
+            annotations_file_name=page_filename(file_name, page),
+        )
+        digests.append((page, page_digest(json.loads(json_result))))
+    return response.total_pages, digests, None
+
+
+def written_pages(
+    annotations_bucket: str, file_name: str, metadata: Dict[str, str]
+) -> Tuple[Dict[int, int], Dict[int, str]]:
+    """Lists stored page annotations of the file.
+
+    Returns:
+        tuple: page -> number of pages of the file, of pages annotated for the
+            file version and configuration in <metadata>, and page -> object name
+            of pages annotated for other versions.
+    """
+    current: Dict[int, int] = {}
+    stale: Dict[int, str] = {}
+    prefix = f"{PAGES_PREFIX}{file_name}/"
+    for blob in list_bucket(annotations_bucket, None, prefix=prefix) or []:
+        parsed = parse_page_name(blob.name[len(PAGES_PREFIX) :])  # noqa: E203
+        if parsed is None or parsed[0] != file_name:
+            continue
+        page = parsed[1]
+        page_metadata = blob.metadata or {}
+        total_pages = page_metadata.get(TOTAL_PAGES_METADATA, "")
+        if total_pages.isdigit() and all(
+            page_metadata.get(name) == value for name, value in metadata.items()
+        ):
+            current[page] = int(total_pages)
+        else:
+            stale[page] = blob.name
+    return current, stale
+
+
+def add_written_pages(
+    summary: FileSummary, annotations_bucket: str, file_name: str, pages: List[int]
+) -> None:
+    """Adds digests of page annotations written by a previous invocation to the summary.
+
+    Pages which can't be read are left out of the summary, to be annotated again.
+    """
+    for chunk in page_chunks(pages, SEARCH_REBUILD_CHUNK):
+        names = {page_filename(file_name, page): page for page in chunk}
+        contents, _ = read_json_files(
+            annotations_bucket, list(names), SEARCH_REBUILD_READ_TIMEOUT
+        )
+        for name, annotation in contents.items():
+            if annotation is not None:
+                summary.add(names[name], page_digest(annotation))
+
+
+@traced("annotate_gcs_file")
+def annotate_gcs_file(
+    src_bucket: str,
+    file_name: str,
+    mime_type: str,
+    annotations_bucket: str,
+    features_list: list,
+    image_context: Optional[vision.ImageContext] = None,
+    generation=None,
+    md5_hash: Optional[str] = None,
+) -> str:
+    """Annotates all pages of a PDF, TIFF or GIF file in the bucket.
+
+    Pages are annotated in chunks of VISION_FILE_PAGES_MAX pages, FILE_PARALLELISM
+    chunks at a time. The annotation of every page is written to
+    _vision/pages/<file>/<page>.json as soon as its chunk completes. When the
+    invocation fails, e.g. on its timeout, the retried event annotates only
+    the pages which weren't written for this version of the file.
+
+    Returns:
+        string: JSON summary of the file, see FileSummary.
+    """
+    uri = gcs_uri(src_bucket, file_name)
+    metadata = source_metadata(generation, md5_hash, get_config().fingerprint)
+    summary = FileSummary(mime_type)
+    current, stale = written_pages(annotations_bucket, file_name, metadata)
+    if current:
+        summary.total_pages = max(current.values())
+        add_written_pages(summary, annotations_bucket, file_name, sorted(current))
+    else:
+        # the number of pages is known from the response for the first ones
+        summary.total_pages, digests, summary.error = annotate_file_chunk(
+            uri,
+            mime_type,
+            [],
+            annotations_bucket,
+            file_name,
+            features_list,
+            image_context,
+            metadata,
+        )
+        for page, digest in digests:
+            summary.add(page, digest)
+    set_attributes(page_count=summary.total_pages, written_pages=len(current))
+    chunks = list(page_chunks(summary.missing_pages(), VISION_FILE_PAGES_MAX))
+    if chunks and not summary.error:
+        workers = min(file_parallelism(), len(chunks))
+        next_chunks = iter(chunks)
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pages"
+        ) as executor:
+
+            def submit(pages: List[int]) -> Future:
+                return executor.submit(
+                    contextvars.copy_context().run,
+                    annotate_file_chunk,
+                    uri,
+                    mime_type,
+                    pages,
+                    annotations_bucket,
+                    file_name,
+                    features_list,
+                    image_context,
+                    metadata,
+                )
+
+            # a new chunk is submitted when one completes, not all of them upfront
+            futures = {
+                submit(chunk): chunk for chunk in itertools.islice(next_chunks, workers)
+            }
+            try:
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        chunk = futures.pop(future)
+                        _, digests, error = future.result()
+                        if error:
+                            digests = [(page, {"error": error}) for page in chunk]
+                        for page, digest in digests:
+                            summary.add(page, digest)
+                        for next_chunk in itertools.islice(next_chunks, 1):
+                            futures[submit(next_chunk)] = next_chunk
+            finally:
+                for future in futures:
+                    future.cancel()
+    # pages of a previous version of the file which has more of them
+    for page, name in stale.items():
+        if page > summary.total_pages:
+            try:
+                gcs_blob(annotations_bucket, name).delete()
+            except exceptions.NotFound:
+                pass
+    return json.dumps(summary.to_dict(), indent=2)
+
+
+# ------- Backfill ------
+
+
+def images_to_backfill(
+    input_bucket: str,
+    annotations_bucket: str,
+    batch_size: int,
+    start_offset: Optional[str] = None,
+) -> Iterator[List[str]]:
+    """Yields batches of names of images in the input bucket without annotations.
+
+    Args:
+        input_bucket: bucket with images
+        annotations_bucket: bucket with JSON annotations
+        batch_size: max. number of names in a batch
+        start_offset: the first image name to consider
+
+    Returns:
+        iterator: lists of image names in the lexicographical order.
+    """
+    annotation_blobs = list_bucket(
+        annotations_bucket,
+        None,
+        start_offset=json_filename_for_image(start_offset) if start_offset else None,
+    )
+    annotated = set(blob.name for blob in annotation_blobs or [])
+    image_blobs = list_bucket(input_bucket, None, start_offset=start_offset)
+    batch: List[str] = []
+    for image_blob in image_blobs or []:
+        if image_blob.name.endswith("/"):
+            continue
+        if json_filename_for_image(image_blob.name) in annotated:
+            continue
+        batch.append(image_blob.name)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def split_async_batch_output(
+    src_bucket: str, annotations_bucket: str, output_prefix: str
+) -> Tuple[int, List[str]]:
+    """Splits AsyncBatchAnnotateImages output files into <image>.json files.
+
+    Output files are deleted once their content is split.
+
+    Returns:
+        tuple: number of annotations written and a list of images failed to annotate.
+    """
+    written = 0
+    failed = []
+    image_uri_prefix = gcs_uri(src_bucket, "")
+    output_blobs = list_bucket(annotations_bucket, None, prefix=output_prefix)
+    for output_blob in output_blobs or []:
+        output = json.loads(output_blob.download_as_bytes())
+        for item in output.get("responses", []):
+            image_uri = item.get("context", {}).get("uri", "")
+            image_file_name = image_uri.replace(image_uri_prefix, "", 1)
+            if "error" in item:
+                logging.error(f"Image {image_uri} failed: {item['error']}")
+                failed.append(image_file_name)
+                continue
+            response = vision.AnnotateImageResponse.from_json(
+                json.dumps(item), ignore_unknown_fields=True
+            )
+            write_annotation(
+                annotations_bucket,
+                image_file_name,
+                vision.AnnotateImageResponse.to_json(response),
+            )
+            written += 1
+        output_blob.delete()
+    return written, failed
+
+
+def submit_backfill_batch(
+    src_bucket: str,
+    annotations_bucket: str,
+    image_names: List[str],
+    features_list: list,
+    output_prefix: str,
+    image_context: Optional[vision.ImageContext] = None,
+):
+    """Submits AsyncBatchAnnotateImages operation annotating a batch of images.
 
     Returns:
-        string: JSON with annotations built from vision.AnnotateImageResponse
+        google.api_core.operation.Operation: the submitted operation.
     """
-
-    logging.info("Annotate image: %s", image_uri)
-    vision_client = vision.ImageAnnotatorClient()
-    logging.info("Building Vision Image object.")
-    vision_image = vision.Image()
-    vision_image.source.image_uri = image_uri
-    logging.info("Building Request")
-    request = vision.AnnotateImageRequest(image=vision_image, features=detect_features)
-    logging.info("Annotating image.")
-    response = vision_client.annotate_image(request, timeout=120.0)
-    json_string = type(response).to_json(response)
-    return json_string
+    requests = []
+    for image_name in image_names:
+        vision_image = vision_image_for_gcs(src_bucket, image_name)
+        requests.append(
+            vision.AnnotateImageRequest(
+                image=vision_image, features=features_list, image_context=image_context
+            )
+        )
+    output_config = vision.OutputConfig(
+        gcs_destination=vision.GcsDestination(
+            uri=gcs_uri(annotations_bucket, output_prefix)
+        ),
+        batch_size=VISION_ASYNC_OUTPUT_BATCH_SIZE,
+    )
+    logging.info(f"Submitting {len(requests)} images, output: {output_prefix}")
+    vision_client = get_vision_client()
+    try:
+        return vision_client.async_batch_annotate_images(
+            requests=requests, output_config=output_config
+        )
+    except client_recreate_errors():
+        invalidate_client(vision_client)
+        raise
+
+
+def get_backfill_operation(name: str):
+    """Returns AsyncBatchAnnotateImages operation submitted by an earlier invocation."""
+    operations_client = get_vision_client().transport.operations_client
+    return api_operation.from_gapic(
+        operations_client.get_operation(name),
+        operations_client,
+        vision.AsyncBatchAnnotateImagesResponse,
+        metadata_type=vision.OperationMetadata,
+    )
 
 
-def annotate_image(
-    vision_image: vision.Image, detect_features: Optional[list] = None
-) -> str:
-    """Calculate annotations for the image referenced by URI.
+def finish_backfill_batch(
+    src_bucket: str,
+    annotations_bucket: str,
+    operation,
+    output_prefix: str,
+    deadline: float,
+) -> Tuple[int, List[str]]:
+    """Waits until <deadline> for the operation and splits its output.
 
-    Args:
-        image: a Vision Image object containing image data.
-        detect_features: a list of Vision Feature Types
+    Raises:
+        concurrent.futures.TimeoutError: the operation didn't finish in time.
 
     Returns:
-        string: JSON with annotations built from vision.AnnotateImageResponse
+        tuple: number of annotations written and a list of images failed to annotate.
     """
-    logging.info("annotate_image()")
-    vision_client = vision.ImageAnnotatorClient()
-    logging.info("Building Request")
-    request = vision.AnnotateImageRequest(image=vision_image, features=detect_features)
-    logging.info("Annotating image.")
-    response = vision_client.annotate_image(request, timeout=120.0)
-    json_string = type(response).to_json(response)
-    return json_string
-
-
-# ------- GCS ------
+    operation.result(timeout=max(0.0, deadline - time.monotonic()))
+    return split_async_batch_output(src_bucket, annotations_bucket, output_prefix)
 
 
-def gcs_write(bucket_name, file_name, content):
-    """Write and read a blob from GCS using file-like IO.
+def read_backfill_checkpoint(annotations_bucket: str) -> dict:
+    """Returns the checkpoint of an interrupted backfill, an empty dict if there's none.
 
-    Args:
-        bucket_name: name of the GCS bucket where content will be stored
-        file_name: name of the file
-        content: content to be stored into the file
+    The checkpoint has the last image submitted for annotation (<start_after>) and
+    operations which didn't finish (<pending>) with their output prefixes.
     """
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
-    # write the <content> into the file/blob
-    with blob.open("w") as fp:
-        fp.write(content)
+    return read_json_str(annotations_bucket, BACKFILL_CHECKPOINT) or {}
+
+
+def write_backfill_checkpoint(
+    annotations_bucket: str, start_after: Optional[str], pending: List[dict]
+) -> None:
+    gcs_write(
+        annotations_bucket,
+        BACKFILL_CHECKPOINT,
+        json.dumps(
+            {"start_after": start_after, "pending": pending, "updated": time.time()}
+        ),
+    )
 
 
-def json_filename_for_image(file_name: str) -> str:
-    """Returns name of the JSON file for source image file name."""
-    return file_name + ".json"
+def run_backfill(
+    input_bucket: str,
+    annotations_bucket: str,
+    features_list: list,
+    batch_size: int = BACKFILL_BATCH_SIZE_DEFAULT,
+    concurrency: int = BACKFILL_CONCURRENCY_DEFAULT,
+    image_context: Optional[vision.ImageContext] = None,
+    deadline: Optional[float] = None,
+) -> Dict[str, int]:
+    """Annotates all images in the input bucket which don't have annotations yet.
+
+    Images are submitted in AsyncBatchAnnotateImages operations of <batch_size> images,
+    at most <concurrency> operations run at the same time. Every submitted operation
+    is stored in a checkpoint in the annotations bucket until its output is split.
+    No operation is submitted or waited for after the time.monotonic() <deadline>,
+    the next backfill waits for the pending operations and continues after
+    the last submitted image. The checkpoint is removed when backfill completes.
 
+    Returns:
+        dict: numbers of submitted, annotated, failed and pending images.
+    """
+    batch_size = max(1, min(batch_size, VISION_ASYNC_BATCH_SIZE_MAX))
+    concurrency = max(1, concurrency)
+    if deadline is None:
+        deadline = time.monotonic() + BACKFILL_OPERATION_TIMEOUT
+    checkpoint = read_backfill_checkpoint(annotations_bucket)
+    start_after = checkpoint.get("start_after")
+    start_offset = start_after or checkpoint.get("start_offset")
+    pending: List[dict] = checkpoint.get("pending", [])
+    if start_offset or pending:
+        logging.info(f"Resuming backfill after {start_offset}, {len(pending)} pending")
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    summary = {"submitted": 0, "annotated": 0, "failed": 0}
+    in_flight: Dict[Future, dict] = {}
+
+    def collect(done) -> None:
+        for future in done:
+            batch = in_flight.pop(future)
+            try:
+                written, failed = future.result()
+                failed_count = len(failed)
+            except FuturesTimeoutError:
+                continue
+            except exceptions.GoogleAPICallError as e:
+                logging.error(f"Operation {batch['operation']} failed: {e}")
+                written, failed_count = 0, batch["images"]
+            pending.remove(batch)
+            summary["annotated"] += written
+            summary["failed"] += failed_count
+            write_backfill_checkpoint(annotations_bucket, start_after, pending)
+
+    with ThreadPoolExecutor(max_workers=concurrency + len(pending)) as executor:
+
+        def wait_for(batch: dict, operation) -> None:
+            future = executor.submit(
+                contextvars.copy_context().run,
+                finish_backfill_batch,
+                input_bucket,
+                annotations_bucket,
+                operation,
+                batch["output_prefix"],
+                deadline,
+            )
+            in_flight[future] = batch
 
-def image_filename_for_json(file_name: str) -> str:
-    """Returns name of the image file name for annotation JSON file name."""
-    path_items = os.path.splitext(file_name)
-    return path_items[0]
+        for batch in pending:
+            wait_for(batch, get_backfill_operation(batch["operation"]))
+        batches = images_to_backfill(
+            input_bucket, annotations_bucket, batch_size, start_offset
+        )
+        for batch_index, image_names in enumerate(batches):
+            if start_after and image_names[0] == start_after:
+                image_names = image_names[1:]
+            if not image_names:
+                continue
+            if time.monotonic() >= deadline:
+                break
+            output_prefix = f"{BACKFILL_PREFIX}{run_id}/{batch_index:06d}/"
+            operation = submit_backfill_batch(
+                input_bucket,
+                annotations_bucket,
+                image_names,
+                features_list,
+                output_prefix,
+                image_context,
+            )
+            batch = {
+                "operation": operation.operation.name,
+                "output_prefix": output_prefix,
+                "images": len(image_names),
+            }
+            pending.append(batch)
+            start_after = image_names[-1]
+            write_backfill_checkpoint(annotations_bucket, start_after, pending)
+            summary["submitted"] += len(image_names)
+            wait_for(batch, operation)
+            while len(in_flight) >= concurrency:
+                done, _ = wait(
+                    in_flight,
+                    timeout=max(0.0, deadline - time.monotonic()),
+                    return_when=FIRST_COMPLETED,
+                )
+                if not done:
+                    break
+                collect(done)
+        # every wait ends by the deadline
+        collect(wait(in_flight).done)
+    if pending:
+        summary["pending"] = sum(batch["images"] for batch in pending)
+        logging.info(f"Backfill interrupted: {summary}")
+        return summary
+    try:
+        gcs_blob(annotations_bucket, BACKFILL_CHECKPOINT).delete()
+    except exceptions.NotFound:
+        # nothing was submitted, no checkpoint was written
+        pass
+    summary["manifest"] = rebuild_manifest(annotations_bucket)
+    if get_search_index(annotations_bucket).ready():
+        summary["search_index"] = rebuild_search_index(annotations_bucket)["indexed"]
+    logging.info(f"Backfill finished: {summary}")
+    return summary
 
 
-# Triggered when a new object is created in the GCS bucket.
-@functions_framework.cloud_event
-def annotate_gcs(cloud_event):
-    """Annotate image dropped into GCS bucket.
+@functions_framework.http
+@traced("annotate_backfill")
+def annotate_backfill(request):
+    """HTTP Cloud Function annotating images already stored in the input bucket.
 
-    Terraform configuration subscribes this function for the events generated by GCS bucket.
-    event_trigger {
-        trigger_region = var.gcf_location # The trigger must be in the same location as the bucket
-        event_type = "google.cloud.storage.object.v1.finalized"
-        retry_policy = "RETRY_POLICY_RETRY"
-        service_account_email = google_service_account.gcf-sa.email
-        event_filters {
-        attribute = "bucket"
-        value = var.input-bucket
-        }
-    }
+    Optional request arguments <batch_size> and <concurrency> override
+    BACKFILL_BATCH_SIZE and BACKFILL_CONCURRENCY environment variables.
+    Operations still running when the function is about to time out are left
+    pending, calling the function again waits for them and resumes the backfill.
+    With <manifest_only>=true only the manifest of annotated images is rebuilt,
+    with <search_index>=true only the search index of the annotations is built.
 
-    Args:
-        cloud_event: is event generated by GCS bucket when new object is created
+    Returns:
+        JSON with numbers of submitted, annotated, failed and pending images,
+        the status is 202 when the backfill has to be resumed.
     """
-
-    # read notification event data, showing also variables which are not used in this code
-    data = cloud_event.data
-    event_id = cloud_event["id"]
-    event_type = cloud_event["type"]
-    src_bucket = data["bucket"]
-    image_file_name = data["name"]
-    logging.info(
-        f"Received event {event_type} id={event_id} from {src_bucket} for file {image_file_name}"
-    )
-    # build a list of requested annotation features form environment variable
-    features_list = []
-    features_env = os.environ.get(FEATURES_ENV, None)
-    if features_env is None:
-        logging.warn(
-            "Annotation features aren't defined in the environment variable %s",
-            FEATURES_ENV,
+    start_invocation()
+    config = get_config()
+    input_bucket = config.input_bucket
+    annotations_bucket = config.annotations_bucket
+    if input_bucket is None or annotations_bucket is None:
+        logging.error(
+            "%s or %s is not defined.", INPUT_BUCKET_ENV, ANNOTATIONS_BUCKET_ENV
         )
-    else:
-        logging.info(f"{event_id}: Env. features:{features_env}")
-        features_list = build_features_list(features_env)
-    logging.info(f"{event_id}: Annotating for features: {features_list}")
-    # form environment variable retreive bucket name for results
-    annotations_bucket = os.environ.get(ANNOTATIONS_BUCKET_ENV)
-    if annotations_bucket is None:
-        logging.error("%s is not defined.", ANNOTATIONS_BUCKET_ENV)
-        return
-    # create result file name:
-    annotations_file_name = json_filename_for_image(image_file_name)
-    vision_image = read_vision_image_from_gcs(src_bucket, image_file_name)
-    if vision_image:
-        logging.info(
-            f"{event_id}: Loaded {image_file_name} as vision.Image, executing annotations."
+        return make_response("Buckets are not defined", 404)
+    if request.args.get("manifest_only", "").strip().lower() in ("1", "true", "yes"):
+        summary = {"manifest": rebuild_manifest(annotations_bucket)}
+        return make_response(json.dumps(summary), 200)
+    if request.args.get("search_index", "").strip().lower() in ("1", "true", "yes"):
+        summary = rebuild_search_index(annotations_bucket)
+        return make_response(json.dumps(summary), 200)
+    try:
+        batch_size = int(
+            request.args.get("batch_size")
+            or os.environ.get(BACKFILL_BATCH_SIZE_ENV, BACKFILL_BATCH_SIZE_DEFAULT)
         )
-        json_result = annotate_image(vision_image, features_list)
-        logging.info(f"{event_id}: Annotated image {image_file_name}")
-        if json_result:
-            logging.info(
-                f"{event_id}: Saving JSON: {annotations_bucket}/{annotations_file_name}"
-            )
-            gcs_write(annotations_bucket, annotations_file_name, json_result)
-    else:
-        logging.error(f"{event_id}: Image {image_file_name} could not be read.")
-    logging.info(f"Event {event_id} is processed")
+        concurrency = int(
+            request.args.get("concurrency")
+            or os.environ.get(BACKFILL_CONCURRENCY_ENV, BACKFILL_CONCURRENCY_DEFAULT)
+        )
+    except ValueError:
+        return make_response("Invalid batch_size or concurrency", 400)
+    features_list = list(config.features.features)
+    summary = run_backfill(
+        input_bucket,
+        annotations_bucket,
+        features_list,
+        batch_size,
+        concurrency,
+        config.image_context,
+        invocation_deadline(),
+    )
+    return make_response(json.dumps(summary), 202 if summary.get("pending") else 200)
 
 
 # -------------  DEMO UI utilities  ----------------------
 
 
 def list_bucket(
-    bucket_name: str, max_results: Optional[int] = 2048
+    bucket_name: str,
+    max_results: Optional[int] = 2048,
+    prefix: Optional[str] = None,
+    start_offset: Optional[str] = None,
+    page_token: Optional[str] = None,
+    end_offset: Optional[str] = None,
 ) -> Optional[List[storage.Blob]]:
-    """Lists all the blobs in the bucket."""
-    storage_client = storage.Client()
+    """Lists all the blobs in the bucket.
+
+    Blobs are fetched page by page while they are iterated, the time spent
+    fetching them is recorded as the list_bucket stage.
+    """
+    storage_client = get_storage_client()
     try:
-        blobs = storage_client.list_blobs(bucket_name, max_results=max_results)
-        return blobs
+        blobs = storage_client.list_blobs(
+            bucket_name,
+            max_results=max_results,
+            prefix=prefix,
+            start_offset=start_offset,
+            end_offset=end_offset,
+            page_token=page_token,
+        )
+        return TimedIterable("list_bucket", blobs)
     except Exception:
         pass
     return None
@@ -299,50 +2962,118 @@ def read_blob(bucket_name: str, file_name: str) -> Optional[str]:
         Object data object.
     """
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
+    blob = gcs_blob(bucket_name, file_name)
     try:
-        with blob.open("rb") as fp:
-            content = fp.read()
+        content = blob.download_as_bytes()
     except Exception:
         return None
     return content
 
 
-def read_json_str(bucket_name: str, file_name: str) -> Optional[str]:
+@traced("read_json_str")
+def read_json_str(
+    bucket_name: str, file_name: str, timeout: Optional[float] = None
+) -> Optional[str]:
     """
     Read JSON file from GCS bucket.
 
     Args:
         bucket_name: bucket name containingh image
         file_name: path+file name of JSON file
+        timeout: optional timeout of the download in seconds
 
     Returns:
         File contents as JSON string.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
+    blob = gcs_blob(bucket_name, file_name)
     try:
-        json_str = blob.download_as_string()
+        if timeout is None:
+            json_str = blob.download_as_string()
+        else:
+            json_str = blob.download_as_string(timeout=timeout)
+        set_attributes(object_size=len(json_str or b""))
         if json_str:
-            json_obj = json.loads(json_str)
+            json_obj = json.loads(decode_stored_json(json_str))
             return json_obj
     except Exception:
         pass
     return None
 
 
+def embed_limits() -> Tuple[int, float]:
+    """Returns max. number of embedded annotations and timeout of a single fetch."""
+    try:
+        return (
+            int(os.environ.get(EMBED_MAX_ENV, NUM_EMBEDDED_ANNOTATIONS_MAX)),
+            float(os.environ.get(EMBED_FETCH_TIMEOUT_ENV, EMBED_FETCH_TIMEOUT)),
+        )
+    except ValueError:
+        logging.error("Invalid %s or %s.", EMBED_MAX_ENV, EMBED_FETCH_TIMEOUT_ENV)
+        return NUM_EMBEDDED_ANNOTATIONS_MAX, EMBED_FETCH_TIMEOUT
+
+
+def read_json_files(
+    bucket_name: str, file_names: List[str], timeout: float
+) -> Tuple[Dict[str, Optional[str]], int]:
+    """Reads JSON files concurrently using the instance I/O thread pool.
+
+    Returns:
+        tuple: file name -> content (None if the file couldn't be read in time),
+            and number of files which couldn't be read.
+    """
+    executor = get_io_executor()
+    # reads run in the context of the caller, e.g. within its span
+    futures = {
+        file_name: executor.submit(
+            contextvars.copy_context().run,
+            read_json_str,
+            bucket_name,
+            file_name,
+            timeout,
+        )
+        for file_name in file_names
+    }
+    deadline = time.monotonic() + timeout
+    contents: Dict[str, Optional[str]] = {}
+    failed = 0
+    for file_name, future in futures.items():
+        try:
+            contents[file_name] = future.result(max(0, deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            future.cancel()
+            contents[file_name] = None
+        if contents[file_name] is None:
+            failed += 1
+    return contents, failed
+
+
 def get_list_of_files(
     imagess_bucket: str,
     annotations_bucket: str,
     start: Optional[str] = None,
     end: Optional[str] = None,
     embed: Optional[str] = None,
+    cursor: Optional[str] = None,
+    prefix: Optional[str] = None,
+    limit: Optional[str] = None,
+    thumbnail: Optional[str] = None,
 ) -> Response:
+    """Lists images and names of their annotations.
+
+    Annotated PDF, TIFF and GIF files have a "page_annotation" URL, the annotations
+    of their pages are returned for it with the page number appended. Single-frame
+    TIFF and GIF images are annotated as other images, they have no pages there.
+    Images are selected either by <start> and <end> positions, or page by page:
+    <limit> images from the <cursor>, the cursor of the next page is returned in
+    the X-Next-Cursor header. Only images with name starting with <prefix> are listed.
+    With <thumbnail> size every image has an entry with the URL of its thumbnail,
+    the annotation of images without one is null.
+    """
+    if thumbnail and parse_thumbnail_size(thumbnail) is None:
+        return make_response("Invalid thumbnail size", 400)
     range_start = 0
     range_end = FILE_LIST_SIZE_MAX
+    page_size = None
     num_embedded_annotations = 0  # request number of embedded annotation results
     if start:
         try:
@@ -354,64 +3085,279 @@ def get_list_of_files(
             range_end = int(end)
         except ValueError:
             pass
+    if limit:
+        try:
+            page_size = max(1, min(int(limit), FILE_LIST_SIZE_MAX))
+        except ValueError:
+            pass
+    embed_max, embed_timeout = embed_limits()
     if embed:
         try:
             num_embedded_annotations = int(embed)
             # limit numbwer to something reasonable
-            if num_embedded_annotations > NUM_EMBEDDED_ANNOTATIONS_MAX:
-                num_embedded_annotations = NUM_EMBEDDED_ANNOTATIONS_MAX
+            if num_embedded_annotations > embed_max:
+                num_embedded_annotations = embed_max
         except ValueError:
             pass
+    paged = bool(cursor) or page_size is not None
     # list images
-    image_blobs = list_bucket(imagess_bucket, range_end)
-    if not image_blobs:
+    image_blobs = list_bucket(
+        imagess_bucket,
+        (page_size or FILE_LIST_SIZE_MAX) if paged else range_end,
+        prefix=prefix,
+        page_token=cursor or None,
+    )
+    if image_blobs is None:
+        return make_response("No images.", 404)
+    image_generations = {}
+    multipage = set()
+    try:
+        for image_blob in image_blobs:
+            image_generations[image_blob.name] = image_blob.generation
+            if file_mimetype(image_blob.name, image_blob.content_type):
+                multipage.add(image_blob.name)
+    except exceptions.GoogleAPICallError:
         return make_response("No images.", 404)
-    image_blobs = list(image_blobs)[range_start:range_end]
-    # list annotations
-    annotation_blobs = list_bucket(annotations_bucket, range_end)
-    if not annotation_blobs:
+    image_names = list(image_generations)
+    next_cursor = getattr(image_blobs, "next_page_token", None) if paged else None
+    if not paged:
+        image_names = image_names[range_start:range_end]
+    # find which images are annotated
+    annotated = annotated_images(annotations_bucket, image_names)
+    if annotated is None:
         return make_response("No image annotations.", 404)
-    # create a list of JSON file names
-    list_of_annotation_names = []
-    for annotation_blob in annotation_blobs:
-        if annotation_blob.name.lower().endswith(".json"):
-            list_of_annotation_names.append(annotation_blob.name)
+    # optionally fill in JSON annotations of the first annotated images, fetched concurrently
+    embedded_names = [
+        json_filename_for_image(image_name)
+        for image_name in image_names
+        if image_name in annotated
+    ][: max(0, num_embedded_annotations)]
+    embedded, embed_failed = read_json_files(
+        annotations_bucket, embedded_names, embed_timeout
+    )
 
     list_of_names: OrderedDict[
         str, Optional[OrderedDict[str, Optional[str]]]
     ] = collections.OrderedDict()
-    for image_blob in image_blobs:
-        json_filename = json_filename_for_image(image_blob.name)
-        if json_filename in list_of_annotation_names:
-            # optionally fill in JSON annotations, but only if number of files is small
-            if num_embedded_annotations > 0:
-                json_content = read_json_str(annotations_bucket, json_filename)
-                num_embedded_annotations -= 1
-            else:
-                json_content = None
+    for image_name in image_names:
+        if image_name in annotated:
+            json_filename = json_filename_for_image(image_name)
+            json_content = embedded.get(json_filename)
             annotation = collections.OrderedDict(
                 {"annotation": json_filename, "content": json_content}
             )
-            list_of_names[image_blob.name] = annotation
+            if image_name in multipage:
+                # the page number is appended to get annotation of the page
+                annotation["page_annotation"] = (
+                    f"/bucket/annotation/{parse.quote(json_filename)}?page="
+                )
+            list_of_names[image_name] = annotation
+        elif thumbnail:
+            list_of_names[image_name] = collections.OrderedDict(
+                {"annotation": None, "content": None}
+            )
+        else:
+            list_of_names[image_name] = None
+        if thumbnail:
+            list_of_names[image_name]["thumbnail"] = thumbnail_url(
+                image_name, thumbnail, image_generations[image_name]
+            )
+
+    response = make_response(json.dumps(list_of_names, indent=2), 200)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if embed_failed:
+        # partial result, content of some of the requested annotations is null
+        response.headers["X-Embed-Failed"] = str(embed_failed)
+    response.headers["Access-Control-Expose-Headers"] = "X-Next-Cursor, X-Embed-Failed"
+    return response
+
+
+def stream_blob(
+    blob: storage.Blob, start: int, length: int, chunk_size: int = IMAGE_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Yields <length> bytes of the blob from <start> offset in chunks.
+
+    Reads the generation of the blob from its metadata, so the stream
+    fails rather than mixing content of two versions of the object.
+    """
+    with blob.open(
+        "rb", chunk_size=chunk_size, if_generation_match=blob.generation
+    ) as fp:
+        fp.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = fp.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def get_image(imagess_bucket, image_name, request: Optional[Request] = None):
+    """Streams image from the bucket.
+
+    Supports conditional requests (If-None-Match, If-Modified-Since),
+    validated by the object generation, and single byte range requests.
+    """
+    blob = gcs_blob_metadata(imagess_bucket, image_name)
+    if blob is None or not blob.size:
+        return make_response("Image not found: %s" % image_name, 404)
+    etag = str(blob.generation)
+    response = Response(mimetype=blob.content_type or "application/octet-stream")
+    response.set_etag(etag)
+    response.last_modified = blob.updated
+    response.accept_ranges = "bytes"
+    response.cache_control.no_cache = True
+    response.headers["Content-Disposition"] = content_disposition_inline(image_name)
+    if request is not None:
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
         else:
-            list_of_names[image_blob.name] = None
+            not_modified = bool(
+                request.if_modified_since
+                and blob.updated
+                and blob.updated.replace(microsecond=0) <= request.if_modified_since
+            )
+        if not_modified:
+            response.status_code = 304
+            return response
+    start, length = 0, blob.size
+    byte_range = request.range if request is not None else None
+    if byte_range and request.if_range.etag in (None, etag):
+        byte_range = byte_range.range_for_length(blob.size)
+        if byte_range is None:
+            response.status_code = 416
+            response.content_range = ContentRange("bytes", None, None, blob.size)
+            return response
+        start, stop = byte_range
+        length = stop - start
+        response.status_code = 206
+        response.content_range = ContentRange("bytes", start, stop, blob.size)
+    response.content_length = length
+    response.response = stream_blob(blob, start, length)
+    return response
 
-    return make_response(json.dumps(list_of_names, indent=2), 200)
 
+def thumbnail_sizes() -> Set[int]:
+    """Returns sizes of thumbnails which can be requested."""
+    sizes = os.environ.get(THUMBNAIL_SIZES_ENV, THUMBNAIL_SIZES_DEFAULT)
+    return set(int(size) for size in sizes.split(",") if size.strip().isdigit())
 
-def get_image(imagess_bucket, image_name):
-    image = read_blob(imagess_bucket, image_name)
-    if image:
-        return send_file(
-            io.BytesIO(image),
-            mimetype="image/jpeg",
-            as_attachment=False,
-            download_name=image_name,
+
+def parse_thumbnail_size(size: str) -> Optional[int]:
+    """Returns thumbnail size in pixels, None if the size isn't one of THUMBNAIL_SIZES."""
+    if not size.isdigit() or int(size) not in thumbnail_sizes():
+        return None
+    return int(size)
+
+
+def thumbnail_filename(image_name: str, size: int) -> str:
+    return f"{THUMBNAIL_PREFIX}{size}/{image_name}"
+
+
+def thumbnail_url(image_name: str, size, generation) -> str:
+    """Returns path of the thumbnail of the image version, relative to the function URL."""
+    query = parse.urlencode({"size": size, "generation": generation or ""})
+    return f"/bucket/imagedata/{parse.quote(image_name)}?{query}"
+
+
+@traced("make_thumbnail")
+def make_thumbnail(
+    annotations_bucket: str, image_blob: storage.Blob, size: int
+) -> Optional[bytes]:
+    """Downscales the image to <size> pixels and stores it in the annotations bucket.
+
+    Returns:
+        bytes: the thumbnail, None if the image doesn't need one, can't be read or decoded.
+    """
+    if not image_size_allowed(image_blob.size):
+        return None
+    try:
+        content = image_blob.download_as_bytes(
+            if_generation_match=image_blob.generation
         )
-    return make_response("Image not found: %s" % image_name, 404)
+    except exceptions.GoogleAPICallError as e:
+        logging.error(f"Image {image_blob.name} could not be read: {e}")
+        return None
+    downscaled = downscale(content, size, quality=THUMBNAIL_QUALITY)
+    if downscaled is None:
+        return None
+    thumbnail = downscaled[0]
+    blob = gcs_blob(annotations_bucket, thumbnail_filename(image_blob.name, size))
+    blob.metadata = source_metadata(image_blob.generation, None)
+    try:
+        blob.upload_from_string(thumbnail, content_type=image_mimetype(thumbnail))
+    except exceptions.GoogleAPICallError as e:
+        # served anyway, stored on the next request
+        logging.error(f"Thumbnail of {image_blob.name} could not be stored: {e}")
+    return thumbnail
 
 
-def get_annotation(annotations_bucket, annotation_name):
+def get_thumbnail(
+    imagess_bucket: str,
+    annotations_bucket: str,
+    image_name: str,
+    size: int,
+    request: Request,
+) -> Response:
+    """Returns thumbnail of the image, made and stored on the first request.
+
+    A thumbnail requested with the current <generation> of the image (thumbnail_url())
+    is cached by browsers for THUMBNAIL_MAX_AGE, otherwise it's revalidated by ETag.
+    Images smaller than the thumbnail are returned as they are.
+    """
+    image_blob = gcs_blob_metadata(imagess_bucket, image_name)
+    if image_blob is None or not image_blob.size:
+        return make_response("Image not found: %s" % image_name, 404)
+    etag = f"{image_blob.generation}-{size}"
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+    thumbnail = None
+    thumbnail_blob = gcs_blob_metadata(
+        annotations_bucket, thumbnail_filename(image_name, size)
+    )
+    metadata = (thumbnail_blob.metadata or {}) if thumbnail_blob else {}
+    if metadata.get(SOURCE_GENERATION_METADATA) == str(image_blob.generation):
+        try:
+            thumbnail = thumbnail_blob.download_as_bytes(
+                if_generation_match=thumbnail_blob.generation
+            )
+        except exceptions.GoogleAPICallError:
+            thumbnail = None
+    if thumbnail is None:
+        thumbnail = make_thumbnail(annotations_bucket, image_blob, size)
+    if thumbnail is None:
+        return get_image(imagess_bucket, image_name, request)
+    response = make_response(thumbnail, 200)
+    response.mimetype = image_mimetype(thumbnail)
+    response.set_etag(etag)
+    if request.args.get("generation") == str(image_blob.generation):
+        response.cache_control.public = True
+        response.cache_control.max_age = THUMBNAIL_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    response.headers["Content-Disposition"] = content_disposition_inline(image_name)
+    return response
+
+
+def content_disposition_inline(file_name: str) -> str:
+    """Returns Content-Disposition header value for displaying the file in a browser."""
+    base_name = file_name.rsplit("/", 1)[-1]
+    return "inline; filename*=UTF-8''" + parse.quote(base_name)
+
+
+def get_annotation(annotations_bucket, annotation_name, page: Optional[str] = None):
+    """Returns annotation JSON, with <page> the annotation of a page of a multi-page file."""
+    if page:
+        if not page.isdigit() or int(page) < 1:
+            return make_response("Invalid page: %s" % page, 400)
+        annotation_name = page_filename(
+            image_filename_for_json(annotation_name), int(page)
+        )
     json = read_json_str(annotations_bucket, annotation_name)
     if json:
         return make_response(json, 200)
@@ -435,11 +3381,12 @@ def handle_bucket(request: Request):
     result = "Undefined request: [%s]." % request.args
     error_code = 404
     # get bucket names from env. variables
-    imagess_bucket = os.environ.get(INPUT_BUCKET_ENV)
+    config = get_config()
+    imagess_bucket = config.input_bucket
     if imagess_bucket is None:
         logging.error("%s is not defined.", INPUT_BUCKET_ENV)
         return make_response("%s is not defined" % INPUT_BUCKET_ENV, 404)
-    annotations_bucket = os.environ.get(ANNOTATIONS_BUCKET_ENV)
+    annotations_bucket = config.annotations_bucket
     if annotations_bucket is None:
         logging.error("%s is not defined.", ANNOTATIONS_BUCKET_ENV)
         return make_response("%s is not defined" % ANNOTATIONS_BUCKET_ENV, 404)
@@ -457,26 +3404,155 @@ def handle_bucket(request: Request):
             request.args.get("start"),
             request.args.get("end"),
             request.args.get("embed"),
+            request.args.get("cursor"),
+            request.args.get("prefix"),
+            request.args.get("limit"),
+            request.args.get("thumbnail"),
         )
     elif path_items[2].lower() == "imagedata" and len(path_items) > 3:
-        name = path_items[3]
+        # image names can contain slashes
+        name = "/".join(path_items[3:])
         if name:
             image_name = parse.unquote(name)
-            return get_image(imagess_bucket, image_name)
+            size = request.args.get("size")
+            if size:
+                thumbnail_size = parse_thumbnail_size(size)
+                if thumbnail_size is None:
+                    return make_response("Invalid thumbnail size", 400)
+                return get_thumbnail(
+                    imagess_bucket,
+                    annotations_bucket,
+                    image_name,
+                    thumbnail_size,
+                    request,
+                )
+            return get_image(imagess_bucket, image_name, request)
+    elif path_items[2].lower() == "search":
+        return search_images(annotations_bucket, request)
     elif path_items[2].lower() == "annotation" and len(path_items) > 3:
-        name = path_items[3]
+        # annotations of images in folders have slashes in their names
+        name = "/".join(path_items[3:])
         if name:
             annotation_name = parse.unquote(name)
-            return get_annotation(annotations_bucket, annotation_name)
+            return get_annotation(
+                annotations_bucket, annotation_name, request.args.get("page")
+            )
     return make_response(result, error_code)
 
 
+def image_digest(image_uri: Optional[str], image_bin: Optional[bytes]) -> Optional[str]:
+    """Returns MD5 of the image content, None if it can't be cheaply determined.
+
+    Only images uploaded with the request or stored in GCS can be digested,
+    the content of other URIs is not known before Vision API fetches it.
+    """
+    if image_bin:
+        return content_md5(image_bin)
+    if image_uri and image_uri.startswith("gs://"):
+        bucket_name, _, file_name = image_uri.replace("gs://", "", 1).partition("/")
+        if bucket_name and file_name:
+            return gcs_object_md5(bucket_name, file_name)
+    return None
+
+
+def upload_size_max() -> int:
+    """Returns max. size of a request body with a base64 encoded image."""
+    return (max_image_size() + 2) // 3 * 4 + UPLOAD_OVERHEAD_MAX
+
+
+def is_raw_image_request(request: Request) -> bool:
+    """Checks if the request body is the image itself rather than a form or JSON."""
+    mimetype = request.mimetype
+    return mimetype.startswith("image/") or mimetype == "application/octet-stream"
+
+
+def read_request_body(request: Request, limit: int) -> Optional[bytes]:
+    """Reads raw request body, None if it's larger than <limit> bytes.
+
+    Body of a request without Content-Length (chunked) is read in chunks,
+    so that it's never buffered beyond the limit.
+    """
+    if request.content_length is not None:
+        if request.content_length > limit:
+            return None
+        return request.get_data(cache=False)
+    body = bytearray()
+    while chunk := request.stream.read(IMAGE_CHUNK_SIZE):
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+def decode_image_b64(image_b64: str) -> Optional[bytes]:
+    """Decodes base64 encoded image, None if the encoding isn't valid.
+
+    The image can be sent as a data URL ("data:image/png;base64,...").
+    The ASCII string is decoded directly, without encoding it to bytes first.
+    Characters outside of the base64 alphabet (other than line breaks) and empty
+    images are rejected, a2b_base64() would silently skip them.
+    """
+    if image_b64.startswith("data:"):
+        image_b64 = image_b64.partition(",")[2]
+    if not BASE64_RE.fullmatch(image_b64):
+        return None
+    try:
+        image_bin = binascii.a2b_base64(image_b64)
+    except (binascii.Error, ValueError):
+        return None
+    return image_bin or None
+
+
+def request_features(features_http) -> FeatureSelection:
+    """Selects annotation features for a HTTP request.
+
+    Features from the request (a comma separated string or a list of names)
+    override the ones defined in the environment variable "FEATURES".
+    Both are parsed once, names which aren't Vision features are in <unknown>.
+    """
+    # override annotation features with the ones from the request if provided
+    if features_http:
+        if isinstance(features_http, list):
+            features_http = ','.join(features_http)
+        logging.info("Request features: %s", features_http)
+        return parse_features(features_http)
+    # otherwise use requested annotation features form environment variable
+    return get_config().features
+
+
+def request_image_context(image_context_http) -> Optional[vision.ImageContext]:
+    """Selects Vision ImageContext for a HTTP request.
+
+    The <image_context> of the request (JSON string or, in a JSON body, an object)
+    overrides the one defined in the environment variable "IMAGE_CONTEXT".
+
+    Raises:
+        ValueError: the request has an invalid image context.
+    """
+    if image_context_http:
+        if isinstance(image_context_http, dict):
+            image_context_http = json.dumps(image_context_http, sort_keys=True)
+        logging.info("Request image context: %s", image_context_http)
+        return parse_image_context(image_context_http)
+    return get_config().image_context
+
+
+def unknown_features_response(selection: FeatureSelection) -> Response:
+    """Builds the 400 response for a request with unknown feature names."""
+    logging.error("Unknown features: %s", selection.unknown)
+    return make_response("Unknown features: %s" % ",".join(selection.unknown), 400)
+
+
 def handle_annotation(request):
     """Executes online image annotations.
 
     Handles GET and POST methods.
     The form in POST method can have image as URI  in the <image_uri> variable
     or base64 encoded image in <image> form variable.
+    The body of a POST request with Content-Type image/* or application/octet-stream
+    is the image itself, <features> are then read from the query string.
+    Bodies larger than a base64 encoded image of MAX_IMAGE_SIZE are rejected
+    before they are read.
     Optional variable is <features> which overrides a list of
     vision.Feature.Type(s) defined in the environment variable "FEATURES".
 
@@ -486,22 +3562,39 @@ def handle_annotation(request):
     Due to the request size limit, GET method can't submit the image.
     """
 
-    features_env = os.environ.get(FEATURES_ENV, None)
     image_uri = None
     image_bin = None
     features_http = None
+    image_context_http = None
     # read variables from POST or GET request
     if request.method == "POST":
-        content = request.form or request.json
-        logging.info("Received content in POST: content=%s" % content)
-        features_http = content.get("features")
+        if request.content_length and request.content_length > upload_size_max():
+            logging.error("Request body too large: %s", request.content_length)
+            return make_response("Image too large", 413)
+        if is_raw_image_request(request):
+            features_http = request.args.get("features")
+            image_context_http = request.args.get("image_context")
+            image_bin = read_request_body(request, max_image_size())
+            if image_bin is None:
+                return make_response("Image too large", 413)
+            logging.debug("image_bin size=%s" % len(image_bin))
+            content = {}
+        else:
+            content = request.form or request.get_json(silent=True) or {}
+            logging.info("Received fields in POST: %s", list(content))
+        features_http = content.get("features", features_http)
+        image_context_http = content.get("image_context", image_context_http)
         image_uri = content.get("image_uri")
         image_b64 = content.get("image")
         if image_b64:
             logging.debug("image_b64 size=%s" % len(image_b64))
-            image_bin = image_b64.encode()
+            if not image_size_allowed(len(image_b64) // 4 * 3 - 2):
+                return make_response("Image too large", 413)
+            image_bin = decode_image_b64(image_b64)
+            if image_bin is None:
+                return make_response("Invalid base64 image", 400)
             logging.debug("Image size=%s" % len(image_bin))
-            logging.info("Converted base64 encoded image from the form.")
+            logging.info("Decoded base64 encoded image from the form.")
         if image_bin is None and request.files and "image" in request.files:
             logging.info(
                 "Reading image from attached file %s" % request.files["image"].filename
@@ -509,12 +3602,15 @@ def handle_annotation(request):
             file_object = request.files.get("image")
             image_bin = file_object.read()
             logging.debug("image_bin size=%s" % len(image_bin))
+            if not image_size_allowed(len(image_bin)):
+                return make_response("Image too large", 413)
     elif request.method == "GET":
         logging.info(
             "Received form in GET path=%s, args=%s" % (request.path, request.args)
         )
         image_uri = request.args.get("image_uri", None)
         features_http = request.args.get("features")
+        image_context_http = request.args.get("image_context")
         if not image_uri:  # check if URI is encoded in the path
             path_items = request.path.split("?")  # separate args
             path_items = path_items[0].split("/", 2)
@@ -525,37 +3621,241 @@ def handle_annotation(request):
     # is image input p[resent?
     if image_uri is None and image_bin is None:
         return make_response("No image data", 412)
-    # build a list of requested annotation features form environment variable
-    features_list = []
-    if features_env:
-        logging.info("Env. features: %s", features_env)
-        features_list = build_features_list(features_env)
-    # override annotation features with the ones from the request if provided
-    if features_http:
-        if isinstance(features_http, list):
-            features_http = ','.join(features_http)
-        logging.info("Request features: %s", features_http)
-        features_list = build_features_list(features_http)
+    selection = request_features(features_http)
+    if selection.unknown:
+        return unknown_features_response(selection)
+    features_list = list(selection.features)
     logging.info("Annotating for features: %s", features_list)
-    result = None
+    try:
+        image_context = request_image_context(image_context_http)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    config = get_config()
+    annotations_bucket = config.annotations_bucket
+    # images referenced by URI are read by Vision, only uploads are downscaled
+    max_dimension = config.max_dimension(features_list) if image_bin else None
+    upload_digest = content_md5(image_bin) if image_bin else None
+    cache_key = None
+    # the digest of a GCS image costs a metadata request, only a cache needs it
+    if get_annotation_cache(annotations_bucket) is not None:
+        cache_key = annotation_cache_key(
+            upload_digest or image_digest(image_uri, None),
+            features_list,
+            image_context,
+            max_dimension,
+        )
+    result = lookup_cached_annotation(cache_key, annotations_bucket)
+    cache_status = "hit" if result else "miss"
+    set_attributes(cache_hit=bool(result), feature_count=len(features_list))
+    # concurrent requests of the same image and options share one Vision call
+    flight_key = (
+        "annotate",
+        annotation_cache_key(
+            upload_digest or image_uri, features_list, image_context, max_dimension
+        ),
+    )
     # call Vision image annotation API
-    if image_uri:
-        logging.info(f"Annotating image from URI {image_uri}")
-        result = annotate_image_uri(image_uri, features_list)
-    else:
-        logging.info("Annotating uploaded image.")
-        vision_image = vision.Image(content=image_bin)
-        result = annotate_image(vision_image, features_list)
+    try:
+        if result:
+            logging.info("Returning cached annotation.")
+        elif image_uri:
+            logging.info(f"Annotating image from URI {image_uri}")
+            result, leader = coalesced(
+                flight_key,
+                lambda: annotate_image_uri(image_uri, features_list, image_context),
+            )
+        else:
+            logging.info("Annotating uploaded image.")
+            result, leader = coalesced(
+                flight_key,
+                lambda: annotate_image_content(
+                    image_bin, features_list, image_context, max_dimension
+                ),
+            )
+    except (exceptions.TooManyRequests, RateLimitTimeout) as e:
+        logging.error("Vision API quota exhausted: %s", e)
+        return throttled_response()
+    except SingleFlightTimeout as e:
+        logging.error("Shared annotation timed out: %s", e)
+        return make_response("Annotation timed out", 504)
     if result:
-        if result.find('"error"') > 0 and result.find('"code":') > 0:
+        if annotation_has_error(result):
             logging.error("Vision API returned error, check JSON result for details.")
             return make_response(result, 412)  # Vision API returned JSON with an error
+        if cache_status == "miss" and not leader:
+            cache_status = "coalesced"
+        elif cache_status == "miss":
+            store_cached_annotation(cache_key, result, annotations_bucket)
         logging.info("Returning annotation result as JSON.")
-        return make_response(result, 200)
+        response = make_response(result, 200)
+        response.headers["X-Annotation-Cache"] = cache_status
+        return response
     logging.error("Annotation result is None.")
     return make_response("Annotation result is None.", 500)
 
 
+def throttled_response():
+    """Response asking the client to retry when Vision API quota is exhausted."""
+    response = make_response("Vision API quota exhausted, retry later.", 429)
+    rate = get_vision_rate_limiter().rate
+    response.headers["Retry-After"] = str(math.ceil(1 / rate) if rate else 1)
+    return response
+
+
+def annotate_batch_limits() -> Tuple[int, int]:
+    """Returns parallelism and max. number of images of a batch annotation request."""
+    try:
+        return (
+            int(
+                os.environ.get(
+                    ANNOTATE_BATCH_PARALLELISM_ENV, ANNOTATE_BATCH_PARALLELISM_DEFAULT
+                )
+            ),
+            int(
+                os.environ.get(
+                    ANNOTATE_BATCH_ITEMS_MAX_ENV, ANNOTATE_BATCH_ITEMS_MAX_DEFAULT
+                )
+            ),
+        )
+    except ValueError:
+        logging.error(
+            "Invalid %s or %s.",
+            ANNOTATE_BATCH_PARALLELISM_ENV,
+            ANNOTATE_BATCH_ITEMS_MAX_ENV,
+        )
+        return ANNOTATE_BATCH_PARALLELISM_DEFAULT, ANNOTATE_BATCH_ITEMS_MAX_DEFAULT
+
+
+def annotate_batch_bytes_max() -> int:
+    """Returns max. total size of images uploaded with a batch annotation request."""
+    try:
+        return int(
+            os.environ.get(
+                ANNOTATE_BATCH_BYTES_MAX_ENV, ANNOTATE_BATCH_BYTES_MAX_DEFAULT
+            )
+        )
+    except ValueError:
+        logging.error("Invalid %s.", ANNOTATE_BATCH_BYTES_MAX_ENV)
+        return ANNOTATE_BATCH_BYTES_MAX_DEFAULT
+
+
+def uploaded_file_size(file_object) -> int:
+    """Returns size of an uploaded file without reading it."""
+    stream = file_object.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell() - position
+    stream.seek(position)
+    return size
+
+
+def upload_request(
+    file_object, features_list: list, image_context: Optional[vision.ImageContext]
+):
+    """Returns function reading the uploaded file into a Vision request."""
+
+    def build() -> vision.AnnotateImageRequest:
+        return vision.AnnotateImageRequest(
+            image=vision.Image(content=file_object.read()),
+            features=features_list,
+            image_context=image_context,
+        )
+
+    return build
+
+
+def handle_annotation_batch(request: Request) -> Response:
+    """Annotates multiple images with a single HTTP request.
+
+    The POST request has image URIs in the <image_uri> variable (repeated form
+    field, or a list in JSON) and/or image files attached as <image>.
+    Optional variables are <features> and <image_context>, as in handle_annotation().
+
+    Images are annotated in groups of VISION_BATCH_SIZE_MAX with BatchAnnotateImages,
+    ANNOTATE_BATCH_PARALLELISM groups at a time. The response is JSON with
+    the list <responses> of AnnotateImageResponse in the order of the images,
+    URIs first. If the client accepts application/x-ndjson (or sets ?format=ndjson),
+    every response is streamed as a line {"index": <n>, "response": {...}}
+    as soon as its group is annotated.
+
+    Uploaded images are limited to ANNOTATE_BATCH_BYTES_MAX in total, larger
+    request bodies are rejected before they are read. An uploaded image is read
+    only when its group is annotated, except for streamed responses: the uploads
+    are closed when the handler returns, so they are read before streaming.
+    """
+    parallelism, items_max = annotate_batch_limits()
+    body_max = annotate_batch_bytes_max() + UPLOAD_OVERHEAD_MAX
+    if request.content_length and request.content_length > body_max:
+        logging.error("Request body too large: %s", request.content_length)
+        return make_response("Request too large", 413)
+    if request.content_length is None and request.mimetype == "multipart/form-data":
+        # the size of uploads sent in chunks isn't known before they're read
+        return make_response("Content-Length required", 411)
+    if request.form or request.files:
+        features_http = request.form.get("features")
+        image_context_http = request.form.get("image_context")
+        image_uris = request.form.getlist("image_uri")
+    else:
+        content = request.get_json(silent=True) or {}
+        features_http = content.get("features")
+        image_context_http = content.get("image_context")
+        image_uris = content.get("image_uri") or []
+        if isinstance(image_uris, str):
+            image_uris = [image_uris]
+    files = request.files.getlist("image")
+    num_images = len(image_uris) + len(files)
+    logging.info("Batch annotation of %s images.", num_images)
+    if num_images == 0:
+        return make_response("No image data", 412)
+    if num_images > items_max:
+        return make_response(f"Too many images, the limit is {items_max}.", 413)
+    selection = request_features(features_http)
+    if selection.unknown:
+        return unknown_features_response(selection)
+    features_list = list(selection.features)
+    try:
+        image_context = request_image_context(image_context_http)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    accepted = request.accept_mimetypes.best_match(
+        ["application/json", NDJSON_MIMETYPE]
+    )
+    streamed = request.args.get("format") == "ndjson" or accepted == NDJSON_MIMETYPE
+    requests: List[Optional[Any]] = []
+    rejected = {}
+    for image_uri in image_uris:
+        vision_image = vision.Image()
+        vision_image.source.image_uri = image_uri
+        requests.append(
+            vision.AnnotateImageRequest(
+                image=vision_image, features=features_list, image_context=image_context
+            )
+        )
+    for file_object in files:
+        if not image_size_allowed(uploaded_file_size(file_object)):
+            rejected[len(requests)] = vision.AnnotateImageResponse.to_json(
+                error_response(3, f"Image {file_object.filename} is too large."),
+                indent=None,
+            )
+            requests.append(None)
+            continue
+        build = upload_request(file_object, features_list, image_context)
+        requests.append(build() if streamed else build)
+    results = annotate_images_concurrently(requests, parallelism, rejected)
+    if streamed:
+
+        def generate() -> Iterator[str]:
+            for index, result in results:
+                yield '{"index": %d, "response": %s}\n' % (index, result)
+
+        return Response(generate(), 200, mimetype=NDJSON_MIMETYPE)
+    ordered = [None] * len(requests)
+    for index, result in results:
+        ordered[index] = result
+    body = '{"responses": [' + ", ".join(ordered) + "]}"
+    return make_response(body, 200, {"Content-Type": "application/json"})
+
+
 @functions_framework.http
 def annotate_http(request):
     """HTTP Cloud Function.
@@ -585,21 +3885,42 @@ def annotate_http(request):
         }
 
         return ("", 204, headers)
+    start_invocation()
     logging.info(
-        "REST API request path=%s, args=%s, form=%s",
+        "REST API request path=%s, args=%s, content_type=%s, content_length=%s",
         request.path,
         request.args,
-        request.form,
+        request.content_type,
+        request.content_length,
     )
     response = None
     path_items = request.path.split("/")
-    if len(path_items) >= 2:
-        if path_items[1].lower() == "annotate":
-            response = handle_annotation(request)
-        elif path_items[1].lower() == "bucket" and request.method == "GET":
-            response = handle_bucket(request)
-    if not response:
-        response = make_response("Not supported.", 501)
+    # the span joins the trace of the caller when the request carries its context
+    with stage(
+        "annotate_http", carrier=request.headers, http_method=request.method
+    ) as request_stage:
+        if len(path_items) >= 2:
+            request_stage.set(http_route="/".join(path_items[:3]))
+            try:
+                with contextlib.ExitStack() as reservation:
+                    reservation.enter_context(admitted(request_memory(request)))
+                    if path_items[1].lower() == "annotate":
+                        if request.method == "POST" and path_items[2:] == ["batch"]:
+                            response = handle_annotation_batch(request)
+                        else:
+                            response = handle_annotation(request)
+                    elif path_items[1].lower() == "bucket" and request.method == "GET":
+                        response = handle_bucket(request)
+                    if response is not None and response.is_streamed:
+                        # the streamed body is annotated after the function returns,
+                        # the memory stays reserved until the response is closed
+                        response.call_on_close(reservation.pop_all().close)
+            except AdmissionRejected as e:
+                logging.warning("Request rejected: %s", e)
+                response = overloaded_response()
+        if not response:
+            response = make_response("Not supported.", 501)
+        request_stage.set(http_status_code=response.status_code)
     # Set CORS headers for the main request
     response.headers["Access-Control-Allow-Origin"] = "*"
     logging.info("REST API response=%s", response.status_code)
@@ -0,0 +1,228 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Perceptual hashes of images and lookup of near-duplicates by Hamming distance.
+
+Resized or re-encoded copies of an image have the same or a close difference
+hash (dHash), their annotations differ only in the scale of the coordinates.
+Pillow is imported on first use, like in image_resize.
+"""
+
+import io
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from sharded_store import ShardedJsonStore
+
+# dHash compares neighbouring pixels of a HASH_SIZE x HASH_SIZE grayscale thumbnail
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# max. relative difference of the aspect ratios of near-duplicate images
+ASPECT_RATIO_TOLERANCE = 0.02
+
+
+@dataclass(frozen=True)
+class ImageHash:
+    """Difference hash of an image and the size of the image in pixels."""
+
+    value: int
+    width: int
+    height: int
+
+    @property
+    def aspect_ratio(self) -> float:
+        return self.width / self.height
+
+
+def perceptual_hash(content: bytes) -> Optional[ImageHash]:
+    """Returns dHash of the encoded image, None if it can't be decoded.
+
+    Args:
+        content: encoded image
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning("Pillow is not installed, images are not hashed.")
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            width, height = image.size
+            # JPEG is decoded in the smallest scale still larger than the thumbnail
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            pixels = (
+                image.convert("L")
+                .resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)
+                .tobytes()
+            )
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning("Image not hashed: %s", e)
+        return None
+    if not width or not height:
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            value = (value << 1) | (
+                pixels[offset + column] > pixels[offset + column + 1]
+            )
+    return ImageHash(value, width, height)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHash:
+    """Hashes and their items, finds hashes within a Hamming distance.
+
+    Hashes are split into <radius> + 1 segments, each indexed by a hash table.
+    Hashes within the radius match at least one segment exactly (pigeonhole
+    principle), so only hashes sharing a segment with the searched one are
+    compared instead of all of them. Not thread-safe.
+
+    Args:
+        radius: max. distance of searched hashes
+        bits: length of the hashes
+    """
+
+    def __init__(self, radius: int, bits: int = HASH_BITS):
+        self.radius = radius
+        count = min(radius + 1, bits)
+        # (shift, mask) of the segments
+        self._segments: List[Tuple[int, int]] = []
+        shift = 0
+        for segment in range(count):
+            width = (bits - shift) // (count - segment)
+            self._segments.append((shift, (1 << width) - 1))
+            shift += width
+        # segment value -> hashes, for every segment
+        self._tables: List[Dict[int, Set[int]]] = [{} for _ in self._segments]
+        self._items: Dict[int, Set] = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, value: int, item) -> None:
+        items = self._items.get(value)
+        if items is None:
+            items = self._items[value] = set()
+            for (shift, mask), table in zip(self._segments, self._tables):
+                table.setdefault((value >> shift) & mask, set()).add(value)
+        items.add(item)
+
+    def search(self, value: int) -> Iterator[Tuple[int, int, Set]]:
+        """Yields (distance, hash, items) of the hashes within the radius."""
+        candidates: Set[int] = set()
+        for (shift, mask), table in zip(self._segments, self._tables):
+            candidates.update(table.get((value >> shift) & mask, ()))
+        for candidate in candidates:
+            distance = hamming_distance(value, candidate)
+            if distance <= self.radius:
+                yield distance, candidate, self._items[candidate]
+
+
+class NearDuplicateIndex:
+    """Perceptual hashes of annotated images, shared by instances through GCS.
+
+    Entries image name -> [hash, width, height, image generation] are kept in
+    <store>. Every instance loads them into a MultiIndexHash and reloads new entries
+    when the store TTL elapses. Entries replaced or removed since they were
+    loaded are skipped by lookups.
+
+    Args:
+        store: persistent entries
+        max_distance: max. Hamming distance of near-duplicate hashes
+        clock: time source, for tests
+    """
+
+    def __init__(
+        self,
+        store: ShardedJsonStore,
+        max_distance: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.store = store
+        self.max_distance = max_distance
+        self._clock = clock
+        self._hashes = MultiIndexHash(max_distance)
+        self._entries: Dict[str, list] = {}
+        self._loaded: Optional[float] = None
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "hits": 0, "loads": 0}
+
+    def _refresh(self) -> None:
+        now = self._clock()
+        if self._loaded is not None and now - self._loaded <= self.store.ttl:
+            return
+        self._loaded = now
+        self._counters["loads"] += 1
+        for image_name, entry in self.store.items():
+            self._add_entry(image_name, entry)
+
+    def _add_entry(self, image_name: str, entry: list) -> None:
+        if self._entries.get(image_name) == entry:
+            return
+        self._entries[image_name] = entry
+        self._hashes.add(int(entry[0], 16), image_name)
+
+    def lookup(self, image_hash: ImageHash) -> Optional[Tuple[str, list, int]]:
+        """Finds the closest annotated image with a similar aspect ratio.
+
+        Returns:
+            tuple: image name, its entry and the distance, None if there is no
+                image within max_distance.
+        """
+        with self._lock:
+            self._refresh()
+            self._counters["lookups"] += 1
+            found: List[Tuple[int, str, list]] = []
+            for distance, value, image_names in self._hashes.search(image_hash.value):
+                for image_name in image_names:
+                    entry = self._entries.get(image_name)
+                    if entry is None or int(entry[0], 16) != value:
+                        continue
+                    aspect_ratio = entry[1] / entry[2]
+                    if (
+                        abs(aspect_ratio - image_hash.aspect_ratio) / aspect_ratio
+                        > ASPECT_RATIO_TOLERANCE
+                    ):
+                        continue
+                    found.append((distance, image_name, entry))
+            if not found:
+                return None
+            self._counters["hits"] += 1
+        distance, image_name, entry = min(found)
+        return image_name, entry, distance
+
+    def add(self, image_name: str, image_hash: ImageHash, generation) -> None:
+        """Records hash of an annotated image."""
+        entry = [
+            f"{image_hash.value:016x}",
+            image_hash.width,
+            image_hash.height,
+            int(generation or 0),
+        ]
+        self.store.put(image_name, entry)
+        with self._lock:
+            self._add_entry(image_name, entry)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns lookup and hit counters and the number of loaded hashes."""
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries))
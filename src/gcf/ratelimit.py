@@ -0,0 +1,247 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side rate limiting and retries for calls against a shared quota."""
+
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, Type
+
+# shortest wait for tokens, so that rounding errors of the refill can't make
+# a waiting caller spin with delays too small to advance the clock
+MIN_WAIT = 0.001
+
+
+class RateLimitTimeout(Exception):
+    """The call couldn't be started or retried before its deadline."""
+
+
+class AdaptiveRateLimiter:
+    """Thread-safe token bucket whose rate adapts to the quota (AIMD).
+
+    Without an initial <rate> calls aren't limited until the first one is throttled,
+    the rate then starts at the rate of calls seen in the last second.
+    Every success raises the rate by <increase> per token it consumed, up to
+    <max_rate>, every throttled call multiplies it by <decrease>, down to <min_rate>.
+    The bucket holds at most <burst> tokens, so an idle instance can start
+    a burst of that size without waiting.
+
+    Args:
+        rate: initial rate in tokens (e.g. images) per second, None for no limit
+        burst: capacity of the bucket
+        min_rate: lowest rate the limiter backs off to
+        max_rate: highest rate the limiter probes up to, None for no limit
+        increase: additive increase of the rate per token of a successful call
+        decrease: multiplicative decrease of the rate per throttled call
+        clock: time source, for tests
+        sleep: sleep function, for tests
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: float = 10.0,
+        min_rate: float = 0.5,
+        max_rate: Optional[float] = None,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.min_rate = min_rate
+        self.max_rate = None if max_rate is None else max(max_rate, min_rate)
+        self.rate = None if rate is None else self._bounded(rate)
+        self.burst = max(burst, 1.0)
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        # tokens taken in the current and the last full second, while not limited
+        self._demand = 0.0
+        self._demand_since = self._updated
+        self._last_demand = 0.0
+        self._lock = threading.Lock()
+        self._counters = {
+            "calls": 0,
+            "throttled": 0,
+            "retries": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    def _bounded(self, rate: float) -> float:
+        rate = max(rate, self.min_rate)
+        return rate if self.max_rate is None else min(rate, self.max_rate)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _record_demand(self, now: float, tokens: float) -> None:
+        if now - self._demand_since >= 1.0:
+            self._last_demand = self._demand / (now - self._demand_since)
+            self._demand = 0.0
+            self._demand_since = now
+        self._demand += tokens
+
+    def acquire(self, tokens: float = 1.0, deadline: Optional[float] = None) -> float:
+        """Takes tokens from the bucket, waiting for them if needed.
+
+        Requests for more than <burst> tokens wait for a full bucket and take it all.
+
+        Args:
+            tokens: number of tokens, e.g. images of a batch request.
+            deadline: clock() time by which the tokens must be acquired.
+
+        Returns:
+            float: seconds waited.
+
+        Raises:
+            RateLimitTimeout: the tokens won't be available before the deadline.
+        """
+        tokens = min(tokens, self.burst)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                if self.rate is None:
+                    self._record_demand(now, tokens)
+                    self._counters["calls"] += 1
+                    return 0.0
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self._counters["calls"] += 1
+                    if waited:
+                        self._counters["waits"] += 1
+                        self._counters["wait_seconds"] += waited
+                    return waited
+                delay = max(MIN_WAIT, (tokens - self._tokens) / self.rate)
+            if deadline is not None and now + delay > deadline:
+                raise RateLimitTimeout(f"Rate limit wait {delay:.2f}s exceeds deadline")
+            self.sleep(delay)
+            waited += delay
+
+    def success(self, tokens: float = 1.0) -> None:
+        """Additive increase of the rate after a call of <tokens> within the quota."""
+        with self._lock:
+            if self.rate is not None:
+                self.rate = self._bounded(self.rate + self.increase * tokens)
+
+    def throttled(self) -> None:
+        """Multiplicative decrease of the rate after a call rejected by the quota."""
+        with self._lock:
+            now = self.clock()
+            if self.rate is None:
+                # the first throttled call limits the rate seen so far
+                elapsed = max(now - self._demand_since, 1.0)
+                self.rate = max(self._last_demand, self._demand / elapsed)
+                self._updated = now
+            self.rate = self._bounded(self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            self._counters["throttled"] += 1
+
+    def backed_off(self, seconds: float) -> None:
+        """Records a retry after <seconds> of backoff."""
+        with self._lock:
+            self._counters["retries"] += 1
+            self._counters["backoff_seconds"] += seconds
+
+    def stats(self) -> Dict[str, float]:
+        """Returns current rate (0 when not limited) and counters.
+
+        throttled_seconds is the time spent waiting for tokens and backing off.
+        """
+        with self._lock:
+            return dict(
+                self._counters,
+                rate=self.rate or 0.0,
+                throttled_seconds=self._counters["wait_seconds"]
+                + self._counters["backoff_seconds"],
+            )
+
+
+def backoff_delay(
+    attempt: int, initial: float = 0.5, maximum: float = 32.0, multiplier: float = 2.0
+) -> float:
+    """Returns jittered exponential backoff delay of the retry <attempt> (from 0).
+
+    Full jitter: uniformly random between 0 and the exponential delay, so retries
+    of many concurrent callers spread out instead of arriving together.
+    """
+    return random.uniform(0, min(maximum, initial * multiplier**attempt))
+
+
+def call_with_retry(
+    call: Callable[[float], object],
+    limiter: AdaptiveRateLimiter,
+    retryable: Tuple[Type[BaseException], ...],
+    throttling: Tuple[Type[BaseException], ...],
+    deadline: float,
+    timeout: float,
+    tokens: float = 1.0,
+    max_retries: int = 5,
+    initial_backoff: float = 0.5,
+    max_backoff: float = 32.0,
+    on_error: Optional[Callable[[BaseException], None]] = None,
+):
+    """Calls <call>(timeout) through the rate limiter, retrying retryable errors.
+
+    Args:
+        call: the call, receives the timeout in seconds for this attempt.
+        limiter: rate limiter shared by all callers of the quota.
+        retryable: errors after which the call is retried.
+        throttling: retryable errors meaning the quota was exceeded, they slow down
+            the limiter.
+        deadline: limiter clock time by which the call must complete.
+        timeout: max. timeout of a single attempt.
+        tokens: quota units the call consumes.
+        max_retries: max. retries after the first attempt.
+        on_error: called with every error before it's retried or raised.
+
+    Returns:
+        the result of the call.
+
+    Raises:
+        the last error when it isn't retryable, retries are exhausted or there is
+        no time left for another attempt. RateLimitTimeout if the call couldn't be
+        started before the deadline.
+    """
+    clock = limiter.clock
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens, deadline)
+        remaining = deadline - clock()
+        try:
+            result = call(min(timeout, remaining))
+        except retryable as e:
+            if on_error:
+                on_error(e)
+            if isinstance(e, throttling):
+                limiter.throttled()
+            delay = backoff_delay(attempt, initial_backoff, max_backoff)
+            if attempt == max_retries or clock() + delay >= deadline:
+                raise
+            limiter.sleep(delay)
+            limiter.backed_off(delay)
+            continue
+        except Exception as e:
+            if on_error:
+                on_error(e)
+            raise
+        limiter.success(tokens)
+        return result
@@ -0,0 +1,256 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inverted index of annotation terms, kept in a GCS bucket as sharded JSON objects."""
+
+import heapq
+import math
+import re
+import zlib
+from concurrent.futures import Executor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sharded_store import ShardedJsonStore
+
+# annotation lists with a description and score -> namespace of their terms
+SCORED_ANNOTATIONS = {
+    "labelAnnotations": ("label", "description"),
+    "localizedObjectAnnotations": ("object", "name"),
+    "landmarkAnnotations": ("landmark", "description"),
+    "logoAnnotations": ("logo", "description"),
+}
+TEXT_NAMESPACE = "text"
+NAMESPACES = tuple(namespace for namespace, _ in SCORED_ANNOTATIONS.values()) + (
+    TEXT_NAMESPACE,
+)
+# scores are stored as confidence buckets 0..10, detected text has the top one
+SCORE_BUCKETS = 10
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokens(text: str) -> List[str]:
+    """Returns lowercase words of the text."""
+    return TOKEN_RE.findall(text.lower())
+
+
+def score_bucket(score: float) -> int:
+    return max(0, min(SCORE_BUCKETS, int(score * SCORE_BUCKETS)))
+
+
+def annotation_terms(annotation: dict, max_text_terms: int = 100) -> Dict[str, int]:
+    """Returns terms "<namespace>:<word>" of the annotation with their confidence buckets.
+
+    Args:
+        annotation: parsed JSON of AnnotateImageResponse
+        max_text_terms: max. number of distinct words of detected text
+    """
+    terms: Dict[str, int] = {}
+    for field, (namespace, description_field) in SCORED_ANNOTATIONS.items():
+        for item in annotation.get(field, []):
+            bucket = score_bucket(item.get("score", 0.0))
+            for word in tokens(item.get(description_field, "")):
+                term = f"{namespace}:{word}"
+                terms[term] = max(bucket, terms.get(term, 0))
+    text_annotations = annotation.get("textAnnotations", [])
+    if text_annotations:
+        # the first item is the whole detected text
+        words = dict.fromkeys(tokens(text_annotations[0].get("description", "")))
+        for word in list(words)[:max_text_terms]:
+            terms[f"{TEXT_NAMESPACE}:{word}"] = SCORE_BUCKETS
+    return terms
+
+
+def query_terms(query: str) -> List[List[str]]:
+    """Parses a query into a list of alternatives of terms.
+
+    Words prefixed with a namespace (e.g. label:dog) match terms of the namespace,
+    other words match terms of any namespace. Every word must match.
+    """
+    alternatives = []
+    for item in query.split():
+        namespace, has_namespace, text = item.partition(":")
+        namespaces = [namespace.lower()] if has_namespace else list(NAMESPACES)
+        if not has_namespace:
+            text = item
+        for word in tokens(text):
+            alternatives.append([f"{namespace}:{word}" for namespace in namespaces])
+    return alternatives
+
+
+class SearchIndex:
+    """Inverted index: term -> {image name: confidence bucket}.
+
+    Images of every term are split into <partitions> posting lists "<term>#<n>"
+    by the image name hash, sharded in <postings>. An update of an image then
+    rewrites small parts of the lists of frequent terms. Terms of every image
+    are kept in <documents> so that an update of an image removes its old terms.
+
+    Args:
+        postings: store of the posting lists
+        documents: store of image name -> list of terms
+        executor: runs updates of the shards in parallel
+        partitions: number of posting lists of a term, must not change once
+            the index is built
+    """
+
+    def __init__(
+        self,
+        postings: ShardedJsonStore,
+        documents: ShardedJsonStore,
+        executor: Optional[Executor] = None,
+        partitions: int = 16,
+    ):
+        self.postings = postings
+        self.documents = documents
+        self.executor = executor
+        self.partitions = partitions
+
+    def ready(self) -> bool:
+        """Checks if the index was built, see rebuild()."""
+        return self.postings.ready()
+
+    def posting_key(self, term: str, image_name: str) -> str:
+        partition = zlib.crc32(image_name.encode("utf-8")) % self.partitions
+        return f"{term}#{partition}"
+
+    def posting_keys(self, term: str) -> List[str]:
+        return [f"{term}#{partition}" for partition in range(self.partitions)]
+
+    def update(self, image_name: str, terms: Dict[str, int]) -> None:
+        """Replaces terms of the image."""
+        old_terms = self.documents.read(
+            self.documents.shard_of(image_name), fresh=True
+        ).get(image_name, [])
+        # shard -> posting list key -> new confidence bucket, None to remove the image
+        by_shard: Dict[int, Dict[str, Optional[int]]] = {}
+        for term in set(old_terms) | set(terms):
+            key = self.posting_key(term, image_name)
+            by_shard.setdefault(self.postings.shard_of(key), {})[key] = terms.get(term)
+
+        def update_shard(shard: int) -> bool:
+            def mutate(content: dict) -> bool:
+                changed = False
+                for key, bucket in by_shard[shard].items():
+                    postings = content.get(key, {})
+                    if postings.get(image_name) == bucket:
+                        continue
+                    postings = dict(postings)
+                    if bucket is None:
+                        postings.pop(image_name, None)
+                    else:
+                        postings[image_name] = bucket
+                    if postings:
+                        content[key] = postings
+                    else:
+                        content.pop(key, None)
+                    changed = True
+                return changed
+
+            return self.postings.update(shard, mutate)
+
+        if self.executor and len(by_shard) > 1:
+            list(self.executor.map(update_shard, by_shard))
+        else:
+            for shard in by_shard:
+                update_shard(shard)
+        self.documents.put(image_name, sorted(terms))
+
+    def rebuild(self, items: Iterable[Tuple[str, Dict[str, int]]], meta: dict) -> int:
+        """Replaces content of the index with terms of the images.
+
+        Returns:
+            int: number of indexed images.
+        """
+        postings: Dict[str, Dict[str, int]] = {}
+        documents = {}
+        for image_name, terms in items:
+            documents[image_name] = sorted(terms)
+            for term, bucket in terms.items():
+                postings.setdefault(self.posting_key(term, image_name), {})[
+                    image_name
+                ] = bucket
+        self.documents.write_all(documents.items(), meta)
+        self.postings.write_all(
+            postings.items(),
+            dict(meta, images=len(documents), partitions=self.partitions),
+        )
+        return len(documents)
+
+    def matches(self, terms: List[str], min_bucket: int) -> Dict[str, int]:
+        """Returns images having any of the terms, with their best confidence bucket."""
+        matches: Dict[str, int] = {}
+        for term in terms:
+            for key in self.posting_keys(term):
+                postings = self.postings.get(key)
+                if not postings:
+                    continue
+                if not matches and min_bucket == 0:
+                    matches.update(postings)
+                    continue
+                for image_name, bucket in postings.items():
+                    if bucket >= min_bucket and bucket > matches.get(image_name, -1):
+                        matches[image_name] = bucket
+        return matches
+
+    def search(
+        self, query: str, min_score: float = 0.0, offset: int = 0, limit: int = 20
+    ) -> Tuple[List[Tuple[str, float]], int]:
+        """Finds images matching all words of the query.
+
+        Images are ranked by the sum of confidences of the matched terms, then by name.
+
+        Returns:
+            tuple: page of (image name, score) and the number of all matching images.
+        """
+        alternatives = query_terms(query)
+        if not alternatives:
+            return [], 0
+        min_bucket = math.ceil(min_score * SCORE_BUCKETS)
+        self.postings.prefetch(
+            key
+            for terms in alternatives
+            for term in terms
+            for key in self.posting_keys(term)
+        )
+        scores: Dict[str, int] = {}
+        for position, terms in enumerate(alternatives):
+            matches = self.matches(terms, min_bucket)
+            if position == 0:
+                scores = matches
+            else:
+                scores = {
+                    image_name: score + matches[image_name]
+                    for image_name, score in scores.items()
+                    if image_name in matches
+                }
+            if not scores:
+                return [], 0
+        # scores are small integers, images are grouped by them and only the groups
+        # up to the requested page are sorted by name
+        by_score: Dict[int, List[str]] = {}
+        for image_name, score in scores.items():
+            by_score.setdefault(score, []).append(image_name)
+        page: List[Tuple[str, float]] = []
+        skip = offset
+        for score in sorted(by_score, reverse=True):
+            group = by_score[score]
+            if skip >= len(group):
+                skip -= len(group)
+                continue
+            names = heapq.nsmallest(skip + limit - len(page), group)[skip:]
+            skip = 0
+            page.extend((image_name, score / SCORE_BUCKETS) for image_name in names)
+            if len(page) >= limit:
+                break
+        return page, len(scores)
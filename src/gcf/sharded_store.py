@@ -0,0 +1,267 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Key-value state kept in a GCS bucket as a set of sharded JSON objects."""
+
+import json
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from lazy_module import lazy_import
+
+exceptions = lazy_import("google.api_core.exceptions")
+
+
+class ShardedJsonStore:
+    """Dictionary sharded by key hash into JSON objects <prefix>NNNN.json.
+
+    Shards are cached per instance for <ttl> seconds. Updates are read-modify-write
+    cycles guarded by the object generation (if_generation_match), so concurrent
+    writers from other instances never lose each other's updates.
+
+    Args:
+        get_bucket: returns the google.cloud.storage.Bucket holding the shards
+        prefix: object name prefix of the shards
+        num_shards: number of shards, must not change once the store is written
+        ttl: how long a shard read from GCS is considered fresh, in seconds
+        max_retries: max. attempts of a conditional update
+    """
+
+    def __init__(
+        self,
+        get_bucket: Callable,
+        prefix: str,
+        num_shards: int = 256,
+        ttl: float = 30.0,
+        max_retries: int = 10,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.get_bucket = get_bucket
+        self.prefix = prefix
+        self.num_shards = num_shards
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self._clock = clock
+        # shard number -> (time read, generation, content)
+        self._cache: Dict[int, Tuple[float, int, dict]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def meta_name(self) -> str:
+        return self.prefix + "meta.json"
+
+    def shard_of(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % self.num_shards
+
+    def shard_name(self, shard: int) -> str:
+        return f"{self.prefix}{shard:04d}.json"
+
+    def _download(self, name: str) -> Tuple[int, Optional[dict]]:
+        blob = self.get_bucket().blob(name)
+        try:
+            content = blob.download_as_bytes()
+        except exceptions.NotFound:
+            return 0, None
+        # generation is set from the download response headers
+        return int(blob.generation or 0), json.loads(content)
+
+    def read(self, shard: int, fresh: bool = False) -> dict:
+        """Returns content of the shard, from the instance cache when it is fresh enough.
+
+        The returned dictionary must not be modified.
+        """
+        now = self._clock()
+        with self._lock:
+            cached = self._cache.get(shard)
+        if cached and not fresh and now - cached[0] <= self.ttl:
+            return cached[2]
+        generation, content = self._download(self.shard_name(shard))
+        content = content or {}
+        with self._lock:
+            self._cache[shard] = (now, generation, content)
+        return content
+
+    def prefetch(self, keys: Iterable[str], max_workers: int = 16) -> None:
+        """Loads shards of the keys which are not fresh in the cache, in parallel."""
+        self.prefetch_shards(set(self.shard_of(key) for key in keys), max_workers)
+
+    def prefetch_shards(self, shards: Iterable[int], max_workers: int = 16) -> None:
+        """Loads the shards which are not fresh in the cache, in parallel."""
+        now = self._clock()
+        with self._lock:
+            shards = set(
+                shard
+                for shard in shards
+                if shard not in self._cache or now - self._cache[shard][0] > self.ttl
+            )
+        if len(shards) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(self.read, shards))
+
+    def items(self, max_workers: int = 16) -> Iterator[Tuple[str, object]]:
+        """Yields all keys and values, shards not fresh in the cache are read in parallel."""
+        self.prefetch_shards(range(self.num_shards), max_workers)
+        for shard in range(self.num_shards):
+            yield from self.read(shard).items()
+
+    def get(self, key: str, default=None):
+        return self.read(self.shard_of(key)).get(key, default)
+
+    def contains(self, key: str) -> bool:
+        return key in self.read(self.shard_of(key))
+
+    def update(self, shard: int, mutate: Callable[[dict], bool]) -> bool:
+        """Applies <mutate> to a copy of the shard and stores it conditionally.
+
+        <mutate> returns False when it didn't change the content, nothing is written then.
+        The update is repeated with the current content when another writer wins the race.
+
+        Returns:
+            bool: True if the shard was written.
+        """
+        for attempt in range(self.max_retries):
+            generation, content = self._download(self.shard_name(shard))
+            content = dict(content or {})
+            if not mutate(content):
+                return False
+            blob = self.get_bucket().blob(self.shard_name(shard))
+            try:
+                blob.upload_from_string(
+                    json.dumps(content, separators=(",", ":")),
+                    content_type="application/json",
+                    if_generation_match=generation,
+                )
+            except exceptions.PreconditionFailed:
+                time.sleep(random.uniform(0, 0.05 * 2**attempt))
+                continue
+            with self._lock:
+                self._cache[shard] = (
+                    self._clock(),
+                    int(blob.generation or 0),
+                    content,
+                )
+            return True
+        raise RuntimeError(f"Too many concurrent updates of {self.shard_name(shard)}")
+
+    def put(self, key: str, value) -> bool:
+        """Sets value of the key, returns True if the store was modified."""
+
+        def mutate(content: dict) -> bool:
+            if content.get(key) == value:
+                return False
+            content[key] = value
+            return True
+
+        return self.update(self.shard_of(key), mutate)
+
+    def delete(self, key: str) -> bool:
+        """Removes the key, returns True if the store was modified."""
+        return self.update(
+            self.shard_of(key), lambda content: content.pop(key, None) is not None
+        )
+
+    def ready(self) -> bool:
+        """Checks if the store was fully built, see write_all()."""
+        now = self._clock()
+        with self._lock:
+            cached = self._cache.get(-1)
+        if cached and now - cached[0] <= self.ttl:
+            return cached[2] is not None
+        blob = self.get_bucket().blob(self.meta_name)
+        meta = blob.exists()
+        with self._lock:
+            self._cache[-1] = (now, 0, {} if meta else None)
+        return meta
+
+    def _write_shard(self, shard: int, content: dict, base: Tuple[int, dict]) -> None:
+        """Stores content of a shard rebuilt from a snapshot.
+
+        Changes made to the shard by other writers since the snapshot <base>
+        was read are applied on top of <content>, the write is conditional.
+        """
+        base_generation, base_content = base
+        generation, current = base_generation, base_content
+        for attempt in range(self.max_retries):
+            merged = dict(content)
+            if generation != base_generation:
+                for key, value in current.items():
+                    if base_content.get(key) != value:
+                        merged[key] = value
+                for key in base_content.keys() - current.keys():
+                    merged.pop(key, None)
+            blob = self.get_bucket().blob(self.shard_name(shard))
+            try:
+                blob.upload_from_string(
+                    json.dumps(merged, separators=(",", ":")),
+                    content_type="application/json",
+                    if_generation_match=generation,
+                )
+                return
+            except exceptions.PreconditionFailed:
+                time.sleep(random.uniform(0, 0.05 * 2**attempt))
+            generation, current = self._download(self.shard_name(shard))
+            current = current or {}
+        raise RuntimeError(f"Too many concurrent updates of {self.shard_name(shard)}")
+
+    def write_all(
+        self,
+        items: Iterable[Tuple[str, object]],
+        meta: dict,
+        max_workers: int = 16,
+    ) -> int:
+        """Replaces content of the whole store and marks it ready.
+
+        Shards are read before <items> are consumed, updates and deletions made
+        by other writers while the items are produced are kept.
+
+        Returns:
+            int: number of stored keys.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            snapshot = list(
+                executor.map(
+                    lambda shard: self._download(self.shard_name(shard)),
+                    range(self.num_shards),
+                )
+            )
+        shards: Dict[int, dict] = {shard: {} for shard in range(self.num_shards)}
+        count = 0
+        for key, value in items:
+            shards[self.shard_of(key)][key] = value
+            count += 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(
+                executor.map(
+                    lambda shard: self._write_shard(
+                        shard,
+                        shards[shard],
+                        (snapshot[shard][0], snapshot[shard][1] or {}),
+                    ),
+                    range(self.num_shards),
+                )
+            )
+        self.get_bucket().blob(self.meta_name).upload_from_string(
+            json.dumps(dict(meta, keys=count, shards=self.num_shards)),
+            content_type="application/json",
+        )
+        self.clear_cache()
+        return count
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
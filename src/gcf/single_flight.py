@@ -0,0 +1,89 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of concurrent identical calls into a single execution."""
+
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlightTimeout(Exception):
+    """The call shared with another caller didn't finish before the timeout."""
+
+
+class SingleFlight:
+    """Thread-safe group of calls in flight, keyed by what they compute.
+
+    The first caller of a key (the leader) runs the function, callers of the same
+    key arriving before it finishes wait for its result, or its exception.
+    Results aren't kept after the call finishes, that is the job of a cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self._counters = {"calls": 0, "coalesced": 0, "errors": 0, "timeouts": 0}
+
+    def do(
+        self, key: Hashable, fn: Callable[[], T], timeout: Optional[float] = None
+    ) -> Tuple[T, bool]:
+        """Runs fn() unless a call of the same key is in flight, then shares its result.
+
+        Args:
+            key: identifies the result of fn
+            fn: function computing the result
+            timeout: max. seconds to wait for the call of another caller
+
+        Returns:
+            tuple: the result and True if this caller ran fn, False if it was shared.
+
+        Raises:
+            SingleFlightTimeout: the shared call didn't finish within <timeout>.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self._counters["calls"] += 1
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            try:
+                return future.result(timeout), False
+            except FuturesTimeoutError:
+                with self._lock:
+                    self._counters["timeouts"] += 1
+                raise SingleFlightTimeout(f"Call of {key} is still running.")
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self._counters["errors"] += 1
+                del self._calls[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._calls[key]
+        future.set_result(result)
+        return result, True
+
+    def stats(self) -> Dict[str, int]:
+        """Returns counters of executed, coalesced, failed and timed out calls."""
+        with self._lock:
+            return dict(self._counters, in_flight=len(self._calls))
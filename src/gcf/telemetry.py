@@ -0,0 +1,375 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tracing spans and latency histograms of the annotation pipeline stages.
+
+TELEMETRY_EXPORTER environment variable selects where spans and metrics go:
+    gcp: Cloud Trace, and Cloud Monitoring when opentelemetry-exporter-gcp-monitoring
+        is installed. Default in Cloud Functions.
+    console: printed to stdout, for local runs.
+    memory: kept in memory for finished_spans() and metrics_data(), used by tests.
+    none: disabled, a stage then costs a function call. Default outside of
+        Cloud Functions, e.g. in benchmarks.
+
+OpenTelemetry SDK is imported when the first stage starts, not at cold start.
+Every stage is a span and a sample of the gcf.stage.duration histogram (ms),
+attributed by the stage name and the low-cardinality METRIC_ATTRIBUTES.
+"""
+
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Optional
+
+TELEMETRY_EXPORTER_ENV = "TELEMETRY_EXPORTER"
+TELEMETRY_EXPORTERS = ("gcp", "console", "memory", "none")
+METRICS_EXPORT_INTERVAL_MS = 60000
+STAGE_DURATION_METRIC = "gcf.stage.duration"
+IMAGE_SIZE_METRIC = "gcf.image.size"
+# span attributes which are also histogram attributes, they must have few distinct values
+METRIC_ATTRIBUTES = ("stage", "cache.hit", "feature.count", "error.type")
+
+
+class Stage:
+    """A running pipeline stage: its span and attributes of its duration sample."""
+
+    __slots__ = ("span", "metric_attributes", "image_size")
+
+    def __init__(self, span, name: str):
+        self.span = span
+        self.metric_attributes: Dict[str, object] = {"stage": name}
+        self.image_size: Optional[int] = None
+
+    def set(self, **attributes) -> None:
+        """Sets attributes of the stage, "_" in names stands for ".".
+
+        E.g. set(cache_hit=True) sets the attribute cache.hit, None values are ignored.
+        """
+        for key, value in attributes.items():
+            if value is None:
+                continue
+            name = key.replace("_", ".")
+            self.span.set_attribute(name, value)
+            if name in METRIC_ATTRIBUTES:
+                self.metric_attributes[name] = value
+            elif name == "image.size":
+                self.image_size = int(value)
+
+
+class NullStage:
+    """Stage used when telemetry is disabled."""
+
+    __slots__ = ()
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Telemetry:
+    """Tracer and histograms of the instance, exporting to the selected exporter."""
+
+    def __init__(self, exporter: str):
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import (
+            BatchSpanProcessor,
+            SimpleSpanProcessor,
+        )
+
+        self.exporter = exporter
+        self.span_exporter = None
+        self.metric_reader = None
+        if exporter == "gcp":
+            from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+
+            # spans are exported in the background, not in the request path
+            processor = BatchSpanProcessor(CloudTraceSpanExporter())
+            self.metric_reader = gcp_metric_reader()
+        elif exporter == "console":
+            from opentelemetry.sdk.metrics.export import (
+                ConsoleMetricExporter,
+                PeriodicExportingMetricReader,
+            )
+            from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+            processor = SimpleSpanProcessor(ConsoleSpanExporter())
+            self.metric_reader = PeriodicExportingMetricReader(
+                ConsoleMetricExporter(),
+                export_interval_millis=METRICS_EXPORT_INTERVAL_MS,
+            )
+        else:
+            from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+            from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+                InMemorySpanExporter,
+            )
+
+            self.span_exporter = InMemorySpanExporter()
+            processor = SimpleSpanProcessor(self.span_exporter)
+            self.metric_reader = InMemoryMetricReader()
+        resource = Resource.create(
+            {"service.name": os.environ.get("K_SERVICE", "annotate")}
+        )
+        # providers are owned by the instance, not registered globally,
+        # so that they can be replaced, e.g. between tests
+        self.tracer_provider = TracerProvider(resource=resource)
+        self.tracer_provider.add_span_processor(processor)
+        self.meter_provider = MeterProvider(
+            resource=resource,
+            metric_readers=[self.metric_reader] if self.metric_reader else [],
+        )
+        self.tracer = self.tracer_provider.get_tracer(__name__)
+        self.meter = self.meter_provider.get_meter(__name__)
+        self.stage_duration = self.meter.create_histogram(
+            STAGE_DURATION_METRIC,
+            unit="ms",
+            description="Duration of annotation pipeline stages.",
+        )
+        self.image_size = self.meter.create_histogram(
+            IMAGE_SIZE_METRIC, unit="By", description="Size of processed images."
+        )
+
+    def record(self, stage: Stage, duration_ms: float) -> None:
+        self.stage_duration.record(duration_ms, stage.metric_attributes)
+        if stage.image_size is not None:
+            self.image_size.record(
+                stage.image_size, {"stage": stage.metric_attributes["stage"]}
+            )
+
+    def observe(
+        self, name: str, callback: Callable[[], Dict[str, float]], description: str
+    ) -> None:
+        """Exports values returned by <callback> as a gauge attributed by their keys."""
+        from opentelemetry.metrics import Observation
+
+        def observations(options):
+            return [
+                Observation(value, {"stat": key}) for key, value in callback().items()
+            ]
+
+        self.meter.create_observable_gauge(
+            name, callbacks=[observations], description=description
+        )
+
+    def shutdown(self) -> None:
+        self.tracer_provider.shutdown()
+        self.meter_provider.shutdown()
+
+
+def gcp_metric_reader():
+    """Returns Cloud Monitoring metric reader, None if the exporter isn't installed."""
+    try:
+        from opentelemetry.exporter.cloud_monitoring import (
+            CloudMonitoringMetricsExporter,
+        )
+    except ImportError:
+        logging.warning("Cloud Monitoring exporter isn't installed, metrics disabled.")
+        return None
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+
+    return PeriodicExportingMetricReader(
+        CloudMonitoringMetricsExporter(),
+        export_interval_millis=METRICS_EXPORT_INTERVAL_MS,
+    )
+
+
+_telemetry_lock = threading.Lock()
+_telemetry: Optional[Telemetry] = None
+_telemetry_initialized = False
+_current_stage: contextvars.ContextVar = contextvars.ContextVar(
+    "current_stage", default=NULL_STAGE
+)
+
+
+def telemetry_exporter() -> str:
+    """Returns exporter selected by TELEMETRY_EXPORTER, see the module docstring."""
+    # K_SERVICE is set by the Cloud Functions (2nd gen) runtime
+    default = "gcp" if os.environ.get("K_SERVICE") else "none"
+    exporter = os.environ.get(TELEMETRY_EXPORTER_ENV, default).lower()
+    if exporter not in TELEMETRY_EXPORTERS:
+        logging.error("Invalid %s=%s.", TELEMETRY_EXPORTER_ENV, exporter)
+        return default
+    return exporter
+
+
+def get_telemetry() -> Optional[Telemetry]:
+    """Returns telemetry of the instance, None when it's disabled."""
+    global _telemetry, _telemetry_initialized
+    if _telemetry_initialized:
+        return _telemetry
+    with _telemetry_lock:
+        if not _telemetry_initialized:
+            exporter = telemetry_exporter()
+            if exporter != "none":
+                try:
+                    _telemetry = Telemetry(exporter)
+                except Exception as e:
+                    # e.g. missing credentials of the exporter, annotations still work
+                    logging.error("Telemetry disabled: %s", e)
+            _telemetry_initialized = True
+    return _telemetry
+
+
+def reset_telemetry() -> None:
+    """Flushes and drops the telemetry, the next stage sets it up again."""
+    global _telemetry, _telemetry_initialized
+    with _telemetry_lock:
+        if _telemetry is not None:
+            _telemetry.shutdown()
+        _telemetry = None
+        _telemetry_initialized = False
+
+
+@contextlib.contextmanager
+def stage(
+    name: str, carrier: Optional[Mapping[str, str]] = None, **attributes
+) -> Iterator[Stage]:
+    """Runs the enclosed code as a stage, i.e. a span and a duration sample.
+
+    Args:
+        name: name of the span and the stage attribute of the histogram.
+        carrier: headers of an incoming request with the parent trace context.
+        attributes: initial attributes, see Stage.set().
+
+    Yields:
+        Stage: for attributes known only while the stage runs.
+    """
+    telemetry = get_telemetry()
+    if telemetry is None:
+        yield NULL_STAGE
+        return
+    context = None
+    if carrier is not None:
+        from opentelemetry import propagate
+
+        context = propagate.extract(carrier)
+    start = time.perf_counter()
+    with telemetry.tracer.start_as_current_span(name, context=context) as span:
+        current = Stage(span, name)
+        current.set(**attributes)
+        token = _current_stage.set(current)
+        try:
+            yield current
+        except Exception as e:
+            current.set(error_type=type(e).__name__)
+            raise
+        finally:
+            _current_stage.reset(token)
+            telemetry.record(current, (time.perf_counter() - start) * 1000)
+
+
+def traced(name: str) -> Callable:
+    """Decorator running every call of the function as the stage <name>."""
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def set_attributes(**attributes) -> None:
+    """Sets attributes of the innermost running stage, see Stage.set()."""
+    _current_stage.get().set(**attributes)
+
+
+class TimedIterable:
+    """Iterable recording the time spent fetching its items as the stage <name>.
+
+    Lazy iterators, e.g. GCS listings, fetch pages while they are consumed, so
+    a stage around the call returning them would measure nothing. The span covers
+    the iteration, the duration sample only the fetching of items. Other attributes,
+    e.g. next_page_token, are read from the wrapped iterable.
+    """
+
+    def __init__(self, name: str, iterable: Iterable, **attributes):
+        self._name = name
+        self._iterable = iterable
+        self._attributes = attributes
+
+    def __getattr__(self, attr: str):
+        return getattr(self._iterable, attr)
+
+    def __iter__(self) -> Iterator:
+        telemetry = get_telemetry()
+        if telemetry is None:
+            yield from self._iterable
+            return
+        start_ns = time.time_ns()
+        fetching = 0.0
+        count = 0
+        error = None
+        iterator = iter(self._iterable)
+        try:
+            while True:
+                fetch_start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    fetching += time.perf_counter() - fetch_start
+                count += 1
+                yield item
+        finally:
+            span = telemetry.tracer.start_span(self._name, start_time=start_ns)
+            current = Stage(span, self._name)
+            current.set(item_count=count, **self._attributes)
+            if error is not None:
+                from opentelemetry.trace import Status, StatusCode
+
+                span.record_exception(error)
+                span.set_status(Status(StatusCode.ERROR, str(error)))
+                current.set(error_type=type(error).__name__)
+            span.end()
+            telemetry.record(current, fetching * 1000)
+
+
+def observe(
+    name: str, callback: Callable[[], Dict[str, float]], description: str = ""
+) -> None:
+    """Exports values returned by <callback> as the gauge <name>, if enabled."""
+    telemetry = get_telemetry()
+    if telemetry is not None:
+        telemetry.observe(name, callback, description)
+
+
+def finished_spans() -> list:
+    """Returns spans kept by the memory exporter."""
+    telemetry = get_telemetry()
+    if telemetry is None or telemetry.span_exporter is None:
+        return []
+    return list(telemetry.span_exporter.get_finished_spans())
+
+
+def metrics_data():
+    """Returns metrics collected by the memory exporter, None for other exporters."""
+    telemetry = get_telemetry()
+    if telemetry is None or telemetry.span_exporter is None:
+        return None
+    return telemetry.metric_reader.get_metrics_data()
@@ -0,0 +1,63 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+# spans and metrics of the tests are kept in memory instead of printed
+os.environ.setdefault("TELEMETRY_EXPORTER", "memory")
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        import main
+
+
+class FakeClock:
+    """Clock advanced only by sleep(), so tests don't wait."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def reset_instance_state():
+    # clients and caches live per instance, make sure every test starts with fresh ones
+    main.reset_instance_state()
+    yield
+    main.reset_instance_state()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture(autouse=True)
+def vision_rate_limiter(reset_instance_state, monkeypatch, clock):
+    # rate limit waits and backoff of retried Vision calls pass on the fake clock
+    limiter = main.AdaptiveRateLimiter(
+        burst=main.VISION_BATCH_SIZE_MAX, clock=clock, sleep=clock.sleep
+    )
+    monkeypatch.setattr(main, "_vision_rate_limiter", limiter)
+    return limiter
@@ -0,0 +1,133 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from unittest.mock import patch
+
+import flask
+import pytest
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import BACKFILL_CHECKPOINT, annotate_backfill, run_backfill
+
+
+def annotation_names(storage_client):
+    return [n for n in storage_client.names("out") if not n.startswith("_vision/")]
+
+
+@pytest.fixture
+def backend(mocker):
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    for i in range(7):
+        storage_client.put("in", f"img-{i}.jpg", b"image")
+    storage_client.put("out", "img-0.jpg.json", "{}")
+    return storage_client, vision_client
+
+
+def test_run_backfill(backend):
+    # Given
+    storage_client, vision_client = backend
+
+    # When
+    summary = run_backfill("in", "out", [], batch_size=2, concurrency=2)
+
+    # Then
+    assert summary == {"submitted": 6, "annotated": 6, "failed": 0, "manifest": 7}
+    assert vision_client.counters["async_batch"] == 3
+    assert annotation_names(storage_client) == [f"img-{i}.jpg.json" for i in range(7)]
+    annotation = json.loads(storage_client.bucket("out")._blobs["img-3.jpg.json"]._data)
+    assert annotation["labelAnnotations"][0]["description"] == "gs://in/img-3.jpg"
+
+
+def test_run_backfill_resumes_from_checkpoint(backend):
+    # Given
+    storage_client, vision_client = backend
+    storage_client.put("out", BACKFILL_CHECKPOINT, '{"start_offset": "img-4.jpg"}')
+
+    # When
+    summary = run_backfill("in", "out", [], batch_size=2, concurrency=1)
+
+    # Then
+    assert summary["submitted"] == 3
+    assert vision_client.counters["images"] == 3
+    assert BACKFILL_CHECKPOINT not in storage_client.names("out")
+
+
+def test_run_backfill_of_annotated_images(backend):
+    # Given
+    storage_client, vision_client = backend
+    for i in range(1, 7):
+        storage_client.put("out", f"img-{i}.jpg.json", "{}")
+
+    # When
+    summary = run_backfill("in", "out", [], batch_size=2, concurrency=1)
+
+    # Then
+    assert summary == {"submitted": 0, "annotated": 0, "failed": 0, "manifest": 7}
+    assert vision_client.counters["async_batch"] == 0
+    assert BACKFILL_CHECKPOINT not in storage_client.names("out")
+
+
+def test_run_backfill_reports_failed_images(backend):
+    # Given
+    storage_client, _ = backend
+    storage_client.put("in", "img-error.jpg", b"image")
+
+    # When
+    summary = run_backfill("in", "out", [], batch_size=4)
+
+    # Then
+    assert summary == {"submitted": 7, "annotated": 6, "failed": 1, "manifest": 7}
+    assert "img-error.jpg.json" not in storage_client.names("out")
+
+
+def test_backfill_resumes_pending_operations(backend, monkeypatch):
+    # Given
+    storage_client, vision_client = backend
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    vision_client.finish_operations = False
+
+    # When
+    with flask.Flask(__name__).test_request_context("/?batch_size=4"):
+        response = annotate_backfill(flask.request)
+    checkpoint = json.loads(
+        storage_client.bucket("out")._blobs[BACKFILL_CHECKPOINT]._data
+    )
+    vision_client.finish_operations = True
+    summary = run_backfill("in", "out", [], batch_size=4)
+
+    # Then
+    assert response.status_code == 202
+    assert json.loads(response.get_data()) == {
+        "submitted": 6,
+        "annotated": 0,
+        "failed": 0,
+        "pending": 6,
+    }
+    assert checkpoint["start_after"] == "img-6.jpg"
+    assert [batch["operation"] for batch in checkpoint["pending"]] == [
+        "operations/1",
+        "operations/2",
+    ]
+    assert summary == {"submitted": 0, "annotated": 6, "failed": 0, "manifest": 7}
+    assert vision_client.counters["async_batch"] == 2
+    assert annotation_names(storage_client) == [f"img-{i}.jpg.json" for i in range(7)]
+    assert BACKFILL_CHECKPOINT not in storage_client.names("out")
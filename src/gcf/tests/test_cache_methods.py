@@ -0,0 +1,172 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import patch
+
+import flask
+import pytest
+from google.api_core import exceptions
+
+from annotation_cache import AnnotationCache
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        import main
+        from main import (
+            annotate_gcs,
+            annotate_http,
+            annotation_cache_key,
+            build_features_list,
+        )
+
+
+class DictStore(dict):
+    def put(self, key, value):
+        self[key] = value
+
+
+def test_annotation_cache_evicts_least_recently_used():
+    # Given
+    cache = AnnotationCache(max_entries=2, max_bytes=100)
+    cache.put("a", "1")
+    cache.put("b", "2")
+
+    # When
+    cache.get("a")
+    cache.put("c", "3")
+
+    # Then
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_annotation_cache_evicts_by_size_and_ttl():
+    # Given
+    now = [0.0]
+    cache = AnnotationCache(max_bytes=10, ttl=60, clock=lambda: now[0])
+
+    # When
+    cache.put("a", "x" * 6)
+    cache.put("b", "x" * 6)
+    now[0] = 30
+    in_time = cache.get("b")
+    now[0] = 61
+
+    # Then
+    assert cache.get("a") is None
+    assert in_time == "x" * 6
+    assert cache.get("b") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_annotation_cache_promotes_store_hits():
+    # Given
+    store = DictStore(a="1")
+    cache = AnnotationCache(store=store)
+
+    # When
+    results = [cache.get("a"), cache.get("a"), cache.get("b")]
+    cache.put("b", "2")
+
+    # Then
+    assert results == ["1", "1", None]
+    assert store["b"] == "2"
+    stats = cache.stats()
+    assert (stats["store_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_annotation_cache_key_ignores_feature_order():
+    # Given
+    features = build_features_list("LABEL_DETECTION,FACE_DETECTION")
+    reversed_features = build_features_list("FACE_DETECTION,LABEL_DETECTION")
+
+    # Then
+    assert annotation_cache_key("md5", features) == annotation_cache_key(
+        "md5", reversed_features
+    )
+    assert annotation_cache_key("md5", features) != annotation_cache_key("md5", [])
+    assert annotation_cache_key(None, features) is None
+
+
+def test_gcs_cache_store_errors_are_misses(mocker):
+    # Given
+    mocker.patch("google.cloud.storage.Client", FakeStorageClient)
+    blob = mocker.patch("main.gcs_blob").return_value
+    blob.download_as_bytes.side_effect = exceptions.ServiceUnavailable("read")
+    mocker.patch("main.gcs_write", side_effect=exceptions.ServiceUnavailable("write"))
+    store = main.GcsCacheStore("out")
+
+    # When
+    store.put("key", "{}")
+    value = store.get("key")
+
+    # Then
+    assert value is None
+
+
+@pytest.mark.parametrize("cache_mode", ["memory", "gcs"])
+def test_annotate_gcs_reuses_annotation_of_identical_image(
+    mocker, monkeypatch, cache_mode
+):
+    # Given
+    monkeypatch.setenv("ANNOTATION_CACHE", cache_mode)
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    storage_client.put("in", "a.jpg", b"same image")
+    storage_client.put("in", "copy-of-a.jpg", b"same image")
+    storage_client.put("in", "b.jpg", b"other image")
+
+    # When
+    for name in ("a.jpg", "copy-of-a.jpg", "b.jpg"):
+        annotate_gcs(finalized_event("in", name))
+
+    # Then
+    assert vision_client.counters["annotate"] == 2
+    names = storage_client.names("out")
+    cached = [n for n in names if n.startswith("_vision/cache/")]
+    annotations = [n for n in names if not n.startswith("_vision/")]
+    assert annotations == ["a.jpg.json", "b.jpg.json", "copy-of-a.jpg.json"]
+    assert len(cached) == (2 if cache_mode == "gcs" else 0)
+
+
+@pytest.mark.parametrize("cache_mode, digests", [("none", 0), ("memory", 1)])
+def test_annotate_computes_digest_only_for_cache(
+    mocker, monkeypatch, cache_mode, digests
+):
+    # Given
+    monkeypatch.setenv("ANNOTATION_CACHE", cache_mode)
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    storage_client.put("in", "a.jpg", b"image")
+    image_digest = mocker.spy(main, "image_digest")
+
+    # When
+    with flask.Flask(__name__).test_request_context(
+        "/annotate", query_string={"image_uri": "gs://in/a.jpg"}
+    ):
+        response = annotate_http(flask.request)
+
+    # Then
+    assert response.status_code == 200
+    assert image_digest.call_count == digests
@@ -0,0 +1,141 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+from google.api_core import exceptions
+from google.cloud import vision
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import (
+            annotate_image_uri,
+            get_storage_client,
+            get_vision_client,
+            get_vision_rate_limiter,
+            read_json_str,
+        )
+
+
+def test_storage_client_is_reused(mocker):
+    # Given
+    client_class = mocker.patch("google.cloud.storage.Client")
+
+    # When
+    for _ in range(3):
+        read_json_str("test-bucket", "image.jpg.json")
+
+    # Then
+    assert client_class.call_count == 1
+    assert get_storage_client() is client_class.return_value
+
+
+def test_vision_client_pool(mocker, monkeypatch):
+    # Given
+    monkeypatch.setenv("VISION_CLIENT_POOL_SIZE", "2")
+    client_class = mocker.patch("google.cloud.vision.ImageAnnotatorClient")
+    client_class.side_effect = lambda: mocker.MagicMock()
+
+    # When
+    clients = [get_vision_client() for _ in range(4)]
+
+    # Then
+    assert client_class.call_count == 2
+    assert clients[0] is clients[2]
+    assert clients[1] is clients[3]
+    assert clients[0] is not clients[1]
+
+
+def test_vision_client_recreated_after_failure(mocker):
+    # Given
+    client_class = mocker.patch("google.cloud.vision.ImageAnnotatorClient")
+    client_class.side_effect = lambda: mocker.MagicMock()
+    failed_client = get_vision_client()
+    failed_client.annotate_image.side_effect = exceptions.ServiceUnavailable("down")
+    mocker.patch.object(get_vision_rate_limiter(), "sleep")
+
+    # When
+    with patch.dict(os.environ, {"VISION_MAX_RETRIES": "0"}):
+        with pytest.raises(exceptions.ServiceUnavailable):
+            annotate_image_uri("gs://test-bucket/image.jpg", [])
+    new_client = get_vision_client()
+    new_client.annotate_image.return_value = vision.AnnotateImageResponse()
+    result = annotate_image_uri("gs://test-bucket/image.jpg", [])
+
+    # Then
+    assert new_client is not failed_client
+    assert client_class.call_count == 2
+    assert result is not None
+
+
+def test_vision_call_retried_with_new_client(mocker):
+    # Given
+    failed_client = mocker.MagicMock()
+    failed_client.annotate_image.side_effect = exceptions.ServiceUnavailable("down")
+    new_client = mocker.MagicMock()
+    new_client.annotate_image.return_value = vision.AnnotateImageResponse()
+    client_class = mocker.patch("google.cloud.vision.ImageAnnotatorClient")
+    client_class.side_effect = [failed_client, new_client]
+    mocker.patch.object(get_vision_rate_limiter(), "sleep")
+
+    # When
+    result = annotate_image_uri("gs://test-bucket/image.jpg", [])
+
+    # Then
+    assert result is not None
+    assert failed_client.annotate_image.call_count == 1
+    assert new_client.annotate_image.call_count == 1
+
+
+BUCKET_LIST_SCRIPT = """
+import sys
+from unittest.mock import patch
+
+import flask
+
+with patch("google.cloud.storage.Client") as client_class:
+    client_class.return_value.list_blobs.return_value = []
+    import main
+
+    with flask.Flask(__name__).test_request_context("/bucket/list"):
+        response = main.annotate_http(flask.request)
+print(response.status_code, "google.cloud.vision" in sys.modules)
+"""
+
+
+def test_bucket_routes_dont_import_vision():
+    # Given
+    env = dict(
+        os.environ,
+        FEATURES="LABEL_DETECTION",
+        INPUT_BUCKET="in",
+        ANNOTATIONS_BUCKET="out",
+    )
+
+    # When
+    result = subprocess.run(
+        [sys.executable, "-c", BUCKET_LIST_SCRIPT],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Then
+    assert result.stdout.split() == ["200", "False"]
@@ -0,0 +1,225 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import flask
+import pytest
+
+from admission import AdmissionRejected, MemoryAdmission
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        import main
+        from main import annotate_gcs, annotate_http
+
+
+def test_memory_admission_waits_in_order():
+    # Given
+    admission = MemoryAdmission(100)
+    order = []
+    first = admission.reserve(60)
+    first.__enter__()
+
+    def request(name, size):
+        with admission.reserve(size, timeout=5):
+            order.append(name)
+
+    # When
+    waiting = [
+        threading.Thread(target=request, args=("large", 80)),
+        threading.Thread(target=request, args=("small", 10)),
+    ]
+    for position, thread in enumerate(waiting):
+        thread.start()
+        # the second request arrives when the first one waits
+        while admission.stats()["waited"] < position + 1:
+            pass
+    with pytest.raises(AdmissionRejected):
+        with admission.reserve(10, timeout=0):
+            pass
+    first.__exit__(None, None, None)
+    for thread in waiting:
+        thread.join()
+
+    # Then
+    assert order == ["large", "small"]
+    stats = admission.stats()
+    assert (stats["admitted"], stats["rejected"], stats["reserved"]) == (3, 1, 0)
+    assert stats["peak"] <= 100
+
+
+def test_memory_admission_admits_oversized_request_alone():
+    # Given
+    admission = MemoryAdmission(100)
+
+    # When
+    with admission.reserve(500, timeout=0):
+        with pytest.raises(AdmissionRejected):
+            with admission.reserve(1, timeout=0):
+                pass
+
+    # Then
+    assert admission.stats()["peak"] == 500
+
+
+@pytest.fixture
+def clients(mocker, monkeypatch):
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    monkeypatch.setenv("ANNOTATION_CACHE", "none")
+    storage_client = FakeStorageClient(latency=0.001)
+    vision_client = FakeVisionClient(storage_client, latency=0.01)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    return storage_client, vision_client
+
+
+def call(path, method="GET", **kwargs):
+    with flask.Flask(__name__).test_request_context(path, method=method, **kwargs):
+        response = annotate_http(flask.request)
+        return response.status_code, response.get_data()
+
+
+def test_concurrent_requests_of_all_handlers(clients, monkeypatch):
+    # Given
+    storage_client, vision_client = clients
+    monkeypatch.setenv("MEMORY_LIMIT_MB", "64")
+    for i in range(20):
+        storage_client.put("in", f"{i:02d}.jpg", b"image %d" % i)
+
+    def upload(i):
+        return call(
+            "/annotate", "POST", data=b"upload %d" % i, content_type="image/png"
+        )
+
+    def annotate_uri(i):
+        return call("/annotate", query_string={"image_uri": f"gs://in/{i:02d}.jpg"})
+
+    def list_bucket(i):
+        return call("/bucket/list", query_string={"embed": "5"})
+
+    def event(i):
+        annotate_gcs(finalized_event("in", f"{i:02d}.jpg", event_id=str(i)))
+        return 200, b""
+
+    handlers = [upload, annotate_uri, list_bucket, event]
+
+    # When
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = list(executor.map(lambda i: (i, handlers[i % 4](i // 4)), range(80)))
+
+    # Then
+    assert [status for _, (status, _) in results] == [200] * 80
+    for i, (_, body) in results:
+        if i % 4 == 0:
+            assert "uploaded image" in body.decode()
+        elif i % 4 == 1:
+            assert f"gs://in/{i // 4:02d}.jpg" in body.decode()
+        elif i % 4 == 2:
+            assert len(json.loads(body)) == 20
+    assert vision_client.counters["annotate"] == 60
+    assert [name for name in storage_client.names("out")] == [
+        f"{i:02d}.jpg.json" for i in range(20)
+    ]
+    stats = main.get_memory_admission().stats()
+    assert (stats["admitted"], stats["reserved"], stats["running"]) == (60, 0, 0)
+    assert stats["peak"] <= stats["budget"] == 32 * 1024 * 1024
+
+
+def test_requests_over_memory_budget_are_rejected(clients, monkeypatch):
+    # Given
+    storage_client, vision_client = clients
+    monkeypatch.setenv("ADMISSION_MEMORY_MB", "3")
+    monkeypatch.setenv("ADMISSION_TIMEOUT", "0")
+    monkeypatch.setenv("NEAR_DUPLICATE_DISTANCE", "4")
+    storage_client.put("in", "a.jpg", b"x" * 200_000)
+    release = threading.Event()
+    annotate_image = vision_client.annotate_image
+
+    def blocked_annotate_image(request, **kwargs):
+        release.wait(5)
+        return annotate_image(request, **kwargs)
+
+    vision_client.annotate_image = blocked_annotate_image
+    # uploads reserve 1.9 MB, the list 1 MB and the event 1.6 MB of the 3 MB
+    upload = {"data": b"x" * 300_000, "content_type": "image/png"}
+
+    # When
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        running = executor.submit(call, "/annotate", "POST", **upload)
+        while main.get_memory_admission().stats()["running"] == 0:
+            pass
+        rejected = call("/annotate", "POST", **upload)
+        listed = call("/bucket/list")
+        with pytest.raises(AdmissionRejected):
+            annotate_gcs(finalized_event("in", "a.jpg"))
+        release.set()
+        admitted = running.result()
+    retried = call("/annotate", "POST", **upload)
+
+    # Then
+    assert rejected[0] == 503
+    assert listed[0] == 200
+    assert admitted[0] == 200
+    assert retried[0] == 200
+    stats = main.get_memory_admission().stats()
+    assert (stats["rejected"], stats["reserved"]) == (2, 0)
+
+
+def test_streamed_response_keeps_memory_reserved(clients, monkeypatch):
+    # Given
+    storage_client, vision_client = clients
+    monkeypatch.setenv("MEMORY_LIMIT_MB", "64")
+    release = threading.Event()
+    batch_annotate_images = vision_client.batch_annotate_images
+
+    def blocked_batch_annotate_images(requests=None, **kwargs):
+        # the first group is streamed, the second one waits until released
+        if len(requests) == 1:
+            release.wait(5)
+        return batch_annotate_images(requests=requests, **kwargs)
+
+    vision_client.batch_annotate_images = blocked_batch_annotate_images
+    app = flask.Flask(__name__)
+    app.add_url_rule(
+        "/<path:path>",
+        "annotate_http",
+        lambda path: annotate_http(flask.request),
+        methods=["POST"],
+    )
+    image_uris = [f"gs://in/{i}.jpg" for i in range(main.VISION_BATCH_SIZE_MAX + 1)]
+
+    # When
+    response = app.test_client().post(
+        "/annotate/batch?format=ndjson",
+        json={"image_uri": image_uris},
+        buffered=False,
+    )
+    streaming = main.get_memory_admission().stats()
+    release.set()
+    lines = response.get_data(as_text=True).splitlines()
+    response.close()
+
+    # Then
+    assert response.status_code == 200
+    assert len(lines) == main.VISION_BATCH_SIZE_MAX + 1
+    assert (streaming["running"], streaming["reserved"] > 0) == (1, True)
+    stats = main.get_memory_admission().stats()
+    assert (stats["admitted"], stats["reserved"], stats["running"]) == (1, 0, 0)
@@ -0,0 +1,195 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Iterable
+from unittest.mock import patch
+
+import pytest
+from cloudevents.http import CloudEvent
+from google.api_core import exceptions
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import annotate_gcs, reset_instance_state
+
+
+@pytest.fixture
+def storage_client(mocker, monkeypatch):
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    # only the idempotency checks may prevent annotation of an image
+    monkeypatch.setenv("ANNOTATION_CACHE", "none")
+    client = FakeStorageClient()
+    mocker.patch("google.cloud.storage.Client", lambda: client)
+    return client
+
+
+@pytest.fixture
+def vision_client(mocker, storage_client):
+    client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: client)
+    return client
+
+
+def upload(storage_client: FakeStorageClient, name: str, data: bytes) -> CloudEvent:
+    """Stores a new image version, returns its finalized event."""
+    blob = storage_client.put("in", name, data)
+    return finalized_event(
+        "in",
+        name,
+        event_id=f"{name}@{blob.generation}",
+        generation=str(blob.generation),
+        size=str(blob.size),
+        md5Hash=blob.md5_hash,
+    )
+
+
+def replay(events: Iterable[CloudEvent], new_instance: bool = False) -> None:
+    """Delivers the events in the given order, optionally each to a fresh instance."""
+    for event in events:
+        if new_instance:
+            reset_instance_state()
+        annotate_gcs(event)
+
+
+def annotation_metadata(storage_client: FakeStorageClient, name: str) -> dict:
+    return storage_client.bucket("out").get_blob(name + ".json").metadata
+
+
+@pytest.mark.parametrize("new_instance", [False, True])
+def test_redelivered_event_is_annotated_once(
+    storage_client, vision_client, new_instance
+):
+    # Given
+    event = upload(storage_client, "a.jpg", b"image")
+    replay([event])
+    annotation = storage_client.bucket("out").get_blob("a.jpg.json")
+
+    # When
+    replay([event, event], new_instance)
+
+    # Then
+    assert vision_client.counters["images"] == 1
+    assert storage_client.bucket("out").get_blob("a.jpg.json").generation == (
+        annotation.generation
+    )
+
+
+def test_out_of_order_event_keeps_newer_annotation(storage_client, vision_client):
+    # Given
+    old_event = upload(storage_client, "a.jpg", b"first version")
+    new_event = upload(storage_client, "a.jpg", b"second version")
+
+    # When
+    replay([new_event, old_event, new_event])
+
+    # Then
+    assert vision_client.counters["images"] == 1
+    metadata = annotation_metadata(storage_client, "a.jpg")
+    assert metadata["source-generation"] == new_event.data["generation"]
+    assert metadata["source-md5"] == new_event.data["md5Hash"]
+    assert metadata["annotation-config"]
+
+
+def test_rewrite_with_same_content_is_not_annotated(storage_client, vision_client):
+    # Given
+    first = upload(storage_client, "a.jpg", b"image")
+    replay([first])
+
+    # When
+    replay([upload(storage_client, "a.jpg", b"image")])
+    replay([upload(storage_client, "a.jpg", b"changed image")])
+
+    # Then
+    assert vision_client.counters["images"] == 2
+
+
+@pytest.mark.parametrize(
+    "env",
+    [
+        {"FEATURES": "TEXT_DETECTION"},
+        {"IMAGE_CONTEXT": '{"languageHints": ["en"]}'},
+        {"OUTPUT_COMPACT": "true"},
+    ],
+)
+def test_same_content_is_annotated_again_after_config_change(
+    storage_client, vision_client, monkeypatch, env
+):
+    # Given
+    replay([upload(storage_client, "a.jpg", b"image")])
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+    # When
+    replay([upload(storage_client, "a.jpg", b"image")], new_instance=True)
+    replay([upload(storage_client, "a.jpg", b"image")], new_instance=True)
+
+    # Then
+    assert vision_client.counters["images"] == 2
+
+
+def annotate_with_concurrent_event(vision_client, mocker, event: CloudEvent) -> None:
+    """Makes another instance process the event during the next Vision call."""
+    annotate = vision_client.annotate_image
+    calls = []
+
+    def annotate_with_concurrent_invocation(request, **kwargs):
+        calls.append(request)
+        if len(calls) == 1:
+            replay([event], new_instance=True)
+        return annotate(request, **kwargs)
+
+    mocker.patch.object(
+        vision_client,
+        "annotate_image",
+        side_effect=annotate_with_concurrent_invocation,
+    )
+
+
+def test_concurrent_write_of_newer_version_is_kept(
+    storage_client, vision_client, mocker
+):
+    # Given
+    old_event = upload(storage_client, "a.jpg", b"first version")
+    new_event = upload(storage_client, "a.jpg", b"second version")
+    annotate_with_concurrent_event(vision_client, mocker, new_event)
+
+    # When
+    annotate_gcs(old_event)
+
+    # Then
+    assert annotation_metadata(storage_client, "a.jpg")["source-generation"] == (
+        new_event.data["generation"]
+    )
+
+
+def test_concurrent_write_of_older_version_fails_for_retry(
+    storage_client, vision_client, mocker
+):
+    # Given
+    old_event = upload(storage_client, "a.jpg", b"first version")
+    new_event = upload(storage_client, "a.jpg", b"second version")
+    annotate_with_concurrent_event(vision_client, mocker, old_event)
+
+    # When
+    with pytest.raises(exceptions.PreconditionFailed):
+        annotate_gcs(new_event)
+    annotate_gcs(new_event)
+
+    # Then
+    assert annotation_metadata(storage_client, "a.jpg")["source-generation"] == (
+        new_event.data["generation"]
+    )
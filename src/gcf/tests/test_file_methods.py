@@ -0,0 +1,269 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+from unittest.mock import patch
+
+import flask
+import pytest
+from google.api_core import exceptions
+from PIL import Image
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+from file_pages import FileSummary, file_mimetype, frame_count, page_chunks
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import annotate_gcs, annotate_http
+
+
+def test_file_mimetype_and_page_chunks():
+    # Given
+    names = [
+        ("doc.pdf", None),
+        ("scan.TIFF", "application/octet-stream"),
+        ("doc.bin", "application/pdf; charset=binary"),
+        ("animation.gif", "image/gif"),
+        ("photo.jpg", "image/jpeg"),
+        ("report.pdf", "text/plain"),
+    ]
+
+    # When
+    mimetypes = [file_mimetype(name, content_type) for name, content_type in names]
+    chunks = list(page_chunks([1, 2, 3, 4, 5, 6, 8, 9], 5))
+
+    # Then
+    assert mimetypes == [
+        "application/pdf",
+        "image/tiff",
+        "application/pdf",
+        "image/gif",
+        None,
+        None,
+    ]
+    assert chunks == [[1, 2, 3, 4, 5], [6, 8, 9]]
+
+
+def test_file_summary_merges_pages():
+    # Given
+    summary = FileSummary("application/pdf")
+    summary.total_pages = 4
+
+    # When
+    summary.add(3, {"labelAnnotations": [{"description": "Cat", "score": 0.9}]})
+    summary.add(
+        1,
+        {
+            "labelAnnotations": [
+                {"description": "Cat", "score": 0.7, "mid": "/m/cat"},
+                {"description": "Dog", "score": 0.8},
+            ]
+        },
+    )
+    summary.add(2, {"error": {"code": 3, "message": "bad page"}})
+
+    # Then
+    assert summary.missing_pages() == [4]
+    assert summary.to_dict() == {
+        "mimeType": "application/pdf",
+        "totalPages": 4,
+        "failedPages": [{"page": 2, "error": {"code": 3, "message": "bad page"}}],
+        "labelAnnotations": [
+            {"description": "Cat", "score": 0.9, "mid": "/m/cat", "pages": [1, 3]},
+            {"description": "Dog", "score": 0.8, "pages": [1]},
+        ],
+    }
+
+
+@pytest.fixture
+def clients(mocker, monkeypatch):
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "DOCUMENT_TEXT_DETECTION")
+    monkeypatch.setenv("FILE_PARALLELISM", "3")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    return storage_client, vision_client
+
+
+def document(pages):
+    return b"\f".join(b"page %d" % page for page in range(1, pages + 1))
+
+
+def get(path):
+    with flask.Flask(__name__).test_request_context(path):
+        response = annotate_http(flask.request)
+        return response.status_code, response.get_data(as_text=True)
+
+
+def stored_json(storage_client, name):
+    return json.loads(storage_client.bucket("out")._blobs[name]._data)
+
+
+def page_names(storage_client, file_name):
+    prefix = f"_vision/pages/{file_name}/"
+    return [
+        name[len(prefix) :]  # noqa: E203
+        for name in storage_client.names("out")
+        if name.startswith(prefix)
+    ]
+
+
+def encoded_image(image_format, frames):
+    images = [Image.new("L", (8, 8), 60 * frame) for frame in range(frames)]
+    output = io.BytesIO()
+    images[0].save(output, image_format, save_all=True, append_images=images[1:])
+    return output.getvalue()
+
+
+def test_only_images_of_several_frames_are_annotated_page_by_page(clients):
+    # Given
+    storage_client, vision_client = clients
+    images = {
+        "scan.tiff": encoded_image("TIFF", 1),
+        "icon.gif": encoded_image("GIF", 1),
+        "animation.gif": encoded_image("GIF", 3),
+    }
+    for name, content in images.items():
+        storage_client.put("in", name, content)
+
+    # When
+    frames = {name: frame_count(content) for name, content in images.items()}
+    for i, name in enumerate(images):
+        annotate_gcs(finalized_event("in", name, event_id=str(i)))
+
+    # Then
+    assert frames == {"scan.tiff": 1, "icon.gif": 1, "animation.gif": 3}
+    assert vision_client.counters["annotate"] == 2
+    assert vision_client.counters["files"] > 0
+    assert "mimeType" not in stored_json(storage_client, "scan.tiff.json")
+    assert "mimeType" not in stored_json(storage_client, "icon.gif.json")
+    assert stored_json(storage_client, "animation.gif.json")["mimeType"] == "image/gif"
+
+
+def test_annotate_gcs_annotates_all_pages_of_file(clients):
+    # Given
+    storage_client, vision_client = clients
+    storage_client.put("in", "doc.pdf", document(23), content_type="application/pdf")
+
+    # When
+    annotate_gcs(finalized_event("in", "doc.pdf"))
+
+    # Then
+    # the first call learns the number of pages, the other 18 pages take 4 calls
+    assert (vision_client.counters["files"], vision_client.counters["images"]) == (
+        5,
+        23,
+    )
+    assert page_names(storage_client, "doc.pdf") == [
+        f"{page:05d}.json" for page in range(1, 24)
+    ]
+    page = stored_json(storage_client, "_vision/pages/doc.pdf/00007.json")
+    assert page["context"]["pageNumber"] == 7
+    summary = stored_json(storage_client, "doc.pdf.json")
+    assert (summary["mimeType"], summary["totalPages"]) == ("application/pdf", 23)
+    labels = {
+        label["description"]: label["pages"] for label in summary["labelAnnotations"]
+    }
+    assert labels["gs://in/doc.pdf"] == list(range(1, 24))
+    assert labels["page 7"] == [7]
+    assert "failedPages" not in summary
+
+
+def test_file_pages_are_listed_and_served(clients):
+    # Given
+    storage_client, _ = clients
+    storage_client.put("in", "doc.pdf", document(7), content_type="application/pdf")
+    storage_client.put("in", "photo.jpg", b"image", content_type="image/jpeg")
+    annotate_gcs(finalized_event("in", "doc.pdf"))
+    annotate_gcs(finalized_event("in", "photo.jpg", event_id="2"))
+
+    # When
+    _, listing = get("/bucket/list?embed=2")
+    page = get("/bucket/annotation/doc.pdf.json?page=6")
+    summary = get("/bucket/annotation/doc.pdf.json")
+
+    # Then
+    listing = json.loads(listing)
+    assert listing["doc.pdf"]["page_annotation"] == (
+        "/bucket/annotation/doc.pdf.json?page="
+    )
+    assert listing["doc.pdf"]["content"]["totalPages"] == 7
+    assert "page_annotation" not in listing["photo.jpg"]
+    assert page[0] == 200
+    assert json.loads(page[1])["context"]["pageNumber"] == 6
+    assert json.loads(summary[1])["totalPages"] == 7
+    assert get("/bucket/annotation/doc.pdf.json?page=8")[0] == 404
+    assert get("/bucket/annotation/doc.pdf.json?page=x")[0] == 400
+
+
+def test_retried_event_annotates_only_missing_pages(clients, monkeypatch):
+    # Given
+    storage_client, vision_client = clients
+    monkeypatch.setenv("FILE_PARALLELISM", "1")
+    storage_client.put("in", "doc.pdf", document(23), content_type="application/pdf")
+    batch_annotate_files = vision_client.batch_annotate_files
+    failures = [exceptions.PermissionDenied("denied")]
+
+    def failing_batch_annotate_files(requests=None, **kwargs):
+        if 12 in requests[0].pages and failures:
+            raise failures.pop()
+        return batch_annotate_files(requests=requests, **kwargs)
+
+    vision_client.batch_annotate_files = failing_batch_annotate_files
+    with pytest.raises(exceptions.PermissionDenied):
+        annotate_gcs(finalized_event("in", "doc.pdf"))
+    written = page_names(storage_client, "doc.pdf")
+
+    # When
+    annotate_gcs(finalized_event("in", "doc.pdf", event_id="2"))
+
+    # Then
+    assert written == [f"{page:05d}.json" for page in range(1, 11)]
+    assert "doc.pdf.json" in storage_client.names("out")
+    # pages 1-10 in 2 calls, then pages 11-23 in 3 calls
+    assert (vision_client.counters["files"], vision_client.counters["images"]) == (
+        5,
+        23,
+    )
+    summary = stored_json(storage_client, "doc.pdf.json")
+    labels = {
+        label["description"]: label["pages"] for label in summary["labelAnnotations"]
+    }
+    assert labels["gs://in/doc.pdf"] == list(range(1, 24))
+
+
+def test_file_errors_and_shorter_versions(clients):
+    # Given
+    storage_client, _ = clients
+    storage_client.put("in", "bad.pdf", b"error", content_type="application/pdf")
+    storage_client.put("in", "doc.tiff", document(12))
+    annotate_gcs(finalized_event("in", "doc.tiff"))
+    storage_client.put("in", "doc.tiff", document(3))
+
+    # When
+    annotate_gcs(finalized_event("in", "bad.pdf", event_id="2"))
+    annotate_gcs(finalized_event("in", "doc.tiff", event_id="3"))
+
+    # Then
+    assert stored_json(storage_client, "bad.pdf.json")["error"]["code"] == 3
+    assert page_names(storage_client, "bad.pdf") == []
+    summary = stored_json(storage_client, "doc.tiff.json")
+    assert (summary["mimeType"], summary["totalPages"]) == ("image/tiff", 3)
+    assert page_names(storage_client, "doc.tiff") == [
+        f"{page:05d}.json" for page in range(1, 4)
+    ]
@@ -0,0 +1,173 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import random
+from unittest.mock import patch
+
+import pytest
+from google.cloud import vision
+from PIL import Image, ImageDraw, ImageFilter
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+from near_duplicates import MultiIndexHash, hamming_distance, perceptual_hash
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import annotate_gcs, get_near_duplicate_index, reset_config
+
+
+def picture(seed, size=(800, 600)):
+    """Returns a smooth picture of blurred ellipses on a gradient."""
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse(
+            [x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 300)],
+            fill=tuple(rng.randrange(256) for _ in range(3)),
+        )
+    return image.filter(ImageFilter.GaussianBlur(20))
+
+
+def encode(image, size=None, quality=90, image_format="JPEG"):
+    if size:
+        image = image.resize(size)
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality)
+    return output.getvalue()
+
+
+def test_perceptual_hash_of_copies():
+    # Given
+    image = picture(1)
+    original = perceptual_hash(encode(image))
+
+    # When
+    copies = [
+        perceptual_hash(encode(image, (400, 300), quality=60)),
+        perceptual_hash(encode(image, (200, 150), quality=30)),
+        perceptual_hash(encode(image, image_format="PNG")),
+    ]
+    other = perceptual_hash(encode(picture(2)))
+
+    # Then
+    assert (original.width, original.height) == (800, 600)
+    assert (copies[0].width, copies[0].height) == (400, 300)
+    assert all(hamming_distance(original.value, c.value) <= 4 for c in copies)
+    assert hamming_distance(original.value, other.value) > 16
+    assert perceptual_hash(b"not an image") is None
+
+
+@pytest.mark.parametrize("radius", [0, 4, 10])
+def test_multi_index_hash_finds_hashes_within_radius(radius):
+    # Given
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    index = MultiIndexHash(radius)
+    for position, value in enumerate(hashes):
+        index.add(value, position)
+    index.add(hashes[7], "copy")
+    query = hashes[7] ^ 0b1011
+
+    # When
+    found = sorted((d, v) for d, v, _ in index.search(query))
+    closest = next(index.search(hashes[7]))
+
+    # Then
+    expected = sorted(
+        (hamming_distance(query, value), value)
+        for value in hashes
+        if hamming_distance(query, value) <= radius
+    )
+    assert found == expected
+    assert closest == (0, hashes[7], {7, "copy"})
+    assert len(index) == 2000
+
+
+@pytest.fixture
+def vision_client(mocker, monkeypatch):
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LANDMARK_DETECTION")
+    monkeypatch.setenv("ANNOTATION_CACHE", "none")
+    monkeypatch.setenv("NEAR_DUPLICATE_DISTANCE", "6")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    annotate_image = vision_client.annotate_image
+
+    def annotate_with_landmark(request, **kwargs):
+        # a landmark at 1/4 of the width and height of the image sent to Vision
+        response = annotate_image(request, **kwargs)
+        with Image.open(io.BytesIO(request.image.content)) as image:
+            x, y = image.width // 4, image.height // 4
+        response.landmark_annotations.append(
+            vision.EntityAnnotation(
+                description="tower", bounding_poly={"vertices": [{"x": x, "y": y}]}
+            )
+        )
+        return response
+
+    vision_client.annotate_image = annotate_with_landmark
+    vision_client.storage_client = storage_client
+    return vision_client
+
+
+def test_annotate_gcs_reuses_annotation_of_resized_copy(vision_client):
+    # Given
+    storage_client = vision_client.storage_client
+    image = picture(1)
+    storage_client.put("in", "a.jpg", encode(image))
+    storage_client.put("in", "small-a.jpg", encode(image, (400, 300), quality=60))
+    storage_client.put("in", "b.jpg", encode(picture(2)))
+
+    # When
+    for event_id, name in enumerate(("a.jpg", "small-a.jpg", "b.jpg")):
+        annotate_gcs(finalized_event("in", name, event_id=str(event_id)))
+
+    # Then
+    assert vision_client.counters["annotate"] == 2
+    small = json.loads(storage_client.bucket("out")._blobs["small-a.jpg.json"]._data)
+    assert small["landmarkAnnotations"][0]["boundingPoly"]["vertices"] == [
+        {"x": 100, "y": 75}
+    ]
+    assert get_near_duplicate_index("out").stats() == {
+        "lookups": 3,
+        "hits": 1,
+        "loads": 1,
+        "entries": 2,
+    }
+
+
+def test_annotate_gcs_ignores_copies_annotated_with_other_features(
+    vision_client, monkeypatch
+):
+    # Given
+    storage_client = vision_client.storage_client
+    image = picture(1)
+    storage_client.put("in", "a.jpg", encode(image))
+    storage_client.put("in", "small-a.jpg", encode(image, (400, 300)))
+    annotate_gcs(finalized_event("in", "a.jpg"))
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    reset_config()
+
+    # When
+    annotate_gcs(finalized_event("in", "small-a.jpg", event_id="2"))
+
+    # Then
+    assert vision_client.counters["annotate"] == 2
+    assert get_near_duplicate_index("out").stats()["entries"] == 1
@@ -0,0 +1,215 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import patch
+
+import flask
+import pytest
+from google.api_core import exceptions
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient
+from ratelimit import AdaptiveRateLimiter, RateLimitTimeout, call_with_retry
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import (
+            annotate_http,
+            annotate_image_uri,
+            batch_annotate_images,
+            get_vision_rate_limiter,
+            vision,
+        )
+
+
+@pytest.fixture
+def vision_client(mocker, monkeypatch, clock):
+    monkeypatch.setenv("ANNOTATION_CACHE", "none")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    storage_client = FakeStorageClient()
+    client = FakeVisionClient(storage_client, clock=clock)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: client)
+    return client
+
+
+def test_rate_limiter_waits_for_tokens(clock):
+    # Given
+    limiter = AdaptiveRateLimiter(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+
+    # When
+    waits = [limiter.acquire() for _ in range(4)]
+
+    # Then
+    assert waits == [0.0, 0.0, 0.5, 0.5]
+    assert clock.now == 1.0
+    assert limiter.stats()["waits"] == 2
+
+
+def test_rate_limiter_adapts_rate(clock):
+    # Given
+    limiter = AdaptiveRateLimiter(
+        rate=8, max_rate=10, min_rate=1, increase=1, clock=clock, sleep=clock.sleep
+    )
+
+    # When
+    rates = []
+    for event in ["success", "success", "success", "throttled", "throttled"] + [
+        "throttled"
+    ] * 3:
+        getattr(limiter, event)()
+        rates.append(limiter.rate)
+
+    # Then
+    assert rates == [9, 10, 10, 5, 2.5, 1.25, 1, 1]
+    assert limiter.stats()["throttled"] == 5
+
+
+def test_rate_limiter_wait_ends_despite_rounding(clock):
+    # Given
+    clock.now = 2.26
+    limiter = AdaptiveRateLimiter(rate=3, burst=1, clock=clock, sleep=clock.sleep)
+
+    # When
+    for _ in range(100):
+        limiter.acquire()
+
+    # Then
+    assert len(clock.slept) < 200
+    assert clock.now == pytest.approx(2.26 + 99 / 3, abs=0.1)
+
+
+def test_rate_limiter_starts_unlimited(clock):
+    # Given
+    limiter = AdaptiveRateLimiter(clock=clock, sleep=clock.sleep)
+
+    # When
+    waits = [limiter.acquire(4) for _ in range(100)]
+    clock.now += 2
+    limiter.acquire(40)
+    limiter.throttled()
+
+    # Then
+    assert waits == [0.0] * 100
+    assert clock.slept == []
+    assert limiter.rate == pytest.approx(400 / 2 * 0.5)
+
+
+def test_rate_limiter_fails_after_deadline(clock):
+    # Given
+    limiter = AdaptiveRateLimiter(rate=1, burst=1, clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+
+    # When / Then
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(deadline=0.5)
+    assert clock.now == 0.0
+
+
+def test_call_retried_after_throttling(clock):
+    # Given
+    limiter = AdaptiveRateLimiter(rate=10, clock=clock, sleep=clock.sleep)
+    errors = [
+        exceptions.ResourceExhausted("quota"),
+        exceptions.ResourceExhausted("quota"),
+    ]
+    timeouts = []
+
+    def call(timeout):
+        timeouts.append(timeout)
+        if errors:
+            raise errors.pop()
+        return "result"
+
+    # When
+    result = call_with_retry(
+        call,
+        limiter,
+        retryable=(exceptions.TooManyRequests,),
+        throttling=(exceptions.TooManyRequests,),
+        deadline=60,
+        timeout=30,
+    )
+
+    # Then
+    assert result == "result"
+    stats = limiter.stats()
+    assert stats["throttled"] == 2
+    assert stats["retries"] == 2
+    assert stats["rate"] == 10 * 0.5 * 0.5 + 0.5
+    assert all(timeout <= 30 for timeout in timeouts)
+    assert timeouts[-1] == min(30, 60 - clock.now)
+
+
+def test_call_not_retried_on_permanent_error(clock):
+    # Given
+    limiter = AdaptiveRateLimiter(clock=clock, sleep=clock.sleep)
+    calls = []
+
+    def call(timeout):
+        calls.append(timeout)
+        raise exceptions.InvalidArgument("bad request")
+
+    # When / Then
+    with pytest.raises(exceptions.InvalidArgument):
+        call_with_retry(
+            call,
+            limiter,
+            retryable=(exceptions.TooManyRequests,),
+            throttling=(exceptions.TooManyRequests,),
+            deadline=60,
+            timeout=30,
+        )
+    assert len(calls) == 1
+
+
+def test_vision_quota_burst_succeeds_with_retries(vision_client, clock):
+    # Given
+    vision_client.quota = 4
+    requests = [
+        vision.AnnotateImageRequest(
+            image=vision.Image(
+                source=vision.ImageSource(image_uri=f"gs://in/image{i}.jpg")
+            )
+        )
+        for i in range(4)
+    ]
+    images = [f"gs://in/single{i}.jpg" for i in range(8)]
+
+    # When
+    batch = batch_annotate_images(requests)
+    single = [annotate_image_uri(uri, []) for uri in images]
+
+    # Then
+    assert len(batch) == 4
+    assert all(single)
+    assert vision_client.counters["throttled"] > 0
+    stats = get_vision_rate_limiter().stats()
+    assert stats["throttled"] == vision_client.counters["throttled"]
+    assert stats["throttled_seconds"] > 0
+
+
+def test_annotate_returns_429_when_quota_exhausted(vision_client, monkeypatch):
+    # Given
+    monkeypatch.setenv("VISION_MAX_RETRIES", "1")
+    vision_client.quota = 0
+
+    # When
+    with flask.Flask(__name__).test_request_context(
+        "/annotate", query_string={"image_uri": "gs://in/a.jpg"}
+    ):
+        response = annotate_http(flask.request)
+
+    # Then
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
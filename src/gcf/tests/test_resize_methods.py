@@ -0,0 +1,203 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+from unittest.mock import patch
+
+import flask
+import pytest
+from google.cloud import vision
+from PIL import Image
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+from image_resize import downscale, rescale_annotation
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        import main
+        from main import annotate_gcs, annotate_http, get_config
+
+
+def encoded_image(width, height, image_format="JPEG", **save_args):
+    output = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(
+        output, format=image_format, **save_args
+    )
+    return output.getvalue()
+
+
+def test_downscale_keeps_aspect_ratio_and_drops_exif():
+    # Given
+    exif = Image.Exif()
+    exif[0x010F] = "Camera maker"
+    image_bin = encoded_image(800, 600, exif=exif.tobytes())
+
+    # When
+    image_out, scale_x, scale_y = downscale(image_bin, 200)
+
+    # Then
+    with Image.open(io.BytesIO(image_out)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (200, 150)
+        assert not image.getexif()
+    assert (scale_x, scale_y) == (4.0, 4.0)
+    assert len(image_out) < len(image_bin)
+
+
+@pytest.mark.parametrize(
+    "image_bin", [encoded_image(100, 80, "PNG"), b"not an image", b""]
+)
+def test_downscale_skips_small_and_invalid_images(image_bin):
+    # Then
+    assert downscale(image_bin, 100) is None
+
+
+def test_rescale_annotation():
+    # Given
+    annotation = {
+        "faceAnnotations": [
+            {
+                "boundingPoly": {"vertices": [{"x": 10}, {"x": 20, "y": 5}]},
+                "landmarks": [{"position": {"x": 1.5, "y": 2.0, "z": 3.0}}],
+            }
+        ],
+        "localizedObjectAnnotations": [
+            {"boundingPoly": {"normalizedVertices": [{"x": 0.5, "y": 0.5}]}}
+        ],
+        "fullTextAnnotation": {
+            "pages": [
+                {
+                    "width": 100,
+                    "height": 50,
+                    "blocks": [{"boundingBox": {"vertices": [{"x": 3, "y": 4}]}}],
+                }
+            ]
+        },
+    }
+
+    # When
+    rescale_annotation(annotation, 2.0, 3.0)
+
+    # Then
+    face = annotation["faceAnnotations"][0]
+    assert face["boundingPoly"]["vertices"] == [{"x": 20, "y": 0}, {"x": 40, "y": 15}]
+    assert face["landmarks"][0]["position"] == {"x": 3.0, "y": 6.0, "z": 3.0}
+    assert annotation["localizedObjectAnnotations"][0]["boundingPoly"] == {
+        "normalizedVertices": [{"x": 0.5, "y": 0.5}]
+    }
+    page = annotation["fullTextAnnotation"]["pages"][0]
+    assert (page["width"], page["height"]) == (200, 150)
+    assert page["blocks"][0]["boundingBox"]["vertices"] == [{"x": 6, "y": 12}]
+
+
+@pytest.mark.parametrize(
+    "spec, features, max_dimension",
+    [
+        ("", "LABEL_DETECTION", None),
+        ("640", "LABEL_DETECTION,FACE_DETECTION", 640),
+        ("LABEL_DETECTION=640", "LABEL_DETECTION,TEXT_DETECTION", None),
+        ("640,TEXT_DETECTION=2048", "LABEL_DETECTION,TEXT_DETECTION", 2048),
+        ("640,TEXT_DETECTION=2048", "LABEL_DETECTION", 640),
+        ("LABEL_DETECTION=zero", "LABEL_DETECTION", None),
+        ("LABELS=640", "LABEL_DETECTION", None),
+    ],
+)
+def test_max_dimension_per_features(monkeypatch, spec, features, max_dimension):
+    # Given
+    monkeypatch.setenv("IMAGE_MAX_DIMENSION", spec)
+    features_list = main.build_features_list(features)
+
+    # Then
+    assert get_config().max_dimension(features_list) == max_dimension
+
+
+def whole_image_crop_hint(request, **kwargs):
+    """Vision response with a crop hint covering the whole image it received."""
+    response = vision.AnnotateImageResponse()
+    if not request.image.content:
+        return response
+    with Image.open(io.BytesIO(request.image.content)) as image:
+        width, height = image.size
+    response.crop_hints_annotation.crop_hints.append(
+        vision.CropHint(
+            bounding_poly=vision.BoundingPoly(
+                vertices=[vision.Vertex(x=0, y=0), vision.Vertex(x=width, y=height)]
+            )
+        )
+    )
+    return response
+
+
+@pytest.fixture
+def vision_client(mocker):
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    mocker.patch.object(
+        vision_client, "annotate_image", side_effect=whole_image_crop_hint
+    )
+    return vision_client
+
+
+def crop_hint_vertices(annotation: dict) -> list:
+    return annotation["cropHintsAnnotation"]["cropHints"][0]["boundingPoly"]["vertices"]
+
+
+def test_annotate_downscales_uploaded_image(vision_client, monkeypatch):
+    # Given
+    monkeypatch.setenv("IMAGE_MAX_DIMENSION", "CROP_HINTS=100")
+    image_bin = encoded_image(1000, 500)
+
+    # When
+    with flask.Flask(__name__).test_request_context(
+        "/annotate?features=CROP_HINTS",
+        method="POST",
+        data=image_bin,
+        headers={"Content-Type": "image/jpeg"},
+    ):
+        response = annotate_http(flask.request)
+
+    # Then
+    assert response.status_code == 200
+    sent = vision_client.annotate_image.call_args.args[0].image.content
+    with Image.open(io.BytesIO(sent)) as image:
+        assert image.size == (100, 50)
+    assert crop_hint_vertices(json.loads(response.get_data())) == [
+        {"x": 0, "y": 0},
+        {"x": 1000, "y": 500},
+    ]
+
+
+def test_annotate_gcs_downscales_large_images(vision_client, monkeypatch):
+    # Given
+    monkeypatch.setenv("IMAGE_MAX_DIMENSION", "100")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "CROP_HINTS")
+    monkeypatch.setattr(main, "DOWNSCALE_MIN_SIZE", 100_000)
+    storage_client = vision_client.storage_client
+    storage_client.put("in", "large.png", encoded_image(400, 400, "PNG"))
+    storage_client.put("in", "small.png", encoded_image(20, 20, "PNG"))
+
+    # When
+    annotate_gcs(finalized_event("in", "large.png"))
+    annotate_gcs(finalized_event("in", "small.png", event_id="2"))
+
+    # Then
+    large = json.loads(storage_client.bucket("out")._blobs["large.png.json"]._data)
+    assert crop_hint_vertices(large) == [{"x": 0, "y": 0}, {"x": 400, "y": 400}]
+    sent = [call.args[0].image for call in vision_client.annotate_image.call_args_list]
+    assert len(sent[0].content) < 400 * 400
+    assert sent[1].source.image_uri == "gs://in/small.png"
@@ -0,0 +1,188 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from unittest.mock import patch
+
+import flask
+import pytest
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+from search_index import SearchIndex, annotation_terms, query_terms
+from sharded_store import ShardedJsonStore
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import (
+            annotate_backfill,
+            annotate_gcs,
+            annotate_http,
+            get_search_index,
+            rebuild_search_index,
+        )
+
+
+ANNOTATION = {
+    "labelAnnotations": [
+        {"description": "Dog", "score": 0.97},
+        {"description": "Golden retriever", "score": 0.61},
+    ],
+    "localizedObjectAnnotations": [{"name": "Dog", "score": 0.88}],
+    "textAnnotations": [{"description": "BEWARE OF\nTHE DOG"}, {"description": "x"}],
+}
+
+
+def test_annotation_terms():
+    # When
+    terms = annotation_terms(ANNOTATION)
+
+    # Then
+    assert terms == {
+        "label:dog": 9,
+        "label:golden": 6,
+        "label:retriever": 6,
+        "object:dog": 8,
+        "text:beware": 10,
+        "text:of": 10,
+        "text:the": 10,
+        "text:dog": 10,
+    }
+    assert len(annotation_terms(ANNOTATION, max_text_terms=1)) == 5
+
+
+def test_query_terms():
+    # When
+    alternatives = query_terms("label:Dog menu")
+
+    # Then
+    assert alternatives[0] == ["label:dog"]
+    assert "text:menu" in alternatives[1] and "logo:menu" in alternatives[1]
+
+
+def test_search_index_update_replaces_terms_of_image():
+    # Given
+    storage_client = FakeStorageClient()
+    index = SearchIndex(
+        ShardedJsonStore(lambda: storage_client.bucket("out"), "terms/", 4),
+        ShardedJsonStore(lambda: storage_client.bucket("out"), "docs/", 4),
+    )
+    index.rebuild([("a.jpg", {"label:dog": 9}), ("b.jpg", {"label:dog": 5})], {})
+
+    # When
+    index.update("a.jpg", {"label:cat": 7})
+    index.update("c.jpg", {"label:dog": 3})
+
+    # Then
+    assert index.search("dog") == ([("b.jpg", 0.5), ("c.jpg", 0.3)], 2)
+    assert index.search("cat") == ([("a.jpg", 0.7)], 1)
+    assert index.documents.get("a.jpg") == ["label:cat"]
+
+
+@pytest.fixture
+def buckets(mocker, monkeypatch):
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    monkeypatch.setenv("SEARCH_INDEX_SHARDS", "8")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    return storage_client
+
+
+def annotate(storage_client, name, annotation):
+    storage_client.put("out", name + ".json", json.dumps(annotation))
+
+
+def search(query):
+    with flask.Flask(__name__).test_request_context(
+        "/bucket/search", query_string=query
+    ):
+        response = annotate_http(flask.request)
+        if response.status_code != 200:
+            return response, None
+        return response, json.loads(response.get_data())
+
+
+def test_search_ranks_and_pages_results(buckets):
+    # Given
+    annotate(buckets, "a.jpg", ANNOTATION)
+    annotate(
+        buckets, "b.jpg", {"labelAnnotations": [{"description": "dog", "score": 0.5}]}
+    )
+    annotate(
+        buckets, "c.jpg", {"labelAnnotations": [{"description": "cat", "score": 0.9}]}
+    )
+    annotate(buckets, "broken.jpg", {"error": {"code": 3}})
+    rebuild_search_index("out")
+
+    # When
+    first, first_page = search({"q": "dog", "limit": "1"})
+    second, second_page = search({"q": "dog", "limit": "1", "cursor": "1"})
+    both, both_words = search({"q": "label:dog text:beware"})
+    confident, confident_results = search({"q": "dog", "min_score": "0.6"})
+    missing, missing_results = search({"q": "horse"})
+
+    # Then
+    assert first.status_code == 200
+    assert first_page["total"] == 2
+    assert first_page["results"] == [
+        {"image": "a.jpg", "annotation": "a.jpg.json", "score": 1.0}
+    ]
+    assert first.headers["X-Next-Cursor"] == "1"
+    assert [r["image"] for r in second_page["results"]] == ["b.jpg"]
+    assert "X-Next-Cursor" not in second.headers
+    assert [(r["image"], r["score"]) for r in both_words["results"]] == [("a.jpg", 1.9)]
+    assert [r["image"] for r in confident_results["results"]] == ["a.jpg"]
+    assert missing_results == {"total": 0, "results": []}
+
+
+def test_search_before_index_is_built(buckets):
+    # When
+    response, _ = search({"q": "dog"})
+    no_query, _ = search({"q": " "})
+
+    # Then
+    assert response.status_code == 404
+    assert no_query.status_code == 400
+
+
+def test_annotate_gcs_updates_built_index(buckets):
+    # Given
+    buckets.put("in", "dog.jpg", b"dog")
+    annotate_gcs(finalized_event("in", "dog.jpg"))
+    index = get_search_index("out")
+    built_before = index.ready()
+
+    # When
+    with flask.Flask(__name__).test_request_context(
+        "/annotate_backfill", query_string={"search_index": "true"}
+    ):
+        summary = json.loads(annotate_backfill(flask.request).get_data())
+    buckets.put("in", "dogs/puppy.jpg", b"puppy")
+    annotate_gcs(finalized_event("in", "dogs/puppy.jpg", event_id="2"))
+    index.postings.clear_cache()
+
+    # Then
+    assert not built_before
+    assert summary == {"indexed": 1, "failed": 0}
+    assert [name for name, _ in index.search("dogs")[0]] == ["dogs/puppy.jpg"]
+    assert [name for name, _ in index.search("label:dog")[0]] == ["dog.jpg"]
+    assert index.search("jpg")[1] == 2
+    assert index.documents.get("dog.jpg") == sorted(
+        annotation_terms(
+            {"labelAnnotations": [{"description": "gs://in/dog.jpg", "score": 0.9}]}
+        )
+    )
@@ -0,0 +1,209 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import flask
+import pytest
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+from single_flight import SingleFlight, SingleFlightTimeout
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import annotate_gcs, annotate_http, get_single_flight
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.001)
+
+
+def test_single_flight_shares_result_and_error():
+    # Given
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    # When
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = [
+            executor.submit(flight.do, "a", lambda: compute(1)) for _ in range(4)
+        ]
+        errors = [
+            executor.submit(flight.do, "b", lambda: compute(ValueError("failed")))
+            for _ in range(4)
+        ]
+        wait_until(lambda: flight.stats()["coalesced"] == 6)
+        release.set()
+
+    # Then
+    assert sorted(future.result() for future in results) == [
+        (1, False),
+        (1, False),
+        (1, False),
+        (1, True),
+    ]
+    assert all(isinstance(future.exception(), ValueError) for future in errors)
+    assert len(calls) == 2
+    assert flight.stats() == {
+        "calls": 2,
+        "coalesced": 6,
+        "errors": 1,
+        "timeouts": 0,
+        "in_flight": 0,
+    }
+    # finished calls aren't remembered
+    assert flight.do("a", lambda: 2) == (2, True)
+
+
+def test_single_flight_waiter_times_out():
+    # Given
+    flight = SingleFlight()
+    release = threading.Event()
+    started = threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return 1
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        leader = executor.submit(flight.do, "a", compute)
+        started.wait(5)
+
+        # When
+        with pytest.raises(SingleFlightTimeout):
+            flight.do("a", compute, timeout=0.01)
+        release.set()
+
+    # Then
+    assert leader.result() == (1, True)
+    assert flight.stats()["timeouts"] == 1
+
+
+@pytest.fixture
+def clients(mocker, monkeypatch):
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    monkeypatch.setenv("ANNOTATION_CACHE", "none")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    # Vision calls wait until the test releases them, so that requests overlap
+    release = threading.Event()
+    annotate_image = vision_client.annotate_image
+
+    def blocked_annotate_image(*args, **kwargs):
+        release.wait(5)
+        return annotate_image(*args, **kwargs)
+
+    vision_client.annotate_image = blocked_annotate_image
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    return storage_client, vision_client, release
+
+
+def call(path, method="GET", **kwargs):
+    with flask.Flask(__name__).test_request_context(path, method=method, **kwargs):
+        response = annotate_http(flask.request)
+        return (
+            response.status_code,
+            response.headers.get("X-Annotation-Cache"),
+            response.get_data(as_text=True),
+        )
+
+
+def test_concurrent_identical_requests_share_vision_call(clients):
+    # Given
+    storage_client, vision_client, release = clients
+
+    def annotate_uri(features):
+        return call(
+            "/annotate",
+            query_string={"image_uri": "gs://in/a.jpg", "features": features},
+        )
+
+    def upload(_):
+        return call("/annotate", "POST", data=b"image", content_type="image/png")
+
+    # When
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        # the same features in a different order share the call
+        uris = [
+            executor.submit(annotate_uri, "LABEL_DETECTION,LOGO_DETECTION"),
+            executor.submit(annotate_uri, "LOGO_DETECTION,LABEL_DETECTION"),
+        ] + [executor.submit(annotate_uri, "LABEL_DETECTION") for _ in range(6)]
+        uploads = [executor.submit(upload, i) for i in range(6)]
+        wait_until(lambda: get_single_flight().stats()["coalesced"] == 11)
+        release.set()
+
+    # Then
+    responses = [future.result() for future in uris + uploads]
+    assert [status for status, _, _ in responses] == [200] * 14
+    caches = [cache for _, cache, _ in responses]
+    assert (caches.count("miss"), caches.count("coalesced")) == (3, 11)
+    assert "gs://in/a.jpg" in responses[0][2]
+    assert "uploaded image" in responses[-1][2]
+    assert vision_client.counters["annotate"] == 3
+    assert get_single_flight().stats() == {
+        "calls": 3,
+        "coalesced": 11,
+        "errors": 0,
+        "timeouts": 0,
+        "in_flight": 0,
+    }
+
+
+def test_concurrent_events_of_one_object_share_vision_call(clients):
+    # Given
+    storage_client, vision_client, release = clients
+    blob = storage_client.put("in", "a.jpg", b"image")
+    storage_client.put("in", "copy.jpg", b"image")
+
+    def event(i):
+        name = "copy.jpg" if i == 0 else "a.jpg"
+        annotate_gcs(
+            finalized_event("in", name, event_id=str(i), generation=blob.generation)
+        )
+
+    # When
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(event, i) for i in range(4)]
+        wait_until(lambda: get_single_flight().stats()["coalesced"] == 3)
+        release.set()
+    for future in futures:
+        future.result()
+
+    # Then
+    assert vision_client.counters["annotate"] == 1
+    assert storage_client.names("out") == ["a.jpg.json", "copy.jpg.json"]
+    annotation = json.loads(storage_client.bucket("out")._blobs["a.jpg.json"]._data)
+    assert annotation["labelAnnotations"][0]["description"] in (
+        "gs://in/a.jpg",
+        "gs://in/copy.jpg",
+    )
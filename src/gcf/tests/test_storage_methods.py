@@ -12,11 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import json
 from unittest.mock import patch
 
+from benchmarks.fakes import FakeStorageClient
+from sharded_store import ShardedJsonStore
+
 with patch("google.cloud.logging.Client"):
     with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
-        from main import image_filename_for_json, json_filename_for_image
+        from main import (
+            OutputOptions,
+            image_filename_for_json,
+            json_filename_for_image,
+            read_json_str,
+            write_annotation,
+        )
 
 
 def test_json_filename_for_image():
@@ -39,3 +50,108 @@ def test_image_filename_for_json():
 
     # Then
     assert result == "annotation"
+
+
+def test_sharded_store_put_and_get():
+    # Given
+    storage_client = FakeStorageClient()
+    store = ShardedJsonStore(lambda: storage_client.bucket("b"), "idx/", num_shards=4)
+
+    # When
+    changed = [store.put("a", 1), store.put("a", 1), store.put("b", 2)]
+    other_instance = ShardedJsonStore(
+        lambda: storage_client.bucket("b"), "idx/", num_shards=4
+    )
+
+    # Then
+    assert changed == [True, False, True]
+    assert other_instance.get("a") == 1
+    assert other_instance.contains("b")
+    assert not other_instance.contains("c")
+    assert not other_instance.ready()
+
+
+def test_sharded_store_retries_conflicting_update():
+    # Given
+    storage_client = FakeStorageClient()
+    store = ShardedJsonStore(lambda: storage_client.bucket("b"), "idx/", num_shards=1)
+    other_writer = ShardedJsonStore(
+        lambda: storage_client.bucket("b"), "idx/", num_shards=1
+    )
+    attempts = []
+
+    def mutate(content):
+        attempts.append(dict(content))
+        if len(attempts) == 1:
+            # another instance writes the shard in the meantime
+            other_writer.put("other", 1)
+        content["mine"] = 2
+        return True
+
+    # When
+    store.update(0, mutate)
+
+    # Then
+    assert attempts == [{}, {"other": 1}]
+    assert store.read(0, fresh=True) == {"other": 1, "mine": 2}
+
+
+ANNOTATION = json.dumps(
+    {
+        "labelAnnotations": [{"mid": "/m/1", "description": "Cat", "score": 0.9}],
+        "fullTextAnnotation": {
+            "text": "Hi",
+            "pages": [{"width": 10, "blocks": [{"boundingBox": {}, "confidence": 1}]}],
+        },
+    },
+    indent=2,
+)
+
+
+def test_write_annotation_projects_and_compresses(mocker):
+    # Given
+    storage_client = FakeStorageClient()
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    options = OutputOptions(
+        exclude=(("fullTextAnnotation", "pages", "blocks", "boundingBox"),),
+        compact=True,
+        gzip=True,
+        ndjson=True,
+    )
+
+    # When
+    write_annotation("out", "a.jpg", ANNOTATION, options)
+
+    # Then
+    blob = storage_client.bucket("out").get_blob("a.jpg.json")
+    stored = blob.download_as_bytes(raw_download=True)
+    assert blob.content_encoding == "gzip"
+    assert gzip.decompress(stored) == (
+        b'{"labelAnnotations":[{"mid":"/m/1","description":"Cat","score":0.9}],'
+        b'"fullTextAnnotation":{"text":"Hi","pages":[{"width":10,"blocks":'
+        b'[{"confidence":1}]}]}}'
+    )
+    assert read_json_str("out", "a.jpg.json")["labelAnnotations"][0]["mid"] == "/m/1"
+    sidecar = storage_client.bucket("out").get_blob("_vision/ndjson/a.jpg.ndjson")
+    assert json.loads(sidecar.download_as_bytes()) == {
+        "image": "a.jpg",
+        "type": "label",
+        "description": "Cat",
+        "mid": "/m/1",
+        "score": 0.9,
+    }
+
+
+def test_read_json_str_reads_plain_and_gzip_objects(mocker):
+    # Given
+    storage_client = FakeStorageClient()
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    storage_client.put("out", "plain.json", ANNOTATION)
+    storage_client.put("out", "gzip.json", gzip.compress(ANNOTATION.encode()))
+
+    # When
+    plain = read_json_str("out", "plain.json")
+    compressed = read_json_str("out", "gzip.json")
+
+    # Then
+    assert plain == compressed == json.loads(ANNOTATION)
@@ -0,0 +1,199 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Dict, List
+from unittest.mock import patch
+
+import flask
+import pytest
+
+import telemetry
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
+with patch("google.cloud.logging.Client"):
+    with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        from main import annotate_gcs, annotate_http
+
+
+@pytest.fixture
+def storage_client(mocker, monkeypatch):
+    monkeypatch.setenv("TELEMETRY_EXPORTER", "memory")
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    client = FakeStorageClient()
+    mocker.patch("google.cloud.storage.Client", lambda: client)
+    return client
+
+
+@pytest.fixture
+def vision_client(mocker, storage_client):
+    client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: client)
+    return client
+
+
+def get(path, headers=None):
+    with flask.Flask(__name__).test_request_context(path, headers=headers):
+        response = annotate_http(flask.request)
+        return response, response.get_data()
+
+
+def spans_by_name() -> Dict[str, list]:
+    spans: Dict[str, list] = {}
+    for span in telemetry.finished_spans():
+        spans.setdefault(span.name, []).append(span)
+    return spans
+
+
+def stage_samples(metric_name: str = telemetry.STAGE_DURATION_METRIC) -> List[dict]:
+    """Returns attributes and counts of the histogram data points."""
+    samples = []
+    for resource_metrics in telemetry.metrics_data().resource_metrics:
+        for scope_metrics in resource_metrics.scope_metrics:
+            for metric in scope_metrics.metrics:
+                if metric.name == metric_name:
+                    samples.extend(
+                        dict(point.attributes, count=point.count)
+                        for point in metric.data.data_points
+                    )
+    return samples
+
+
+def test_annotate_gcs_records_stages(storage_client, vision_client):
+    # Given
+    blob = storage_client.put("in", "a.jpg", b"image")
+    event = finalized_event(
+        "in", "a.jpg", generation=str(blob.generation), size="5", md5Hash=blob.md5_hash
+    )
+
+    # When
+    annotate_gcs(event)
+    annotate_gcs(finalized_event("in", "b.jpg", event_id="2", size="5"))
+
+    # Then
+    spans = spans_by_name()
+    invocation = spans["annotate_gcs"][0]
+    assert invocation.attributes["event.id"] == "1"
+    assert invocation.attributes["cache.hit"] is False
+    assert invocation.attributes["feature.count"] == 1
+    assert spans["annotate_image"][0].parent.span_id == invocation.context.span_id
+    assert spans["write_annotation"][0].attributes["object.size"] > 0
+    assert spans["lookup_cached_annotation"][0].attributes["cache.hit"] is False
+    samples = stage_samples()
+    assert {"stage": "annotate_image", "feature.count": 1, "count": 2} in samples
+    assert {
+        "stage": "annotate_gcs",
+        "cache.hit": False,
+        "feature.count": 1,
+        "count": 2,
+    } in (samples)
+
+
+def test_annotate_http_joins_caller_trace(vision_client):
+    # Given
+    trace_id = "0af7651916cd43dd8448eb211c80319c"
+    headers = {"traceparent": f"00-{trace_id}-b7ad6b7169203331-01"}
+
+    # When
+    response, _ = get("/annotate?image_uri=gs://in/a.jpg", headers=headers)
+
+    # Then
+    spans = spans_by_name()
+    request_span = spans["annotate_http"][0]
+    assert response.status_code == 200
+    assert format(request_span.context.trace_id, "032x") == trace_id
+    assert request_span.attributes["http.status.code"] == 200
+    assert request_span.attributes["http.route"] == "/annotate"
+    assert spans["annotate_image"][0].context.trace_id == request_span.context.trace_id
+
+
+def test_bucket_list_records_listing_and_reads(storage_client):
+    # Given
+    names = [f"{i}.jpg" for i in range(3)]
+    storage_client.put_many("in", names, b"image")
+    storage_client.put_many("out", [name + ".json" for name in names], b'{"a": 1}')
+
+    # When
+    response, body = get("/bucket/list?embed=3")
+
+    # Then
+    spans = spans_by_name()
+    request_span = spans["annotate_http"][0]
+    listing = [s for s in spans["list_bucket"] if s.attributes["item.count"] == 3]
+    assert json.loads(body)["0.jpg"]["content"] == {"a": 1}
+    assert listing
+    assert len(spans["read_json_str"]) == 3
+    # reads run on the I/O pool and are still children of the request span
+    assert all(
+        span.parent.span_id == request_span.context.span_id
+        for span in spans["read_json_str"]
+    )
+    assert any(s["stage"] == "list_bucket" for s in stage_samples())
+
+
+def test_failed_stage_is_recorded(monkeypatch):
+    # Given
+    monkeypatch.setenv("TELEMETRY_EXPORTER", "memory")
+
+    # When
+    with pytest.raises(ValueError):
+        with telemetry.stage("failing", feature_count=2):
+            raise ValueError("bad")
+
+    # Then
+    span = spans_by_name()["failing"][0]
+    assert not span.status.is_ok
+    assert span.attributes["error.type"] == "ValueError"
+    assert {"stage": "failing", "feature.count": 2, "error.type": "ValueError"} in [
+        {k: v for k, v in s.items() if k != "count"} for s in stage_samples()
+    ]
+
+
+@pytest.mark.parametrize(
+    "env, exporter",
+    [
+        ({}, "none"),
+        ({"K_SERVICE": "annotate-http"}, "gcp"),
+        ({"TELEMETRY_EXPORTER": "console"}, "console"),
+        ({"TELEMETRY_EXPORTER": "Memory"}, "memory"),
+        ({"TELEMETRY_EXPORTER": "zipkin"}, "none"),
+    ],
+)
+def test_telemetry_exporter_selection(monkeypatch, env, exporter):
+    # Given
+    monkeypatch.delenv("TELEMETRY_EXPORTER", raising=False)
+    monkeypatch.delenv("K_SERVICE", raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+    # When / Then
+    assert telemetry.telemetry_exporter() == exporter
+
+
+def test_disabled_telemetry_records_nothing(monkeypatch):
+    # Given
+    monkeypatch.setenv("TELEMETRY_EXPORTER", "none")
+
+    # When
+    with telemetry.stage("annotate_image", feature_count=1) as current:
+        current.set(cache_hit=True)
+    listed = list(telemetry.TimedIterable("list_bucket", [1, 2]))
+
+    # Then
+    assert current is telemetry.NULL_STAGE
+    assert listed == [1, 2]
+    assert telemetry.get_telemetry() is None
+    assert telemetry.finished_spans() == []
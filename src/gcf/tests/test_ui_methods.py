@@ -12,12 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import json
+import time
 from unittest.mock import patch
+
+import flask
+import pytest
 from google.cloud import storage
+from PIL import Image
+
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+from sharded_store import ShardedJsonStore
 
 with patch("google.cloud.logging.Client"):
     with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
-        from main import list_bucket
+        from main import (
+            annotate_backfill,
+            annotate_gcs,
+            annotate_http,
+            get_manifest,
+            list_bucket,
+            rebuild_manifest,
+            write_annotation,
+        )
 
 
 def test_list_bucket(mocker):
@@ -36,3 +54,350 @@ def test_list_bucket(mocker):
     client_mock.list_blobs.side_effect = Exception("An error occurred")
     result = list_bucket(bucket_name)
     assert result is None
+
+
+@pytest.fixture
+def images(mocker, monkeypatch):
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    storage_client = FakeStorageClient()
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    storage_client.put("in", "image.png", bytes(range(100)), content_type="image/png")
+    return storage_client
+
+
+def get(path, headers=None):
+    with flask.Flask(__name__).test_request_context(path, headers=headers):
+        response = annotate_http(flask.request)
+        return response, b"".join(response.response)
+
+
+def test_get_image_streams_content(images):
+    # When
+    response, body = get("/bucket/imagedata/image.png")
+
+    # Then
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.get_etag()[0] == str(
+        images.bucket("in")._blobs["image.png"].generation
+    )
+    assert response.last_modified is not None
+    assert body == bytes(range(100))
+
+
+def test_get_image_range(images):
+    # When
+    response, body = get("/bucket/imagedata/image.png", {"Range": "bytes=10-19"})
+    out_of_range, _ = get("/bucket/imagedata/image.png", {"Range": "bytes=200-"})
+
+    # Then
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-19/100"
+    assert body == bytes(range(10, 20))
+    assert out_of_range.status_code == 416
+
+
+def test_get_image_not_modified(images):
+    # Given
+    etag = get("/bucket/imagedata/image.png")[0].headers["ETag"]
+
+    # When
+    response, body = get("/bucket/imagedata/image.png", {"If-None-Match": etag})
+    images.put("in", "image.png", b"new content", content_type="image/png")
+    modified, modified_body = get(
+        "/bucket/imagedata/image.png", {"If-None-Match": etag}
+    )
+
+    # Then
+    assert response.status_code == 304
+    assert body == b""
+    assert modified.status_code == 200
+    assert modified_body == b"new content"
+
+
+def jpeg(width, height):
+    output = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(output, "JPEG")
+    return output.getvalue()
+
+
+def test_get_thumbnail_is_made_once(images):
+    # Given
+    images.put("in", "dir/photo.jpg", jpeg(400, 300), content_type="image/jpeg")
+    generation = images.bucket("in")._blobs["dir/photo.jpg"].generation
+
+    # When
+    response, body = get("/bucket/imagedata/dir/photo.jpg?size=128")
+    uploads = images.counters["uploads"]
+    cached, cached_body = get(
+        f"/bucket/imagedata/dir/photo.jpg?size=128&generation={generation}"
+    )
+    not_modified, _ = get(
+        "/bucket/imagedata/dir/photo.jpg?size=128",
+        {"If-None-Match": response.headers["ETag"]},
+    )
+
+    # Then
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    assert response.cache_control.no_cache
+    with Image.open(io.BytesIO(body)) as thumbnail:
+        assert thumbnail.size == (128, 96)
+    assert "_vision/thumbnails/128/dir/photo.jpg" in images.names("out")
+    assert cached_body == body
+    assert images.counters["uploads"] == uploads
+    assert cached.cache_control.immutable
+    assert cached.cache_control.max_age == 365 * 24 * 3600
+    assert not_modified.status_code == 304
+
+
+def test_get_thumbnail_of_changed_image(images):
+    # Given
+    images.put("in", "photo.jpg", jpeg(400, 300), content_type="image/jpeg")
+    get("/bucket/imagedata/photo.jpg?size=128")
+
+    # When
+    images.put("in", "photo.jpg", jpeg(300, 400), content_type="image/jpeg")
+    response, body = get("/bucket/imagedata/photo.jpg?size=128")
+
+    # Then
+    with Image.open(io.BytesIO(body)) as thumbnail:
+        assert thumbnail.size == (96, 128)
+
+
+def test_get_thumbnail_of_small_or_invalid_image(images):
+    # When
+    small, small_body = get("/bucket/imagedata/image.png?size=128")
+    invalid_size, _ = get("/bucket/imagedata/image.png?size=100")
+
+    # Then
+    assert small.status_code == 200
+    assert small_body == bytes(range(100))
+    assert invalid_size.status_code == 400
+
+
+def test_get_image_not_found(images):
+    # When
+    response, _ = get("/bucket/imagedata/missing.png")
+
+    # Then
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def listing(images):
+    for name in ("a.jpg", "b.jpg", "c.jpg", "dir/d.jpg"):
+        images.put("in", name, b"image")
+    images.put("out", "b.jpg.json", '{"labelAnnotations": []}')
+    images.put("out", "dir/d.jpg.json", "{}")
+    return images
+
+
+def list_files(query):
+    response, body = get("/bucket/list?" + query)
+    return response, json.loads(body)
+
+
+def test_list_files_by_position(listing):
+    # When
+    _, result = list_files("start=1&end=3&embed=1")
+
+    # Then
+    assert list(result) == ["b.jpg", "c.jpg"]
+    assert result["b.jpg"] == {
+        "annotation": "b.jpg.json",
+        "content": {"labelAnnotations": []},
+    }
+    assert result["c.jpg"] is None
+
+
+def test_list_files_with_cursor(listing):
+    # When
+    first, first_page = list_files("limit=3")
+    cursor = first.headers["X-Next-Cursor"]
+    last, last_page = list_files("limit=3&cursor=" + cursor)
+    _, prefixed = list_files("prefix=dir/&limit=10")
+
+    # Then
+    assert list(first_page) == ["a.jpg", "b.jpg", "c.jpg"]
+    assert list(last_page) == ["dir/d.jpg", "image.png"]
+    assert "X-Next-Cursor" not in last.headers
+    assert prefixed == {"dir/d.jpg": {"annotation": "dir/d.jpg.json", "content": None}}
+
+
+def test_list_files_skips_internal_objects(listing, monkeypatch):
+    # Given
+    for name in ("A.jpg", "z.jpg"):
+        listing.put("in", name, b"image")
+        listing.put("out", name + ".json", "{}")
+    for page in range(1, 101):
+        listing.put("out", f"_vision/pages/doc.pdf/{page:05d}.json", "{}")
+    listed = []
+    list_blobs = listing.list_blobs
+
+    def recorded_list_blobs(*args, **kwargs):
+        blobs = list(list_blobs(*args, **kwargs))
+        listed.extend(blob.name for blob in blobs)
+        return blobs
+
+    monkeypatch.setattr(listing, "list_blobs", recorded_list_blobs)
+
+    # When
+    _, result = list_files("limit=10")
+
+    # Then
+    assert [name for name, annotation in result.items() if annotation] == [
+        "A.jpg",
+        "b.jpg",
+        "dir/d.jpg",
+        "z.jpg",
+    ]
+    assert not [name for name in listed if name.startswith("_vision/")]
+
+
+def test_list_files_uses_manifest(listing, monkeypatch):
+    # Given
+    rebuild_manifest("out")
+    listing.put("in", "e.jpg", b"image", content_type="image/jpeg")
+    annotate_gcs_mock_vision = patch(
+        "google.cloud.vision.ImageAnnotatorClient",
+        lambda: FakeVisionClient(listing),
+    )
+    with annotate_gcs_mock_vision:
+        annotate_gcs(finalized_event("in", "e.jpg", size="5", generation="7"))
+    lists = listing.counters["lists"]
+
+    # When
+    _, result = list_files("limit=10")
+
+    # Then
+    assert [name for name, annotation in result.items() if annotation] == [
+        "b.jpg",
+        "dir/d.jpg",
+        "e.jpg",
+    ]
+    assert get_manifest("out").get("e.jpg") == 7
+    # only images are listed, annotations are found in the manifest
+    assert listing.counters["lists"] == lists + 1
+
+
+def test_manifest_is_updated_only_once_built(listing):
+    # Given
+    listing.put("in", "e.jpg", b"image", content_type="image/jpeg")
+    listing.put("in", "f.jpg", b"image", content_type="image/jpeg")
+
+    # When
+    with patch(
+        "google.cloud.vision.ImageAnnotatorClient", lambda: FakeVisionClient(listing)
+    ):
+        annotate_gcs(finalized_event("in", "e.jpg", generation="7"))
+        names_before_build = listing.names("out")
+        with flask.Flask(__name__).test_request_context("/?manifest_only=true"):
+            response = annotate_backfill(flask.request)
+        annotate_gcs(finalized_event("in", "f.jpg", generation="8"))
+
+    # Then
+    assert not any(name.startswith("_vision/") for name in names_before_build)
+    assert json.loads(response.get_data()) == {"manifest": 3}
+    assert get_manifest("out").get("e.jpg") == 0
+    assert get_manifest("out").get("f.jpg") == 8
+    assert not any(
+        name.startswith("_vision/backfill/") for name in listing.names("out")
+    )
+
+
+def test_manifest_rebuild_keeps_concurrent_updates():
+    # Given
+    storage_client = FakeStorageClient()
+    store = ShardedJsonStore(lambda: storage_client.bucket("out"), "m/", num_shards=4)
+    store.write_all([("a", 1), ("stale", 1), ("deleted", 1)], {})
+
+    def listed():
+        yield "a", 2
+        # other writers change the store while it's being rebuilt
+        store.put("b", 3)
+        store.delete("deleted")
+        yield "deleted", 1
+
+    # When
+    count = store.write_all(listed(), {})
+
+    # Then
+    assert count == 2
+    assert [store.get(key) for key in ("a", "b", "stale", "deleted")] == [
+        2,
+        3,
+        None,
+        None,
+    ]
+
+
+def test_list_files_with_thumbnails(listing):
+    # Given
+    generation = listing.bucket("in")._blobs["dir/d.jpg"].generation
+
+    # When
+    _, result = list_files("prefix=dir/&limit=10&thumbnail=256")
+    invalid, _ = get("/bucket/list?thumbnail=10")
+
+    # Then
+    assert result == {
+        "dir/d.jpg": {
+            "annotation": "dir/d.jpg.json",
+            "content": None,
+            "thumbnail": f"/bucket/imagedata/dir/d.jpg?size=256&generation={generation}",
+        }
+    }
+    _, all_files = list_files("limit=2&thumbnail=256")
+    assert all_files["a.jpg"]["annotation"] is None
+    assert all_files["a.jpg"]["thumbnail"].startswith("/bucket/imagedata/a.jpg?")
+    assert invalid.status_code == 400
+
+
+def test_list_files_embeds_annotations_concurrently(images, monkeypatch):
+    # Given
+    monkeypatch.setenv("EMBED_MAX", "20")
+    names = [f"{i:02d}.jpg" for i in range(20)]
+    images.put_many("in", names, b"image")
+    images.put_many("out", [name + ".json" for name in names], b'{"a": 1}')
+    images.latency = 0.05
+
+    # When
+    started = time.perf_counter()
+    response, result = list_files("limit=20&embed=30")
+    elapsed = time.perf_counter() - started
+
+    # Then
+    assert all(result[name]["content"] == {"a": 1} for name in names)
+    assert "X-Embed-Failed" not in response.headers
+    assert elapsed < 20 * 0.05
+
+
+def test_list_files_reports_embed_timeouts(listing, monkeypatch):
+    # Given
+    monkeypatch.setenv("EMBED_FETCH_TIMEOUT", "0.01")
+    listing.latency = 0.05
+
+    # When
+    response, result = list_files("limit=10&embed=5")
+
+    # Then
+    assert response.headers["X-Embed-Failed"] == "2"
+    assert result["b.jpg"] == {"annotation": "b.jpg.json", "content": None}
+
+
+def test_get_annotation_reads_compressed_output(images, monkeypatch):
+    # Given
+    monkeypatch.setenv("OUTPUT_GZIP", "true")
+    monkeypatch.setenv("OUTPUT_COMPACT", "true")
+    write_annotation("out", "image.png", '{"labelAnnotations": [{"score": 1}]}')
+
+    # When
+    response, body = get("/bucket/annotation/image.png.json")
+
+    # Then
+    assert images.bucket("out")._blobs["image.png.json"].content_encoding == "gzip"
+    assert response.status_code == 200
+    assert json.loads(body) == {"labelAnnotations": [{"score": 1}]}
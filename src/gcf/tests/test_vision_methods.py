@@ -12,16 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import io
+import json
+import threading
 from typing import Dict, List
 from unittest.mock import patch
+import flask
+import pytest
+from google.api_core import exceptions
 from google.cloud import vision
 
+from benchmarks.fakes import FakeStorageClient, FakeVisionClient, finalized_event
+
 with patch("google.cloud.logging.Client"):
     with patch("opentelemetry.exporter.cloud_trace.CloudTraceSpanExporter"):
+        import main
         from main import (
+            AnnotationBatcher,
+            annotate_gcs,
+            annotate_gcs_batched,
+            annotate_http,
+            batch_annotate_images,
             build_features_list,
             get_all_vision_features,
+            get_config,
             get_feature_by_name,
+            parse_features,
             read_vision_image_from_gcs,
         )
 
@@ -85,3 +102,456 @@ def test_build_features_list():
         {"type_": vision.Feature.Type.LABEL_DETECTION},
         {"type_": vision.Feature.Type.FACE_DETECTION},
     ]
+
+
+def test_parse_features_reports_unknown_names():
+    # When
+    selection = parse_features('LABEL_DETECTION, "text_detection", NOPE,')
+
+    # Then
+    assert selection.features == (
+        {"type_": vision.Feature.Type.LABEL_DETECTION},
+        {"type_": vision.Feature.Type.TEXT_DETECTION},
+    )
+    assert selection.unknown == ("NOPE",)
+    assert parse_features('LABEL_DETECTION, "text_detection", NOPE,') is selection
+
+
+def test_parse_features_with_options():
+    # When
+    selection = parse_features(
+        "label_detection:5, TEXT_DETECTION@builtin/latest, OBJECT_LOCALIZATION:3@x,"
+        "LABEL_DETECTION:many, FACE_DETECTION@"
+    )
+
+    # Then
+    assert selection.features == (
+        {"type_": vision.Feature.Type.LABEL_DETECTION, "max_results": 5},
+        {"type_": vision.Feature.Type.TEXT_DETECTION, "model": "builtin/latest"},
+        {
+            "type_": vision.Feature.Type.OBJECT_LOCALIZATION,
+            "max_results": 3,
+            "model": "x",
+        },
+    )
+    assert selection.unknown == ("LABEL_DETECTION:many", "FACE_DETECTION@")
+
+
+def test_get_config_parses_environment_once(monkeypatch):
+    # Given
+    monkeypatch.setenv("FEATURES", "LABEL_DETECTION")
+    monkeypatch.setenv("INPUT_BUCKET", "in")
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+
+    # When
+    config = get_config()
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "other")
+
+    # Then
+    assert get_config() is config
+    assert config.features.features == ({"type_": vision.Feature.Type.LABEL_DETECTION},)
+    assert (config.input_bucket, config.annotations_bucket) == ("in", "out")
+
+
+def test_batch_annotate_images_splits_requests(mocker):
+    # Given
+    client_class = mocker.patch("google.cloud.vision.ImageAnnotatorClient")
+    client = client_class.return_value
+    client.batch_annotate_images.side_effect = (
+        lambda requests, timeout, **kwargs: vision.BatchAnnotateImagesResponse(
+            responses=[vision.AnnotateImageResponse() for _ in requests]
+        )
+    )
+    requests = [vision.AnnotateImageRequest() for _ in range(20)]
+
+    # When
+    responses = batch_annotate_images(requests)
+
+    # Then
+    calls = client.batch_annotate_images.call_args_list
+    assert len(responses) == 20
+    assert [len(c.kwargs["requests"]) for c in calls] == [16, 4]
+
+
+def test_annotation_batcher_isolates_failures(mocker):
+    # Given
+    client_class = mocker.patch("google.cloud.vision.ImageAnnotatorClient")
+    client = client_class.return_value
+
+    def batch_annotate(requests, timeout, **kwargs):
+        responses = []
+        for request in requests:
+            response = vision.AnnotateImageResponse()
+            if "bad" in request.image.source.image_uri:
+                response.error.code = 3
+                response.error.message = "Bad image"
+            responses.append(response)
+        return vision.BatchAnnotateImagesResponse(responses=responses)
+
+    client.batch_annotate_images.side_effect = batch_annotate
+    batcher = AnnotationBatcher(window=0.5, max_size=4)
+    names = ["a.jpg", "bad.jpg", "c.jpg", "d.jpg"]
+    results = {}
+    errors = {}
+
+    def annotate(name):
+        try:
+            results[name] = annotate_gcs_batched(batcher, "id", "in", name, [])
+        except RuntimeError as e:
+            errors[name] = e
+
+    # When
+    threads = [threading.Thread(target=annotate, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Then
+    assert client.batch_annotate_images.call_count == 1
+    assert list(errors) == ["bad.jpg"]
+    assert sorted(results) == ["a.jpg", "c.jpg", "d.jpg"]
+
+
+def test_read_vision_image_from_gcs_checks_size(mocker, monkeypatch):
+    # Given
+    monkeypatch.setenv("MAX_IMAGE_SIZE", "10")
+    storage_client = FakeStorageClient()
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    storage_client.put("in", "small.jpg", b"x" * 10)
+    storage_client.put("in", "large.jpg", b"x" * 11)
+
+    # When
+    small_image = read_vision_image_from_gcs("in", "small.jpg")
+    large_image = read_vision_image_from_gcs("in", "large.jpg")
+
+    # Then
+    assert small_image.content == b"x" * 10
+    assert large_image is None
+    assert storage_client.counters["downloads"] == 1
+
+
+def test_annotate_gcs_passes_gcs_uri_to_vision(mocker, monkeypatch):
+    # Given
+    monkeypatch.setenv("ANNOTATIONS_BUCKET", "out")
+    storage_client = FakeStorageClient()
+    vision_client = FakeVisionClient(storage_client)
+    mocker.patch("google.cloud.storage.Client", lambda: storage_client)
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: vision_client)
+    storage_client.put("in", "image.jpg", b"image")
+
+    # When
+    annotate_gcs(finalized_event("in", "image.jpg", size="5"))
+
+    # Then
+    assert storage_client.counters["downloads"] == 0
+    assert vision_client.counters["annotate"] == 1
+    assert "image.jpg.json" in storage_client.names("out")
+
+
+@pytest.fixture
+def vision_client(mocker):
+    client = FakeVisionClient()
+    mocker.patch("google.cloud.vision.ImageAnnotatorClient", lambda: client)
+    return client
+
+
+def post(path, headers=None, **kwargs):
+    app = flask.Flask(__name__)
+    with app.test_request_context(path, method="POST", headers=headers, **kwargs):
+        response = annotate_http(flask.request)
+        return response, response.get_data()
+
+
+def test_annotate_batch_returns_results_in_order(vision_client, monkeypatch):
+    # Given
+    monkeypatch.setenv("ANNOTATE_BATCH_PARALLELISM", "3")
+    uris = [f"gs://in/{i}.jpg" for i in range(40)]
+    uris[5] = "gs://in/error.jpg"
+
+    # When
+    response, body = post(
+        "/annotate/batch",
+        data={
+            "image_uri": uris,
+            "image": [(io.BytesIO(b"image"), "upload.jpg")],
+        },
+    )
+
+    # Then
+    responses = json.loads(body)["responses"]
+    assert response.status_code == 200
+    assert len(responses) == 41
+    assert responses[0]["labelAnnotations"][0]["description"] == uris[0]
+    assert responses[5]["error"]["code"] == 3
+    assert responses[39]["labelAnnotations"][0]["description"] == uris[39]
+    assert responses[40]["labelAnnotations"][0]["description"] == "uploaded image"
+    assert vision_client.counters["batch"] == 3
+
+
+def test_annotate_batch_streams_ndjson(vision_client):
+    # Given
+    uris = [f"gs://in/{i}.jpg" for i in range(20)]
+
+    # When
+    response, body = post(
+        "/annotate/batch",
+        json={"image_uri": uris},
+        headers={"Accept": "application/x-ndjson"},
+    )
+
+    # Then
+    lines = [json.loads(line) for line in body.decode().splitlines()]
+    assert response.mimetype == "application/x-ndjson"
+    assert sorted(line["index"] for line in lines) == list(range(20))
+    assert all(
+        line["response"]["labelAnnotations"][0]["description"] == uris[line["index"]]
+        for line in lines
+    )
+
+
+def app_client():
+    """Returns test client of an app serving the function, like the Functions Framework."""
+    app = flask.Flask(__name__)
+    app.add_url_rule(
+        "/<path:path>",
+        "annotate_http",
+        lambda path: annotate_http(flask.request),
+        methods=["GET", "POST"],
+    )
+    return app.test_client()
+
+
+def test_annotate_batch_streams_ndjson_of_uploads(vision_client):
+    # Given
+    client = app_client()
+
+    # When
+    response = client.post(
+        "/annotate/batch?format=ndjson",
+        data={"image": [(io.BytesIO(b"image %d" % i), f"{i}.png") for i in range(20)]},
+    )
+
+    # Then
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert response.status_code == 200
+    assert sorted(line["index"] for line in lines) == list(range(20))
+    assert all(
+        line["response"]["labelAnnotations"][0]["description"] == "uploaded image"
+        for line in lines
+    )
+    assert vision_client.counters["images"] == 20
+
+
+def test_annotate_batch_reports_failed_group(mocker, vision_client):
+    # Given
+    mocker.patch.object(
+        vision_client,
+        "batch_annotate_images",
+        side_effect=exceptions.ServiceUnavailable("unavailable"),
+    )
+
+    # When
+    response, body = post(
+        "/annotate/batch", json={"image_uri": ["gs://in/a.jpg", "gs://in/b.jpg"]}
+    )
+
+    # Then
+    responses = json.loads(body)["responses"]
+    assert response.status_code == 200
+    assert [r["error"]["code"] for r in responses] == [14, 14]
+
+
+def test_annotate_batch_limits_number_of_images(vision_client, monkeypatch):
+    # Given
+    monkeypatch.setenv("ANNOTATE_BATCH_ITEMS_MAX", "2")
+
+    # When
+    too_many, _ = post(
+        "/annotate/batch", json={"image_uri": ["gs://in/a", "gs://in/b", "gs://in/c"]}
+    )
+    empty, _ = post("/annotate/batch", json={"image_uri": []})
+
+    # Then
+    assert too_many.status_code == 413
+    assert empty.status_code == 412
+    assert vision_client.counters["images"] == 0
+
+
+def uploads(sizes: List[int]) -> dict:
+    return {
+        "image": [(io.BytesIO(bytes(size)), f"{i}.png") for i, size in enumerate(sizes)]
+    }
+
+
+def test_annotate_batch_limits_uploaded_bytes(vision_client, monkeypatch):
+    # Given
+    monkeypatch.setenv("ANNOTATE_BATCH_BYTES_MAX", "1000")
+    monkeypatch.setenv("MAX_IMAGE_SIZE", "300")
+
+    # When
+    too_large, _ = post("/annotate/batch", data=uploads([100_000]))
+    partly, body = post("/annotate/batch", data=uploads([400, 200]))
+
+    # Then
+    assert too_large.status_code == 413
+    responses = json.loads(body)["responses"]
+    assert partly.status_code == 200
+    assert responses[0]["error"]["code"] == 3
+    assert "error" not in responses[1]
+    assert vision_client.counters["images"] == 1
+
+
+def test_annotate_batch_reads_uploads_per_group(vision_client, mocker, monkeypatch):
+    # Given
+    monkeypatch.setenv("ANNOTATE_BATCH_PARALLELISM", "1")
+    events = []
+    upload_request = main.upload_request
+
+    def counted_upload_request(*args):
+        build = upload_request(*args)
+
+        def read_upload():
+            events.append("read")
+            return build()
+
+        return read_upload
+
+    def batch_annotate(requests=None, **kwargs):
+        events.append(len(requests))
+        return FakeVisionClient.batch_annotate_images(
+            vision_client, requests=requests, **kwargs
+        )
+
+    mocker.patch.object(vision_client, "batch_annotate_images", batch_annotate)
+    mocker.patch("main.upload_request", counted_upload_request)
+
+    # When
+    response, body = post("/annotate/batch", data=uploads([10] * 40))
+
+    # Then
+    assert response.status_code == 200
+    assert len(json.loads(body)["responses"]) == 40
+    groups = [e for e in events if e != "read"]
+    assert groups == [16, 16, 8]
+    assert events.index(16) < events.index("read", events.index(16))
+
+
+@pytest.fixture
+def annotated_images(mocker):
+    images = []
+
+    def annotate(vision_image, features, image_context=None):
+        images.append(vision_image.content)
+        return "{}"
+
+    mocker.patch("main.annotate_image", side_effect=annotate)
+    mocker.patch("google.cloud.storage.Client")
+    return images
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"data": {"image": base64.b64encode(bytes(range(256))).decode()}},
+        {"json": {"image": base64.b64encode(bytes(range(256))).decode()}},
+        {
+            "json": {
+                "image": "data:image/png;base64,"
+                + base64.b64encode(bytes(range(256))).decode()
+            }
+        },
+        {
+            "data": bytes(range(256)),
+            "headers": {"Content-Type": "application/octet-stream"},
+        },
+        {"data": {"image": (io.BytesIO(bytes(range(256))), "image.png")}},
+    ],
+    ids=["form", "json", "data_url", "raw", "file"],
+)
+def test_annotate_decodes_uploaded_image(annotated_images, kwargs):
+    # When
+    response, _ = post("/annotate", **kwargs)
+
+    # Then
+    assert response.status_code == 200
+    assert annotated_images == [bytes(range(256))]
+
+
+def test_annotate_rejects_invalid_uploads(annotated_images, monkeypatch):
+    # Given
+    monkeypatch.setenv("MAX_IMAGE_SIZE", "100")
+    image_b64 = base64.b64encode(bytes(200)).decode()
+
+    # When
+    too_large_form, _ = post("/annotate", data={"image": image_b64})
+    too_large_raw, _ = post(
+        "/annotate",
+        data=bytes(101),
+        headers={"Content-Type": "image/png"},
+    )
+    too_large_body, _ = post("/annotate", data={"image": "A" * 70_000})
+    invalid, _ = post("/annotate", json={"image": "Zm9vé"})
+
+    # Then
+    assert too_large_form.status_code == 413
+    assert too_large_raw.status_code == 413
+    assert too_large_body.status_code == 413
+    assert invalid.status_code == 400
+    assert annotated_images == []
+
+
+@pytest.mark.parametrize("image_b64", ["@@@@", "abcd efgh!!", "Zm9v=A==", "===="])
+def test_annotate_rejects_malformed_base64(annotated_images, image_b64):
+    # When
+    response, _ = post("/annotate", data={"image": image_b64})
+
+    # Then
+    assert response.status_code == 400
+    assert annotated_images == []
+
+
+def test_annotate_rejects_unknown_features(vision_client):
+    # When
+    response, body = post(
+        "/annotate", data={"image_uri": "gs://in/a.jpg", "features": "LABELS"}
+    )
+    batch_response, _ = post(
+        "/annotate/batch", json={"image_uri": ["gs://in/a.jpg"], "features": ["LABELS"]}
+    )
+
+    # Then
+    assert response.status_code == 400
+    assert body == b"Unknown features: LABELS"
+    assert batch_response.status_code == 400
+    assert vision_client.counters["images"] == 0
+
+
+def test_annotate_passes_feature_options_and_image_context(vision_client, mocker):
+    # Given
+    annotate_image = mocker.spy(vision_client, "annotate_image")
+
+    # When
+    response, _ = post(
+        "/annotate",
+        json={
+            "image_uri": "https://example.com/a.jpg",
+            "features": "LABEL_DETECTION:5,TEXT_DETECTION@builtin/latest",
+            "image_context": {"languageHints": ["en"]},
+        },
+    )
+    invalid, body = post(
+        "/annotate",
+        json={"image_uri": "https://example.com/a.jpg", "image_context": "{bad"},
+    )
+
+    # Then
+    request = annotate_image.call_args.args[0]
+    assert response.status_code == 200
+    assert [(f.type_, f.max_results, f.model) for f in request.features] == [
+        (vision.Feature.Type.LABEL_DETECTION, 5, ""),
+        (vision.Feature.Type.TEXT_DETECTION, 0, "builtin/latest"),
+    ]
+    assert list(request.image_context.language_hints) == ["en"]
+    assert invalid.status_code == 400
+    assert body.startswith(b"Invalid image context")